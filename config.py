@@ -12,8 +12,111 @@ STORAGE_DIRECTORY = os.path.join(BASE_DIR, 'storage')
 
 # enables demo
 STORAGE_DIRECTORY = os.environ.get('STORAGE_DIR', os.path.join(BASE_DIR, 'storage'))
+# store identical originals (and their resized versions) only once.
+# only enable this for a new (empty) STORAGE_DIRECTORY.
+CONTENT_ADDRESSED = os.environ.get('CONTENT_ADDRESSED', 'False') == 'True'
+# spreads the images over subdirectories (STORAGE_DIRECTORY/ab/cd/), for millions of images.
+# move existing images first: python -m image_service.migrate STORAGE_DIRECTORY --sharded
+SHARDED_STORAGE = os.environ.get('SHARDED_STORAGE', 'False') == 'True'
+# keeps a sqlite index of the images (STORAGE_DIRECTORY/.index.sqlite), so existence checks, validators
+# and listings don't touch the filesystem. not for CONTENT_ADDRESSED or TIER_CACHE_DIRECTORY.
+# index existing images first: python -m image_service.reindex STORAGE_DIRECTORY
+METADATA_INDEX = os.environ.get('METADATA_INDEX', 'False') == 'True'
+# where images are stored: filesystem (STORAGE_DIRECTORY) or s3 (any s3 compatible object store, needs boto3).
+# serving with x-accel-redirect or x-sendfile needs the filesystem, s3 is rejected with them.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'filesystem')
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+# key prefix of all images in the bucket, e.g. "images/"
+S3_PREFIX = os.environ.get('S3_PREFIX', '')
+# e.g. http://localhost:9000 for minio, the credentials are read by boto3 (env, ~/.aws, ...)
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+S3_REGION = os.environ.get('S3_REGION') or None
+# connections shared by all threads of a worker, should be >= its number of threads
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 10))
+# originals larger than this (bytes) are uploaded in parts
+S3_MULTIPART_THRESHOLD = int(os.environ.get('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024))
+# keeps the resized images in a (fast, local) directory of their own, while the originals stay in
+# the storage above. the least recently read resized images are evicted when it grows over
+# TIER_CACHE_BYTES and are created again on their next request. needs SERVE_MODE=python.
+TIER_CACHE_DIRECTORY = os.environ.get('TIER_CACHE_DIRECTORY', '')
+TIER_CACHE_BYTES = int(os.environ.get('TIER_CACHE_BYTES', 1024 * 1024 * 1024))
 ENABLE_DEMO = os.environ.get('ENABLE_DEMO', 'True') == 'True'
 AUTH_TOKEN = os.environ.get('AUTH_TOKEN', '*:demo').split(":") \
     if ":" in os.environ.get('AUTH_TOKEN', '*:demo') else ""
 AUTH_BASIC = os.environ.get('AUTH_BASIC', 'uploader:uploader').split(":") \
-    if ":" in os.environ.get('AUTH_BASIC', 'uploader:uploader') else ""
\ No newline at end of file
+    if ":" in os.environ.get('AUTH_BASIC', 'uploader:uploader') else ""
+
+# bytes of manipulated images to keep in memory (per process), 0 disables the cache
+DERIVATIVE_CACHE_BYTES = int(os.environ.get('DERIVATIVE_CACHE_BYTES', 0))
+
+# versions of every uploaded image that are created right away (in the background)
+# instead of on the first request, e.g. PRESETS="fit-200x200,crop-100x100"
+PRESETS = [(preset.split('-')[0], tuple(int(x) for x in preset.split('-')[1].split('x')))
+           for preset in os.environ.get('PRESETS', '').split(',') if preset]
+# number of background threads creating presets
+PRESET_WORKERS = int(os.environ.get('PRESET_WORKERS', 2))
+# threads storing or deleting the images of batch requests (shared by all requests of a process)
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))
+
+# bounds the manipulated images that requests can create. with ALLOWED_SIZES="100x100,400x300" only
+# these sizes are created, otherwise SIZE_STEP (0 disables it) rounds sizes up to multiples of it.
+# requests for other sizes are redirected to the canonical url. larger sizes than MAX_WIDTH or
+# MAX_HEIGHT (0: no limit) get a 404.
+ALLOWED_SIZES = [tuple(int(x) for x in size.split('x'))
+                 for size in os.environ.get('ALLOWED_SIZES', '').split(',') if size]
+SIZE_STEP = int(os.environ.get('SIZE_STEP', 0))
+MAX_WIDTH = int(os.environ.get('MAX_WIDTH', 0))
+MAX_HEIGHT = int(os.environ.get('MAX_HEIGHT', 0))
+# with a key, only urls signed with it (see image_service/signing.py) create manipulated images.
+# unsigned requests only get the stored ones, invalid or expired signatures a 403.
+URL_SIGNING_KEY = os.environ.get('URL_SIGNING_KEY', '')
+# an image keeps at most this many manipulated versions (0: no limit), the least recently
+# read ones are deleted when new ones are created
+MAX_MANIPULATED_PER_IMAGE = int(os.environ.get('MAX_MANIPULATED_PER_IMAGE', 0))
+
+# where images are resized: inline (in the request thread), thread or process (pool).
+# with the process pool resizing isn't limited by the GIL of a threaded uwsgi worker.
+RESIZE_EXECUTOR = os.environ.get('RESIZE_EXECUTOR', 'inline')
+# pool size, defaults to the number of cpus
+RESIZE_WORKERS = int(os.environ.get('RESIZE_WORKERS', 0)) or None
+# max. number of queued or running resize jobs, more requests get a 503
+RESIZE_QUEUE_SIZE = int(os.environ.get('RESIZE_QUEUE_SIZE', 64))
+# seconds a request waits for its resize job before getting a 504
+RESIZE_TIMEOUT = float(os.environ.get('RESIZE_TIMEOUT', 30))
+# with this many queued or running resize jobs (0 disables it) missing manipulated images are
+# created in the background. the request gets a 202 with Retry-After (OVERLOAD_RESPONSE=accepted)
+# or the smallest larger stored version for the client to scale down (nearest, 202 if there is none).
+OVERLOAD_PENDING = int(os.environ.get('OVERLOAD_PENDING', 0))
+OVERLOAD_RESPONSE = os.environ.get('OVERLOAD_RESPONSE', 'accepted')
+OVERLOAD_RETRY_AFTER = int(os.environ.get('OVERLOAD_RETRY_AFTER', 2))
+# at most this many missing manipulated images wait to be created in the background, requests
+# for further ones get a 503 while it's full
+BACKGROUND_QUEUE_SIZE = int(os.environ.get('BACKGROUND_QUEUE_SIZE', 256))
+# images are never decoded when they have more pixels or when decoding them needs more memory
+# (bytes, jpegs are decoded at a reduced scale). uploads that could never be resized get a 413.
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 100 * 1000 * 1000))
+MAX_DECODED_BYTES = int(os.environ.get('MAX_DECODED_BYTES', 512 * 1024 * 1024))
+# animated gifs and webps keep their frames when resized (to gif or webp), one frame is decoded at a
+# time. animations with more frames or more pixels in all frames (0: no limit) are resized as stills.
+MAX_FRAMES = int(os.environ.get('MAX_FRAMES', 1000))
+MAX_ANIMATION_PIXELS = int(os.environ.get('MAX_ANIMATION_PIXELS', 200 * 1000 * 1000))
+
+# Cache-Control max-age (seconds) for originals and resized images, 0 means no-cache.
+# responses always have an ETag and Last-Modified for (cheap) revalidation.
+ORIGINAL_MAX_AGE = int(os.environ.get('ORIGINAL_MAX_AGE', 43200))
+MANIPULATED_MAX_AGE = int(os.environ.get('MANIPULATED_MAX_AGE', 43200))
+
+# how images are sent: python (send_file, with range requests), x-accel-redirect (nginx)
+# or x-sendfile (apache, lighttpd). the latter two free the uwsgi workers from copying bytes.
+SERVE_MODE = os.environ.get('SERVE_MODE', 'python')
+# internal nginx location that is an alias of STORAGE_DIRECTORY (for x-accel-redirect)
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/protected')
+
+# resized images are sent in the first of these formats the client accepts (Accept header),
+# e.g. NEGOTIATED_FORMATS="avif,webp". formats pillow can't write are skipped.
+NEGOTIATED_FORMATS = [f for f in os.environ.get('NEGOTIATED_FORMATS', '').split(',') if f]
+# pillow encoder options per output extension
+FORMAT_OPTIONS = {
+    'webp': {'quality': int(os.environ.get('WEBP_QUALITY', 80)), 'method': int(os.environ.get('WEBP_METHOD', 4))},
+    'avif': {'quality': int(os.environ.get('AVIF_QUALITY', 60)), 'speed': int(os.environ.get('AVIF_SPEED', 6))},
+}
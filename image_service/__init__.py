@@ -1,16 +1,75 @@
+import io
+import os
+import os.path as op
 import mimetypes
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime
 import werkzeug
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+from urllib.parse import quote
 
-from flask import Flask, send_file, request, Response, render_template
+from flask import Flask, send_file, request, Response, render_template, jsonify, g, redirect
 from flask.ext.restful import Api, Resource, reqparse, fields, marshal_with
 from flask_cors import CORS
-from werkzeug.exceptions import Unauthorized
+from werkzeug.exceptions import Unauthorized, BadRequest, RequestEntityTooLarge, HTTPException, InternalServerError, \
+    Forbidden
+from werkzeug.http import is_resource_modified
 
+from image_service import image, metrics, signing
 from image_service.storage import *
+from image_service.s3 import S3Storage
+from image_service.cache import DerivativeCache, CachingStorage
+from image_service.executor import create_executor, ResizeQueueFull
+from image_service.policy import SizePolicy
 
 
 CONFIG_STORAGE_DIR = 'STORAGE_DIRECTORY'
+CONFIG_CONTENT_ADDRESSED = 'CONTENT_ADDRESSED'
+CONFIG_SHARDED_STORAGE = 'SHARDED_STORAGE'
+CONFIG_METADATA_INDEX = 'METADATA_INDEX'
+CONFIG_STORAGE_BACKEND = 'STORAGE_BACKEND'
+CONFIG_S3_BUCKET = 'S3_BUCKET'
+CONFIG_S3_PREFIX = 'S3_PREFIX'
+CONFIG_S3_ENDPOINT_URL = 'S3_ENDPOINT_URL'
+CONFIG_S3_REGION = 'S3_REGION'
+CONFIG_S3_MAX_POOL_CONNECTIONS = 'S3_MAX_POOL_CONNECTIONS'
+CONFIG_S3_MULTIPART_THRESHOLD = 'S3_MULTIPART_THRESHOLD'
+CONFIG_TIER_CACHE_DIR = 'TIER_CACHE_DIRECTORY'
+CONFIG_TIER_CACHE_BYTES = 'TIER_CACHE_BYTES'
+CONFIG_DERIVATIVE_CACHE_BYTES = 'DERIVATIVE_CACHE_BYTES'
+CONFIG_PRESETS = 'PRESETS'
+CONFIG_PRESET_WORKERS = 'PRESET_WORKERS'
+CONFIG_BATCH_WORKERS = 'BATCH_WORKERS'
+CONFIG_RESIZE_EXECUTOR = 'RESIZE_EXECUTOR'
+CONFIG_RESIZE_WORKERS = 'RESIZE_WORKERS'
+CONFIG_RESIZE_QUEUE_SIZE = 'RESIZE_QUEUE_SIZE'
+CONFIG_RESIZE_TIMEOUT = 'RESIZE_TIMEOUT'
+CONFIG_OVERLOAD_PENDING = 'OVERLOAD_PENDING'
+CONFIG_OVERLOAD_RESPONSE = 'OVERLOAD_RESPONSE'
+CONFIG_OVERLOAD_RETRY_AFTER = 'OVERLOAD_RETRY_AFTER'
+CONFIG_BACKGROUND_QUEUE_SIZE = 'BACKGROUND_QUEUE_SIZE'
+CONFIG_MAX_IMAGE_PIXELS = 'MAX_IMAGE_PIXELS'
+CONFIG_MAX_DECODED_BYTES = 'MAX_DECODED_BYTES'
+CONFIG_MAX_FRAMES = 'MAX_FRAMES'
+CONFIG_MAX_ANIMATION_PIXELS = 'MAX_ANIMATION_PIXELS'
+CONFIG_ALLOWED_SIZES = 'ALLOWED_SIZES'
+CONFIG_SIZE_STEP = 'SIZE_STEP'
+CONFIG_MAX_WIDTH = 'MAX_WIDTH'
+CONFIG_MAX_HEIGHT = 'MAX_HEIGHT'
+CONFIG_MAX_MANIPULATED = 'MAX_MANIPULATED_PER_IMAGE'
+CONFIG_URL_SIGNING_KEY = 'URL_SIGNING_KEY'
+CONFIG_ORIGINAL_MAX_AGE = 'ORIGINAL_MAX_AGE'
+CONFIG_MANIPULATED_MAX_AGE = 'MANIPULATED_MAX_AGE'
+CONFIG_SERVE_MODE = 'SERVE_MODE'
+CONFIG_X_ACCEL_PREFIX = 'X_ACCEL_PREFIX'
+CONFIG_NEGOTIATED_FORMATS = 'NEGOTIATED_FORMATS'
+CONFIG_FORMAT_OPTIONS = 'FORMAT_OPTIONS'
 
 app = Flask(__name__)
 app.config.from_pyfile('../config.py', silent=True)
@@ -18,6 +77,25 @@ api = Api(app)
 cors = CORS(app, resources={r'/*': {'origins': '*'}})
 
 _storage = None
+_storage_lock = threading.Lock()
+_resize_executor = None
+_preset_executor = None
+_batch_executor = None
+# manipulated images being created in the background because of overload
+_background_jobs = set()
+_background_lock = threading.Lock()
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    if 'request_start' in g:
+        metrics.observe('request', time.perf_counter() - g.request_start)
+    return response
 
 
 @app.after_request
@@ -37,13 +115,361 @@ def storage():
     """returns access to the storage (save_image(), get() and exists())"""
     global _storage
     if not _storage:
-        _storage = FileSystemStorage(app.config[CONFIG_STORAGE_DIR])
+        # batch requests call this from several threads
+        with _storage_lock:
+            if not _storage:
+                _storage = _create_storage()
     return _storage
 
 
+def _create_storage():
+    global _resize_executor
+    limits = _image_limits() + _animation_limits()
+    image.set_limits(*limits)
+    executor = _resize_executor = create_executor(app.config.get(CONFIG_RESIZE_EXECUTOR, 'inline'),
+                                                  app.config.get(CONFIG_RESIZE_WORKERS),
+                                                  app.config.get(CONFIG_RESIZE_QUEUE_SIZE, 64),
+                                                  app.config.get(CONFIG_RESIZE_TIMEOUT),
+                                                  image.set_limits, limits)
+    backend = app.config.get(CONFIG_STORAGE_BACKEND, 'filesystem')
+    offload = app.config.get(CONFIG_SERVE_MODE, 'python') != 'python'
+    if backend == 's3':
+        if offload:
+            # the web server can only send files of the local filesystem
+            raise ValueError('SERVE_MODE must be python with STORAGE_BACKEND s3')
+        image_storage = S3Storage(app.config[CONFIG_S3_BUCKET], app.config.get(CONFIG_S3_PREFIX, ''), executor,
+                                  app.config.get(CONFIG_FORMAT_OPTIONS),
+                                  endpoint_url=app.config.get(CONFIG_S3_ENDPOINT_URL),
+                                  region_name=app.config.get(CONFIG_S3_REGION),
+                                  max_pool_connections=app.config.get(CONFIG_S3_MAX_POOL_CONNECTIONS, 10),
+                                  multipart_threshold=app.config.get(CONFIG_S3_MULTIPART_THRESHOLD, 8 * 1024 * 1024))
+    elif backend == 'filesystem' and app.config.get(CONFIG_CONTENT_ADDRESSED):
+        image_storage = ContentAddressedStorage(app.config[CONFIG_STORAGE_DIR], executor,
+                                                app.config.get(CONFIG_FORMAT_OPTIONS),
+                                                app.config.get(CONFIG_SHARDED_STORAGE),
+                                                app.config.get(CONFIG_MAX_MANIPULATED))
+    elif backend == 'filesystem':
+        image_storage = FileSystemStorage(app.config[CONFIG_STORAGE_DIR], executor,
+                                          app.config.get(CONFIG_FORMAT_OPTIONS),
+                                          app.config.get(CONFIG_SHARDED_STORAGE),
+                                          app.config.get(CONFIG_METADATA_INDEX),
+                                          app.config.get(CONFIG_MAX_MANIPULATED))
+    else:
+        raise ValueError('unknown storage backend %s' % backend)
+    if app.config.get(CONFIG_TIER_CACHE_DIR):
+        if offload:
+            # the web server only knows STORAGE_DIRECTORY, not the local tier
+            raise ValueError('SERVE_MODE must be python with TIER_CACHE_DIRECTORY')
+        image_storage = TieredStorage(image_storage, app.config[CONFIG_TIER_CACHE_DIR],
+                                      app.config.get(CONFIG_TIER_CACHE_BYTES, 1024 * 1024 * 1024), executor,
+                                      app.config.get(CONFIG_FORMAT_OPTIONS), app.config.get(CONFIG_SHARDED_STORAGE),
+                                      app.config.get(CONFIG_MAX_MANIPULATED))
+    cache_bytes = app.config.get(CONFIG_DERIVATIVE_CACHE_BYTES, 0)
+    if cache_bytes:
+        image_storage = CachingStorage(image_storage, DerivativeCache(cache_bytes))
+    return image_storage
+
+
+def _image_limits():
+    return (app.config.get(CONFIG_MAX_IMAGE_PIXELS, image.MAX_PIXELS),
+            app.config.get(CONFIG_MAX_DECODED_BYTES, image.MAX_DECODED_BYTES))
+
+
+def _animation_limits():
+    return (app.config.get(CONFIG_MAX_FRAMES, image.MAX_FRAMES),
+            app.config.get(CONFIG_MAX_ANIMATION_PIXELS, image.MAX_ANIMATION_PIXELS))
+
+
+# the header of an upload (e.g. jpegs with large exif data or icc profiles) must be within this many bytes
+UPLOAD_HEADER_BYTES = 1024 * 1024
+
+
+class _HeaderStream(object):
+    """file like object that returns the already read header and then the rest of stream"""
+
+    def __init__(self, header, stream):
+        self._header = header
+        self._stream = stream
+
+    def read(self, size=-1):
+        if not self._header:
+            return self._stream.read(size)
+        if size is None or size < 0:
+            data = self._header + self._stream.read()
+        else:
+            data = self._header[:size]
+        self._header = self._header[len(data):]
+        return data
+
+
+def _checked_upload(stream):
+    """reads the upload until pillow can parse its header and rejects it early if it
+       isn't an image or too large to ever be resized. returns a stream of the whole upload.
+    """
+    header = b''
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        header += chunk
+        try:
+            image.check_image(io.BytesIO(header), *_image_limits())
+            return _HeaderStream(header, stream)
+        except image.ImageTooLarge as e:
+            raise RequestEntityTooLarge(str(e))
+        except IOError:
+            if not chunk or len(header) >= UPLOAD_HEADER_BYTES:
+                raise BadRequest('The file is not a supported image.')
+
+
+def preset_executor():
+    """returns the background pool that creates the presets of new images"""
+    global _preset_executor
+    if not _preset_executor:
+        # batch workers call this concurrently
+        with _storage_lock:
+            if not _preset_executor:
+                _preset_executor = ThreadPoolExecutor(max_workers=app.config.get(CONFIG_PRESET_WORKERS, 2))
+    return _preset_executor
+
+
+def _log_preset_failure(future):
+    if future.exception() is not None:
+        app.logger.error('creating presets failed: %r', future.exception())
+
+
+def batch_executor():
+    """returns the pool that stores and deletes the images of batch requests"""
+    global _batch_executor
+    if not _batch_executor:
+        # concurrent batch requests call this
+        with _storage_lock:
+            if not _batch_executor:
+                _batch_executor = ThreadPoolExecutor(max_workers=app.config.get(CONFIG_BATCH_WORKERS, 4))
+    return _batch_executor
+
+
+def create_presets(name, extension):
+    """creates the configured presets of an image in the background"""
+    presets = app.config.get(CONFIG_PRESETS)
+    if not presets:
+        return None
+    future = preset_executor().submit(storage().create_manipulated, name, extension, presets)
+    future.add_done_callback(_log_preset_failure)
+    return future
+
+
+def _overloaded():
+    """true when the resize backlog reached OVERLOAD_PENDING"""
+    threshold = app.config.get(CONFIG_OVERLOAD_PENDING, 0)
+    return bool(threshold) and _resize_executor is not None and _resize_executor.pending >= threshold
+
+
+def _create_in_background(key):
+    try:
+        storage().get(*key).close()
+    except Exception:
+        app.logger.exception('creating %s in the background failed', key)
+    finally:
+        with _background_lock:
+            _background_jobs.discard(key)
+        metrics.background_pending(-1)
+
+
+def enqueue_manipulated(name, extension, mode, size, output_extension=None):
+    """creates a missing manipulated image in the background, once for concurrent requests.
+       raises ResizeQueueFull when BACKGROUND_QUEUE_SIZE images are waiting already.
+    """
+    key = (name, extension, mode, size, output_extension)
+    with _background_lock:
+        if key in _background_jobs:
+            return
+        if len(_background_jobs) >= app.config.get(CONFIG_BACKGROUND_QUEUE_SIZE, 256):
+            metrics.overload_response('rejected')
+            raise ResizeQueueFull()
+        _background_jobs.add(key)
+    metrics.background_pending(1)
+    preset_executor().submit(_create_in_background, key)
+
+
+def _nearest_manipulated(name, extension, mode, size, output_extension=None):
+    """size of the smallest stored version that the client can scale down to size,
+       for crop it needs the same aspect ratio. None if there is none.
+    """
+    width, height = size
+    sizes = [stored_size for stored_mode, stored_size, stored_extension in storage().manipulated(name, extension)
+             if stored_mode == mode and stored_extension == (output_extension or extension) and
+             stored_size[0] >= width and stored_size[1] >= height and
+             (mode == 'fit' or stored_size[0] * height == stored_size[1] * width)]
+    return min(sizes, key=lambda stored_size: stored_size[0] * stored_size[1]) if sizes else None
+
+
+def _overload_response(name, extension, mode, size, output_extension=None):
+    """answers a request for a missing manipulated image without waiting for it"""
+    nearest = None
+    if app.config.get(CONFIG_OVERLOAD_RESPONSE, 'accepted') == 'nearest':
+        nearest = _nearest_manipulated(name, extension, mode, size, output_extension)
+    if nearest is None:
+        metrics.overload_response('accepted')
+        response = Response(status=202)
+        response.headers['Retry-After'] = str(app.config.get(CONFIG_OVERLOAD_RETRY_AFTER, 2))
+    else:
+        metrics.overload_response('nearest')
+        response = _serve_stored_image(0, name, extension, mode, nearest, output_extension)
+        response.headers['Content-Location'] = _manipulated_url(name, extension, mode, nearest)
+    # the right image is there soon, nobody may cache this one
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def _manipulated_url(name, extension, mode, size, query=None):
+    url = '/images/%s@%s-%dx%d.%s' % (quote(name), mode, size[0], size[1], extension)
+    return '%s?%s' % (url, query) if query else url
+
+
+def _check_signature(name, extension, mode, size):
+    """true if the request is signed, false without a signature. raises Forbidden for
+       invalid or expired signatures, without touching the storage.
+    """
+    signed = request.args.get('sig')
+    if signed is None:
+        return False
+    try:
+        expires = int(request.args['expires']) if 'expires' in request.args else None
+    except ValueError:
+        raise Forbidden()
+    if not signing.check_signature(app.config[CONFIG_URL_SIGNING_KEY], signed, name, extension, mode, size, expires):
+        raise Forbidden()
+    return True
+
+
+def _size_policy():
+    return SizePolicy(app.config.get(CONFIG_ALLOWED_SIZES), app.config.get(CONFIG_SIZE_STEP),
+                      (app.config.get(CONFIG_MAX_WIDTH, 0), app.config.get(CONFIG_MAX_HEIGHT, 0)))
+
+
+def _stored_output_extension(name, extension, mode, size, output_extension=None):
+    """output_extension if that version is stored, else None if the one in the format of
+       the original is. raises Forbidden if neither is, for requests that may not create them.
+    """
+    if output_extension and storage().exists(name, extension, mode, size, output_extension):
+        return output_extension
+    if not storage().exists(name, extension, mode, size):
+        raise Forbidden('Only signed urls create manipulated images.')
+    return None
+
+
+def _canonical_redirect(name, extension, mode, size, signed=False):
+    """redirects to the url of size, it can be cached like the image. the url
+       of a signed request is signed too, with the same expiry.
+    """
+    query = None
+    if signed:
+        expires = int(request.args['expires']) if 'expires' in request.args else None
+        query = signing.signed_query(app.config[CONFIG_URL_SIGNING_KEY], name, extension, mode, size, expires)
+    response = redirect(_manipulated_url(name, extension, mode, size, query))
+    max_age = app.config.get(CONFIG_MANIPULATED_MAX_AGE)
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
+
+
+def _mime_type(extension):
+    return mimetypes.types_map['.%s' % extension.lower()]
+
+
+@metrics.timed('send')
 def _serve_image(image_file, extension):
-    mime_type = mimetypes.types_map['.%s' % extension.lower()]
-    return send_file(image_file, mimetype=mime_type, add_etags=False)
+    return send_file(image_file, mimetype=_mime_type(extension), add_etags=False)
+
+
+def _offload_image(image_path, extension):
+    """lets the web server send the file (and handle range requests).
+       nginx needs an internal location X_ACCEL_PREFIX aliased to the storage directory.
+    """
+    response = Response(mimetype=_mime_type(extension))
+    if app.config.get(CONFIG_SERVE_MODE) == 'x-accel-redirect':
+        relative_path = op.relpath(image_path, app.config[CONFIG_STORAGE_DIR]).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = '%s/%s' % (app.config.get(CONFIG_X_ACCEL_PREFIX, '/protected').rstrip('/'),
+                                                        quote(relative_path))
+    else:
+        response.headers['X-Sendfile'] = image_path
+    return response
+
+
+def _validators(stat):
+    """etag and last modified date of a stored image. files are only ever replaced
+       (never changed in place), so mtime and size identify a version.
+    """
+    return ('%x-%x' % (int(stat.st_mtime * 1000000), stat.st_size),
+            datetime.utcfromtimestamp(int(stat.st_mtime)))
+
+
+def _add_cache_headers(response, stat, max_age):
+    etag, last_modified = _validators(stat)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # replaces the defaults of send_file()
+    response.headers.pop('Expires', None)
+    response.headers.pop('Cache-Control', None)
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def _negotiated_extension(extension):
+    """returns the first of NEGOTIATED_FORMATS that the client explicitly accepts
+       (wildcards don't count) and pillow can write, None to keep the extension.
+    """
+    accepted = [mime_type for mime_type, quality in request.accept_mimetypes if quality > 0]
+    for output_extension in app.config.get(CONFIG_NEGOTIATED_FORMATS) or ():
+        if output_extension == extension.lower():
+            return None
+        if _mime_type(output_extension) in accepted and \
+                image.pil_format_from_file_extension('.' + output_extension):
+            return output_extension
+    return None
+
+
+def _serve_stored_image(max_age, name, extension, mode=None, size=None, output_extension=None):
+    """serves an image from the storage. conditional requests are answered with
+       a 304 based on stat() alone, without opening the image.
+    """
+    served_extension = output_extension or extension
+    offload = app.config.get(CONFIG_SERVE_MODE, 'python') != 'python'
+    stat = None
+    # stat() may be a round trip for remote storages, only do it when needed
+    if offload or request.if_none_match or request.if_modified_since:
+        try:
+            stat = storage().stat(name, extension, mode, size, output_extension)
+        except NotFound:
+            pass
+    if stat is not None:
+        etag, last_modified = _validators(stat)
+        if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+            return _add_cache_headers(Response(status=304), stat, max_age)
+    if offload:
+        if stat is None:
+            # creates the missing manipulated image
+            storage().get(name, extension, mode, size, output_extension).close()
+            stat = storage().stat(name, extension, mode, size, output_extension)
+        image_path = storage().path(name, extension, mode, size, output_extension)
+        # the web server may only send a range of it, we don't know
+        metrics.served(stat.st_size)
+        return _add_cache_headers(_offload_image(image_path, served_extension), stat, max_age)
+    image_file = storage().get(name, extension, mode, size, output_extension)
+    try:
+        # validators of exactly the file we serve, it might have been replaced since stat()
+        stat = os.fstat(image_file.fileno())
+    except io.UnsupportedOperation:
+        # created right now, from the memory cache or from a remote storage
+        stat = image_file.stat
+    response = _add_cache_headers(_serve_image(image_file, served_extension), stat, max_age)
+    response = response.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
+    metrics.served(response.content_length)
+    return response
 
 
 def _check_auth_token(origin, token):
@@ -65,6 +491,47 @@ def index():
     return Response('Nothing to see here ;)', 404)
 
 
+@app.route('/stats/cache')
+def cache_stats():
+    if not isinstance(storage(), CachingStorage):
+        raise NotFound()
+    return jsonify(storage().stats())
+
+
+@app.route('/stats/background')
+def background_stats():
+    # creates the resize executor
+    storage()
+    with _background_lock:
+        jobs = len(_background_jobs)
+    return jsonify(jobs=jobs, max_jobs=app.config.get(CONFIG_BACKGROUND_QUEUE_SIZE, 256),
+                   resize_pending=_resize_executor.pending)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics.prometheus_client:
+        raise NotFound()
+    data, content_type = metrics.render()
+    return Response(data, content_type=content_type)
+
+
+@app.route('/stats/tiers')
+def tier_stats():
+    tier_stats = getattr(storage(), 'tier_stats', None)
+    if tier_stats is None:
+        raise NotFound()
+    return jsonify(tier_stats())
+
+
+@app.route('/stats/index')
+def index_stats():
+    index_stats = getattr(storage(), 'index_stats', lambda: None)()
+    if index_stats is None:
+        raise NotFound()
+    return jsonify(index_stats)
+
+
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -85,6 +552,115 @@ def requires_auth(f):
     return decorated
 
 
+def _split_filename(filename):
+    parts = secure_filename(filename or '').rsplit('.', 1)
+    if len(parts) != 2 or not parts[0]:
+        raise BadRequest('The file name %s has no extension.' % filename)
+    return parts
+
+
+def _store_upload(filename, stream):
+    """stores an uploaded image under an unused name based on filename, returns name and extension"""
+    name, extension = _split_filename(filename)
+    upload = _checked_upload(stream)
+    name = storage().safe_name(name, extension)
+    try:
+        storage().save_stream(name, extension, upload)
+    except Exception:
+        # the empty placeholder would be served as an image
+        storage().release_name(name, extension)
+        raise
+    create_presets(name, extension)
+    return name, extension
+
+
+def _delete_image(filename):
+    storage().delete(*_split_filename(filename))
+
+
+def _spooled(stream):
+    """copies stream into a temp file (in memory while it's small), so it can be read later"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    shutil.copyfileobj(stream, spooled, CHUNK_SIZE)
+    spooled.seek(0)
+    return spooled
+
+
+def _tar_members(stream):
+    # a tar stream has to be read in order, members are spooled to be stored concurrently
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield op.basename(member.name), _spooled(archive.extractfile(member))
+    except tarfile.TarError:
+        raise BadRequest('The tar archive is corrupt.')
+
+
+def _zip_members(stream):
+    # the directory of a zip file is at its end, so the whole body is spooled first
+    try:
+        with _spooled(stream) as body, zipfile.ZipFile(body) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as member:
+                        yield op.basename(info.filename), _spooled(member)
+    except zipfile.BadZipFile:
+        raise BadRequest('The zip archive is corrupt.')
+
+
+def _batch_uploads():
+    """yields (filename, stream) of the images of a batch upload: the members of a tar or
+       zip body or the files of a multipart request
+    """
+    if request.mimetype in ('application/x-tar', 'application/x-gtar'):
+        return _tar_members(request.stream)
+    if request.mimetype in ('application/zip', 'application/x-zip-compressed'):
+        return _zip_members(request.stream)
+    return ((uploaded_file.filename, uploaded_file.stream) for uploaded_file in request.files.getlist('file'))
+
+
+def _run_batch(function, items):
+    """calls function(*arguments) for all (key, arguments) in items in the batch pool.
+       at most twice the pool size of items are read ahead, so a large batch never waits
+       in memory. returns (key, result or HTTPException) in the order of items. when reading
+       items fails (e.g. a corrupt archive) after some have been submitted, their results
+       are followed by (None, HTTPException) for the rest of the items.
+    """
+    pending = threading.BoundedSemaphore(2 * app.config.get(CONFIG_BATCH_WORKERS, 4))
+    futures = []
+    failure = None
+    try:
+        for key, arguments in items:
+            pending.acquire()
+            future = batch_executor().submit(function, *arguments)
+            future.add_done_callback(lambda _: pending.release())
+            futures.append((key, future))
+    except HTTPException as e:
+        if not futures:
+            raise
+        # the submitted items are stored anyway, the client gets to know about them
+        failure = e
+    results = []
+    for key, future in futures:
+        try:
+            results.append((key, future.result()))
+        except HTTPException as e:
+            results.append((key, e))
+        except Exception:
+            app.logger.exception('batch item %s failed', key)
+            results.append((key, InternalServerError()))
+    if failure is not None:
+        results.append((None, failure))
+    return results
+
+
+def _batch_result(key, code, **kwargs):
+    result = dict(file=key, status='ok' if code < 400 else 'fail', code=code)
+    result.update(kwargs)
+    return result
+
+
 def _upload_json_response(success, **kwargs):
     res_dict = dict(status='ok' if success else 'fail')
     res_dict.update(kwargs)
@@ -120,14 +696,43 @@ class UploadAPI(Resource):
     def post(self):
         args = self.reqparse.parse_args()
         uploaded_file = args['file']
-        filename, extension = secure_filename(uploaded_file.filename).rsplit(
-            '.', 1)
-        filename = storage().safe_name(filename, extension)
-        storage().save(filename, extension, uploaded_file.read())
+        filename, extension = _store_upload(uploaded_file.filename, uploaded_file.stream)
         url = api.url_for(ImageAPI, name=filename, extension=extension)
         return {'url': url}, 201
 
 
+class BatchAPI(Resource):
+    """
+    API that supports POST (upload) and DELETE of many images at once.
+    """
+    decorators = [requires_auth]
+
+    def post(self):
+        results = []
+        for filename, result in _run_batch(_store_upload, ((filename, (filename, stream))
+                                                           for filename, stream in _batch_uploads())):
+            if isinstance(result, HTTPException):
+                results.append(_batch_result(filename, result.code, message=result.description))
+            else:
+                name, extension = result
+                results.append(_batch_result(filename, 201, url=api.url_for(ImageAPI, name=name, extension=extension)))
+        if not results:
+            raise BadRequest('No file provided')
+        return {'results': results}, 200
+
+    def delete(self):
+        filenames = (request.get_json(silent=True) or {}).get('files')
+        if not isinstance(filenames, list) or not filenames:
+            raise BadRequest('Expected a json object with a list of files (<name>.<extension>).')
+        results = []
+        for filename, result in _run_batch(_delete_image, ((filename, (filename,)) for filename in filenames)):
+            if isinstance(result, HTTPException):
+                results.append(_batch_result(filename, result.code, message=result.description))
+            else:
+                results.append(_batch_result(filename, 200))
+        return {'results': results}, 200
+
+
 class ImageAPI(Resource):
     """
     API that supports GET, PUT and DELETE for images.
@@ -143,20 +748,21 @@ class ImageAPI(Resource):
     def put(self, name, extension):
         args = self.reqparse.parse_args()
         uploaded_file = args['file']
+        upload = _checked_upload(uploaded_file.stream)
         created = not storage().exists(name, extension)
-        storage().save(name, extension, uploaded_file.read())
+        storage().save_stream(name, extension, upload)
+        create_presets(name, extension)
         return Response('', 201 if created else 200)
 
     @requires_auth
-    def delete(self, project, name, extension):
-        if storage().exists(project, name, extension):
-            storage().delete(project, name, extension)
+    def delete(self, name, extension):
+        if storage().exists(name, extension):
+            storage().delete(name, extension)
             return Response('', 200)
         raise NotFound()
 
     def get(self, name, extension):
-        image = storage().get(name, extension)
-        return _serve_image(image, extension)
+        return _serve_stored_image(app.config.get(CONFIG_ORIGINAL_MAX_AGE), name, extension)
 
 
 class ManipulatedImageAPI(Resource):
@@ -165,13 +771,44 @@ class ManipulatedImageAPI(Resource):
     """
 
     def get(self, name, mode, width, height, extension):
+        output_extension = _negotiated_extension(extension)
         try:
-            image = storage().get(name, extension, mode, (int(width), int(height)))
+            requested_size = (int(width), int(height))
+            signing_key = app.config.get(CONFIG_URL_SIGNING_KEY)
+            signed = bool(signing_key) and _check_signature(name, extension, mode, requested_size)
+            size = _size_policy().canonical_size(requested_size)
+            if size is None:
+                raise NotFound()
+            # one url per manipulated image, e.g. for caches
+            if '%dx%d' % size != '%sx%s' % (width, height):
+                return _canonical_redirect(name, extension, mode, size, signed)
+            if signing_key and not signed:
+                output_extension = _stored_output_extension(name, extension, mode, size, output_extension)
+            # hits are served as usual, misses don't wait for an overloaded resize executor
+            if _overloaded() and not storage().exists(name, extension, mode, size, output_extension):
+                if mode not in ('crop', 'fit'):
+                    raise NotFound()
+                # raises NotFound for missing originals
+                storage().stat(name, extension)
+                enqueue_manipulated(name, extension, mode, size, output_extension)
+                response = _overload_response(name, extension, mode, size, output_extension)
+            else:
+                response = _serve_stored_image(app.config.get(CONFIG_MANIPULATED_MAX_AGE),
+                                               name, extension, mode, size, output_extension)
+        except image.ImageTooLarge as e:
+            # the original exists, only this size can't be created within the limits
+            response = Response(str(e), status=422, mimetype='text/plain')
+            # the limits may be raised, nobody may cache this
+            response.headers['Cache-Control'] = 'no-store'
+            return response
         except ValueError:
             raise NotFound()
-        return _serve_image(image, extension)
+        if app.config.get(CONFIG_NEGOTIATED_FORMATS):
+            response.vary.add('Accept')
+        return response
 
 
 api.add_resource(UploadAPI, '/images/')
+api.add_resource(BatchAPI, '/images/batch')
 api.add_resource(ImageAPI, '/images/<name>.<extension>')
 api.add_resource(ManipulatedImageAPI, '/images/<name>@<mode>-<width>x<height>.<extension>')
@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+from image_service import metrics
+from image_service.storage import ImageBuffer
+
+
+class DerivativeCache(object):
+    """in-memory LRU cache for encoded images. the cache is bounded by the
+       total number of cached bytes, not by the number of entries.
+       keys are (name, extension, mode, size, output_extension) tuples, values
+       (data, stat) with the stat of the stored image (for its validators).
+       entries can carry a validator of their original, see get().
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_by_image = {}
+        self._generations = {}
+        # when the storage has last been told about a read of a key, see touch_due()
+        self._touched = {}
+
+    def get(self, key, validator=None):
+        """(data, stat) of a cached image, None if it isn't cached. when the entry
+           has been put with another validator than the given one, its original has
+           been replaced and all versions of the image are invalidated.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] != validator:
+                self._invalidate(key[:2])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._move_to_end(key)
+            self.hits += 1
+            return entry[:2]
+
+    def generation(self, name, extension):
+        """changes whenever (name, extension) is invalidated. pass it to put()
+           to avoid caching data that has been read before an invalidation.
+        """
+        with self._lock:
+            return self._generations.get((name, extension), 0)
+
+    def touch_due(self, key, interval):
+        """true (and the key counts as touched now) if the storage hasn't been told about a
+           read of the cached key for interval seconds. put() counts as a read of the storage.
+        """
+        now = time.time()
+        with self._lock:
+            if key not in self._entries or now - self._touched.get(key, 0) < interval:
+                return False
+            self._touched[key] = now
+            return True
+
+    def put(self, key, data, stat, validator=None, generation=None):
+        if len(data) > self.max_bytes:
+            return
+        image_key = key[:2]
+        with self._lock:
+            if generation is not None and generation != self._generations.get(image_key, 0):
+                return
+            self._remove(key)
+            self._entries[key] = (data, stat, validator)
+            self._touched[key] = time.time()
+            self._keys_by_image.setdefault(image_key, set()).add(key)
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, name, extension, mode=None, size=None, output_extension=None):
+        """drops one cached version or, without mode and size, all versions of an image"""
+        image_key = (name, extension)
+        with self._lock:
+            if mode:
+                self._generations[image_key] = self._generations.get(image_key, 0) + 1
+                self._remove(image_key + (mode, tuple(size), output_extension))
+            else:
+                self._invalidate(image_key)
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        evictions=self.evictions,
+                        entries=len(self._entries),
+                        bytes=self.current_bytes,
+                        max_bytes=self.max_bytes)
+
+    def _invalidate(self, image_key):
+        self._generations[image_key] = self._generations.get(image_key, 0) + 1
+        for key in list(self._keys_by_image.get(image_key, ())):
+            self._remove(key)
+
+    def _move_to_end(self, key):
+        entry = self._entries.pop(key)
+        self._entries[key] = entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.current_bytes -= len(entry[0])
+        self._touched.pop(key, None)
+        keys = self._keys_by_image[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_image[key[:2]]
+
+
+def _validator(stat):
+    # replaced originals are new files, with a new mtime (and inode)
+    return stat.st_mtime, stat.st_size, getattr(stat, 'st_ino', None)
+
+
+class CachingStorage(object):
+    """keeps manipulated images of the wrapped storage in a DerivativeCache.
+       originals are always read from the wrapped storage.
+
+       every process has a cache of its own. so that the images of an original
+       replaced or deleted by another process aren't served from memory, hits
+       stat() the original (one stat() in the filesystem, a HEAD request on s3).
+    """
+
+    def __init__(self, storage, cache):
+        self._storage = storage
+        self.cache = cache
+        # versions the storage deletes on its own are not served from memory either
+        storage.on_evict = self._evicted
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+    def get(self, name, extension, mode=None, size=None, output_extension=None):
+        if not mode or not size:
+            return self._storage.get(name, extension, mode, size)
+        key = (name, extension, mode, tuple(size), output_extension)
+        # raises NotFound for originals deleted by other processes
+        validator = _validator(self._storage.stat(name, extension))
+        entry = self.cache.get(key, validator)
+        if entry is not None:
+            metrics.derivative_request(mode, 'memory_hit')
+            # storages evict the least recently read versions, this one is read
+            if self.cache.touch_due(key, self._storage.atime_resolution):
+                self._storage.touch(name, extension, mode, size, output_extension)
+            return ImageBuffer(*entry)
+        generation = self.cache.generation(name, extension)
+        with self._storage.get(name, extension, mode, size, output_extension) as image_file:
+            # freshly created images come as BytesIO, getvalue() doesn't copy those
+            if isinstance(image_file, BytesIO):
+                data, stat = image_file.getvalue(), image_file.stat
+            else:
+                data, stat = image_file.read(), os.fstat(image_file.fileno())
+        # an original replaced since stat() only makes the next hit a miss
+        self.cache.put(key, data, stat, validator, generation)
+        return ImageBuffer(data, stat)
+
+    def save(self, name, extension, binary_image_data, mode=None, size=None, output_extension=None):
+        stat = self._storage.save(name, extension, binary_image_data, mode, size, output_extension)
+        self.cache.invalidate(name, extension, mode, size, output_extension)
+        return stat
+
+    def save_stream(self, name, extension, stream):
+        self._storage.save_stream(name, extension, stream)
+        self.cache.invalidate(name, extension)
+
+    def delete(self, name, extension, mode=None, size=None, output_extension=None):
+        try:
+            self._storage.delete(name, extension, mode, size, output_extension)
+        finally:
+            self.cache.invalidate(name, extension, mode, size, output_extension)
+
+    def stats(self):
+        return self.cache.stats()
+
+    def _evicted(self, name, extension, mode, size, output_extension):
+        # also when it's evicted while it's created, before it's put into the cache
+        self.cache.invalidate(name, extension, mode, size, output_extension)
@@ -0,0 +1,97 @@
+import os
+import threading
+from concurrent import futures
+
+from werkzeug.exceptions import ServiceUnavailable, GatewayTimeout
+
+from image_service import metrics
+
+
+class ResizeQueueFull(ServiceUnavailable):
+    description = 'Too many images are being resized right now, try again later.'
+
+
+class ResizeTimeout(GatewayTimeout):
+    description = 'Resizing the image took too long.'
+
+
+class InlineExecutor(object):
+    """runs resize jobs in the calling thread, pending counts the threads doing so"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pending = 0
+
+    def run(self, fn, *args):
+        with self._lock:
+            self.pending += 1
+        metrics.resize_pending(1)
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+            metrics.resize_pending(-1)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class PoolExecutor(object):
+    """runs resize jobs in a thread or process pool.
+
+       at most max_pending jobs are queued or running at any time, further
+       jobs are rejected with ResizeQueueFull. run() waits at most timeout
+       seconds for the result and raises ResizeTimeout after that (the job
+       itself keeps its slot until it's done).
+    """
+
+    def __init__(self, pool, max_pending, timeout=None):
+        self._pool = pool
+        self._max_pending = max_pending
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self.pending = 0
+
+    def run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self._max_pending:
+                raise ResizeQueueFull()
+            self.pending += 1
+        metrics.resize_pending(1)
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._job_done(None)
+            raise
+        future.add_done_callback(self._job_done)
+        try:
+            return future.result(timeout=self._timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise ResizeTimeout()
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def _job_done(self, future):
+        with self._lock:
+            self.pending -= 1
+        metrics.resize_pending(-1)
+
+
+def create_executor(backend='inline', workers=None, max_pending=64, timeout=None, initializer=None, initargs=()):
+    """creates an executor for resize jobs. backend is one of inline, thread or process.
+       jobs for the process backend must be picklable (see image.manipulate_file),
+       initializer(*initargs) runs in every process of the pool.
+    """
+    if backend == 'inline':
+        return InlineExecutor()
+    workers = workers or os.cpu_count() or 1
+    if backend == 'thread':
+        pool = futures.ThreadPoolExecutor(max_workers=workers)
+    elif backend == 'process':
+        pool = futures.ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    else:
+        raise ValueError('unknown resize executor %s' % backend)
+    return PoolExecutor(pool, max_pending, timeout)
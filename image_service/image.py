@@ -1,16 +1,32 @@
+from __future__ import division
 import os
-import tempfile
+import math
 import mimetypes
+from io import BytesIO
 
-from PIL import Image, ImageOps
+from PIL import Image, ImageOps, features
+
+from image_service import metrics
+
+
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
 
 
-# for now we only support the two formats ;)
 def pil_format_from_mime_type(mime_type):
     if mime_type == 'image/jpeg':
         return 'JPEG'
     if mime_type == 'image/png':
         return 'PNG'
+    if mime_type == 'image/gif':
+        return 'GIF'
+    # webp and avif depend on how pillow has been built (or on plugins)
+    if mime_type == 'image/webp' and features.check('webp'):
+        return 'WEBP'
+    if mime_type == 'image/avif':
+        Image.init()
+        if 'AVIF' in Image.SAVE:
+            return 'AVIF'
     return None
 
 
@@ -19,22 +35,323 @@ def pil_format_from_file_extension(file_extension):
     return pil_format_from_mime_type(mime_type)
 
 
-def binary_image(pil_image, format):
-    binary = tempfile.TemporaryFile()
-    pil_image.save(binary, format)
+@metrics.timed('encode')
+def binary_image(pil_image, format, save_options=None):
+    """encodes pil_image into an in-memory buffer (positioned at the start)"""
+    binary = BytesIO()
+    pil_image.save(binary, format, **(save_options or {}))
     binary.seek(0)
     return binary
 
 
-def fit_image(image, size):
-    pil_image = Image.open(image)
-    pil_image.thumbnail(size, Image.ANTIALIAS)
-    pil_format = pil_format_from_file_extension(os.path.splitext(image.name)[1])
-    return binary_image(pil_image, pil_format)
+# images are only decoded when the decoded image (after the jpeg draft reduction)
+# fits into MAX_DECODED_BYTES and the image has at most MAX_PIXELS pixels, so a
+# single upload can't take down a worker. 0 disables a limit, see set_limits().
+MAX_DECODED_BYTES = 512 * 1024 * 1024
+MAX_PIXELS = 100 * 1000 * 1000
+# animations (gifs, webps) keep all their frames when resized into a format that can store them,
+# one full size frame is decoded at a time. animations with more frames or more pixels in all
+# frames are resized as stills (their first frame). 0 disables a limit, see set_limits().
+MAX_FRAMES = 1000
+MAX_ANIMATION_PIXELS = 200 * 1000 * 1000
+
+# bytes per pixel of the decoded image, pillow stores 3 channels in 4 bytes
+_BYTES_PER_PIXEL = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16B': 2, 'I;16L': 2, 'LA': 4, 'PA': 4}
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def set_limits(max_pixels, max_decoded_bytes, max_frames=MAX_FRAMES, max_animation_pixels=MAX_ANIMATION_PIXELS):
+    """sets the limits of this process (use it as initializer of process pools)"""
+    global MAX_PIXELS, MAX_DECODED_BYTES, MAX_FRAMES, MAX_ANIMATION_PIXELS
+    MAX_PIXELS = max_pixels
+    MAX_DECODED_BYTES = max_decoded_bytes
+    MAX_FRAMES = max_frames
+    MAX_ANIMATION_PIXELS = max_animation_pixels
+    # pillow only warns below twice its limit, we raise ImageTooLarge there
+    Image.MAX_IMAGE_PIXELS = max_pixels or None
+
+
+def decoded_bytes(pil_image):
+    """memory needed to decode pil_image, estimated from its header and draft"""
+    width, height = pil_image.size
+    return width * height * _BYTES_PER_PIXEL.get(pil_image.mode, 4)
+
+
+def _open(image, max_pixels=None):
+    """opens image, reading only its header"""
+    max_pixels = MAX_PIXELS if max_pixels is None else max_pixels
+    try:
+        pil_image = Image.open(image)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    width, height = pil_image.size
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLarge('%dx%d pixels are more than %d' % (width, height, max_pixels))
+    return pil_image
+
+
+def _check_decoded_bytes(pil_image, max_decoded_bytes=None):
+    max_decoded_bytes = MAX_DECODED_BYTES if max_decoded_bytes is None else max_decoded_bytes
+    if max_decoded_bytes and decoded_bytes(pil_image) > max_decoded_bytes:
+        raise ImageTooLarge('decoding %dx%d %s needs more than %d bytes' % (
+            pil_image.size[0], pil_image.size[1], pil_image.mode, max_decoded_bytes))
+
+
+def check_image(image, max_pixels=None, max_decoded_bytes=None):
+    """reads the header of image and raises ImageTooLarge if not even its smallest
+       possible decode (1/8 scale for jpegs, full size for others) is within the
+       limits, i.e. the image could never be resized. defaults to the limits of this process.
+    """
+    pil_image = _open(image, max_pixels)
+    pil_image.draft(pil_image.mode, (1, 1))
+    _check_decoded_bytes(pil_image, max_decoded_bytes)
+
+
+def identify(image):
+    """(width, height, pil format) from the header of image, None if it isn't an image"""
+    try:
+        with _open(image, 0) as pil_image:
+            return pil_image.size + (pil_image.format,)
+    except (IOError, ImageTooLarge):
+        return None
+
+
+# jpegs are decoded at a reduced scale that is still at least this factor
+# larger than the target size. the final (antialiased) resample is done on the
+# reduced image, so quality is very close to resampling the full image.
+DRAFT_REDUCING_GAP = 2.0
+
+
+def _scale_to(image_size, size, cover=False):
+    scales = (size[0] / image_size[0], size[1] / image_size[1])
+    return max(scales) if cover else min(scales)
+
+
+def _draft(pil_image, scale):
+    if pil_image.format != 'JPEG':
+        return
+    width, height = pil_image.size
+    scale = min(1.0, scale * DRAFT_REDUCING_GAP)
+    pil_image.draft(pil_image.mode, (int(math.ceil(width * scale)), int(math.ceil(height * scale))))
+
+
+def can_manipulate_from(image_size, mode, size):
+    """true if an image of image_size that shows the whole original (a fitted
+       version of it) is at least DRAFT_REDUCING_GAP times larger than needed
+       for mode and size. the result is then as good as when created from the
+       original, like with the jpeg draft.
+    """
+    return _scale_to(image_size, size, cover=mode == 'crop') * DRAFT_REDUCING_GAP <= 1
+
+
+def draft_image(pil_image, size, cover=False):
+    """configures the jpeg decoder to downscale (in the DCT) while decoding.
+       with cover=True the decoded image covers size in both dimensions
+       (needed for cropping), otherwise it only has to contain it.
+       other formats are left untouched.
+    """
+    _draft(pil_image, _scale_to(pil_image.size, size, cover))
+
+
+def _load(pil_image):
+    """decodes pil_image (at its draft scale) if it's within the limits"""
+    _check_decoded_bytes(pil_image)
+    with metrics.stage('decode'):
+        pil_image.load()
+
+
+def _round_aspect(number, key):
+    return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+
+def fitted_size(image_size, size):
+    """size of an image of image_size fitted into size. like pillow's thumbnail() it's
+       never enlarged and the rounded side keeps the aspect ratio as exactly as possible.
+    """
+    width, height = image_size
+    fitted_width, fitted_height = size
+    if fitted_width >= width and fitted_height >= height:
+        return tuple(image_size)
+    aspect = width / height
+    if fitted_width / fitted_height >= aspect:
+        fitted_width = _round_aspect(fitted_height * aspect, key=lambda n: abs(aspect - n / fitted_height))
+    else:
+        fitted_height = _round_aspect(fitted_width / aspect,
+                                      key=lambda n: 0 if n == 0 else abs(aspect - fitted_width / n))
+    return fitted_width, fitted_height
+
+
+def _fit(pil_image, size, reducing_gap=2.0, original_size=None):
+    """fits pil_image into size. the fitted size is the one of original_size (the image that
+       pil_image has been decoded at a draft scale or fitted from), so it doesn't depend on
+       the rounded size of pil_image.
+    """
+    fitted = fitted_size(original_size or pil_image.size, size)
+    if fitted == pil_image.size:
+        return pil_image
+    with metrics.stage('resample'):
+        return pil_image.resize(fitted, Image.ANTIALIAS, reducing_gap=reducing_gap)
+
+
+def _crop(pil_image, size):
+    with metrics.stage('resample'):
+        return ImageOps.fit(pil_image, size, Image.ANTIALIAS, 0.0, (0.5, 0.5))
+
+
+def _resamplable(pil_image):
+    """pil_image in a mode that pillow resamples with antialiasing (not only the nearest pixel)"""
+    if pil_image.mode in ('1', 'P'):
+        return pil_image.convert('RGBA' if 'transparency' in pil_image.info else 'RGB')
+    return pil_image
+
+
+def _pil_format(image, output_extension=None):
+    if output_extension:
+        pil_format = pil_format_from_file_extension('.' + output_extension)
+        if not pil_format:
+            raise ValueError('%s is not supported as output format' % output_extension)
+        return pil_format
+    return pil_format_from_file_extension(os.path.splitext(image.name)[1])
+
+
+def _animated(pil_image, pil_format):
+    """true if all frames of pil_image are manipulated: it's an animation within
+       MAX_FRAMES and MAX_ANIMATION_PIXELS and pil_format can store animations.
+    """
+    if not getattr(pil_image, 'is_animated', False):
+        return False
+    if pil_format != 'GIF' and not (pil_format == 'WEBP' and features.check('webp_anim')):
+        return False
+    width, height = pil_image.size
+    frames = pil_image.n_frames
+    return (not MAX_FRAMES or frames <= MAX_FRAMES) and \
+        (not MAX_ANIMATION_PIXELS or width * height * frames <= MAX_ANIMATION_PIXELS)
+
+
+def _manipulation(mode, size, original_size=None):
+    if mode == 'crop':
+        return lambda frame: _crop(frame, size)
+    return lambda frame: _fit(frame, size, original_size=original_size)
+
+
+def _manipulate_frames(pil_image, manipulations, pil_format, save_options=None):
+    """applies every manipulation (a function of a frame returning the manipulated frame) to all
+       frames of the animation pil_image and returns an animation for each of them. only one
+       full size frame is decoded at a time, the durations and disposal of the frames are kept.
+    """
+    frames = [[] for manipulation in manipulations]
+    durations, disposals = [], []
+    # gifs without a loop count play once, loop=0 would repeat them forever
+    loop = pil_image.info.get('loop')
+    for index in range(pil_image.n_frames):
+        pil_image.seek(index)
+        _load(pil_image)
+        # later frames are decoded on top of pil_image, so only a copy is resampled
+        frame = pil_image.convert('RGBA')
+        for manipulated_frames, manipulation in zip(frames, manipulations):
+            manipulated_frames.append(manipulation(frame.copy() if len(manipulations) > 1 else frame))
+        durations.append(pil_image.info.get('duration', 0))
+        # the frames of other formats are whole images, that replace the previous one
+        disposals.append(getattr(pil_image, 'disposal_method', 2))
+    options = dict(save_options or {}, save_all=True, duration=durations)
+    if loop is not None:
+        options['loop'] = loop
+    if pil_format == 'GIF':
+        options['disposal'] = disposals
+    return [binary_image(manipulated_frames[0], pil_format, dict(options, append_images=manipulated_frames[1:]))
+            for manipulated_frames in frames]
+
+
+def fit_image(image, size, draft=True, output_extension=None, save_options=None, original_size=None):
+    """original_size is the size of the original when image is a fitted version of it"""
+    pil_format = _pil_format(image, output_extension)
+    pil_image = _open(image)
+    original_size = original_size or pil_image.size
+    with metrics.resize(pil_image.size):
+        if _animated(pil_image, pil_format):
+            return _manipulate_frames(pil_image, [_manipulation('fit', size, original_size)], pil_format,
+                                      save_options)[0]
+        if draft:
+            draft_image(pil_image, size)
+            _load(pil_image)
+            fitted_pil_image = _fit(_resamplable(pil_image), size, original_size=original_size)
+        else:
+            _load(pil_image)
+            fitted_pil_image = _fit(_resamplable(pil_image), size, reducing_gap=None, original_size=original_size)
+        return binary_image(fitted_pil_image, pil_format, save_options)
+
+
+def crop_image(image, size, draft=True, output_extension=None, save_options=None):
+    pil_format = _pil_format(image, output_extension)
+    pil_image = _open(image)
+    with metrics.resize(pil_image.size):
+        if _animated(pil_image, pil_format):
+            return _manipulate_frames(pil_image, [_manipulation('crop', size)], pil_format, save_options)[0]
+        if draft:
+            draft_image(pil_image, size, cover=True)
+        _load(pil_image)
+        return binary_image(_crop(_resamplable(pil_image), size), pil_format, save_options)
+
+
+def manipulated_images(image, specs, save_options=None, output_extension=None):
+    """decodes image only once and yields (mode, size, binary_image) for
+       every (mode, size) in specs.
+    """
+    pil_format = _pil_format(image, output_extension)
+    pil_image = _open(image)
+    original_size = pil_image.size
+    if _animated(pil_image, pil_format):
+        binaries = _manipulate_frames(pil_image, [_manipulation(mode, size) for mode, size in specs],
+                                      pil_format, save_options)
+        for (mode, size), binary in zip(specs, binaries):
+            yield mode, size, binary
+        return
+    _draft(pil_image, max(_scale_to(pil_image.size, size, mode == 'crop') for mode, size in specs))
+    _load(pil_image)
+    pil_image = _resamplable(pil_image)
+    for mode, size in specs:
+        if mode == 'crop':
+            manipulated_pil_image = _crop(pil_image, size)
+        else:
+            manipulated_pil_image = _fit(pil_image, size, original_size=original_size)
+        yield mode, size, binary_image(manipulated_pil_image, pil_format, save_options)
+
+
+def _manipulate(image, mode, size, output_extension, save_options, original_size=None):
+    if mode == 'crop':
+        return crop_image(image, size, output_extension=output_extension, save_options=save_options)
+    return fit_image(image, size, output_extension=output_extension, save_options=save_options,
+                     original_size=original_size)
+
+
+def _read(path):
+    """reads the (compressed) image, so decoding it is timed without the i/o"""
+    with metrics.stage('read'):
+        with open(path, 'rb') as image:
+            return image.read()
+
+
+def manipulate_file(path, mode, size, output_extension=None, save_options=None):
+    """crops or fits the image at path. takes and returns only picklable
+       values, so it can run in a process pool.
+    """
+    return manipulate_bytes(_read(path), mode, size, output_extension or os.path.splitext(path)[1][1:],
+                            save_options)
+
+
+def manipulate_file_many(path, specs, save_options=None):
+    """like manipulate_file but for many (mode, size) specs, see manipulated_images()"""
+    return manipulate_bytes_many(_read(path), specs, os.path.splitext(path)[1][1:], save_options)
+
+
+def manipulate_bytes(binary_image_data, mode, size, output_extension, save_options=None, original_size=None):
+    """like manipulate_file, for images that aren't in the local filesystem. see fit_image() for original_size."""
+    return _manipulate(BytesIO(binary_image_data), mode, size, output_extension, save_options, original_size)
 
 
-def crop_image(image, size):
-    pil_image = Image.open(image)
-    cropped_pil_image = ImageOps.fit(pil_image, size, Image.ANTIALIAS, 0.0, (0.5, 0.5))
-    pil_format = pil_format_from_file_extension(os.path.splitext(image.name)[1])
-    return binary_image(cropped_pil_image, pil_format)
+def manipulate_bytes_many(binary_image_data, specs, output_extension, save_options=None):
+    """like manipulate_file_many, for images that aren't in the local filesystem"""
+    return list(manipulated_images(BytesIO(binary_image_data), specs, save_options, output_extension))
@@ -0,0 +1,137 @@
+"""sqlite index of the images of a FileSystemStorage (see its indexed argument):
+the originals with their dimensions, format, size and content hash, and the
+manipulated versions of each of them. it's kept in image_dir/.index.sqlite in
+wal mode, so the processes of a host can share it. rebuild it from the files
+when it's created for an existing storage directory or got out of sync:
+
+    python -m image_service.reindex STORAGE_DIRECTORY
+"""
+import sqlite3
+import threading
+from collections import namedtuple
+
+IndexStat = namedtuple('IndexStat', ['st_size', 'st_mtime'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS originals (
+    name TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    content_hash TEXT,
+    PRIMARY KEY (name, extension)
+);
+CREATE TABLE IF NOT EXISTS manipulated (
+    name TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    output_extension TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (name, extension, mode, width, height, output_extension)
+);
+"""
+
+
+class MetadataIndex(object):
+    """the index in the sqlite database at path, with a connection per thread"""
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # a crash may lose the last transactions but never corrupts the index, rebuild() repairs it
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def put_original(self, name, extension, stat, identity=None, content_hash=None):
+        """identity is (width, height, format) of image.identify()"""
+        width, height, image_format = identity or (None, None, None)
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO originals VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (name, extension, width, height, image_format, stat.st_size, stat.st_mtime,
+                                content_hash))
+
+    def put_manipulated(self, name, extension, mode, size, output_extension, stat):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO manipulated VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (name, extension, mode, size[0], size[1], output_extension or extension,
+                                stat.st_size, stat.st_mtime))
+
+    def stat(self, name, extension, mode=None, size=None, output_extension=None):
+        """IndexStat of an image, None if it isn't indexed"""
+        if mode:
+            row = self._connection().execute(
+                'SELECT size, mtime FROM manipulated WHERE name = ? AND extension = ? AND mode = ? AND width = ? '
+                'AND height = ? AND output_extension = ?',
+                (name, extension, mode, size[0], size[1], output_extension or extension)).fetchone()
+        else:
+            row = self._connection().execute('SELECT size, mtime FROM originals WHERE name = ? AND extension = ?',
+                                             (name, extension)).fetchone()
+        return IndexStat(*row) if row else None
+
+    def original(self, name, extension):
+        """dict of the indexed metadata of an original, None if it isn't indexed"""
+        cursor = self._connection().execute('SELECT * FROM originals WHERE name = ? AND extension = ?',
+                                            (name, extension))
+        row = cursor.fetchone()
+        return dict(zip([column[0] for column in cursor.description], row)) if row else None
+
+    def manipulated(self, name, extension):
+        """list of (mode, size, output_extension) of the manipulated versions of an image"""
+        rows = self._connection().execute(
+            'SELECT mode, width, height, output_extension FROM manipulated WHERE name = ? AND extension = ?',
+            (name, extension))
+        return [(mode, (width, height), output_extension) for mode, width, height, output_extension in rows]
+
+    def delete(self, name, extension, mode=None, size=None, output_extension=None):
+        """deletes an image, an original together with its manipulated versions"""
+        with self._connection() as connection:
+            if mode:
+                connection.execute(
+                    'DELETE FROM manipulated WHERE name = ? AND extension = ? AND mode = ? AND width = ? '
+                    'AND height = ? AND output_extension = ?',
+                    (name, extension, mode, size[0], size[1], output_extension or extension))
+                return
+            connection.execute('DELETE FROM originals WHERE name = ? AND extension = ?', (name, extension))
+            connection.execute('DELETE FROM manipulated WHERE name = ? AND extension = ?', (name, extension))
+
+    def delete_manipulated(self, name, extension):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM manipulated WHERE name = ? AND extension = ?', (name, extension))
+
+    def replace(self, originals, manipulated):
+        """replaces the whole index in one transaction. originals are tuples of the
+           put_original() arguments, manipulated of the put_manipulated() ones.
+        """
+        with self._connection() as connection:
+            connection.execute('DELETE FROM originals')
+            connection.execute('DELETE FROM manipulated')
+            connection.executemany('INSERT OR REPLACE INTO originals VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+                (name, extension) + tuple(identity or (None, None, None)) + (stat.st_size, stat.st_mtime,
+                                                                              content_hash)
+                for name, extension, stat, identity, content_hash in originals])
+            connection.executemany('INSERT OR REPLACE INTO manipulated VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+                (name, extension, mode, size[0], size[1], output_extension or extension, stat.st_size, stat.st_mtime)
+                for name, extension, mode, size, output_extension, stat in manipulated])
+
+    def stats(self):
+        """number and bytes of the indexed originals and manipulated images"""
+        connection = self._connection()
+        originals, original_bytes = connection.execute('SELECT COUNT(*), TOTAL(size) FROM originals').fetchone()
+        manipulated, manipulated_bytes = connection.execute('SELECT COUNT(*), TOTAL(size) FROM manipulated').fetchone()
+        return dict(originals=originals, original_bytes=int(original_bytes),
+                    manipulated=manipulated, manipulated_bytes=int(manipulated_bytes))
+
@@ -0,0 +1,120 @@
+"""prometheus metrics of the service, everything is a no-op without prometheus_client.
+
+   with several processes (uwsgi workers, the process resize executor) point
+   PROMETHEUS_MULTIPROC_DIR to an empty directory before they start, /metrics
+   then adds up the metrics of all processes.
+"""
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # only needed for /metrics
+    prometheus_client = None
+
+
+# upper bounds of the megapixel buckets of the originals
+MEGAPIXEL_BUCKETS = (1, 4, 16, 64)
+
+if prometheus_client:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'image_service_stage_seconds', 'Time spent in a stage of serving or resizing an image.', ['stage'],
+        buckets=(.0001, .0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+    RESIZE_SECONDS = prometheus_client.Histogram(
+        'image_service_resize_seconds', 'Time to create a manipulated image, by megapixels of the original.',
+        ['megapixels'], buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+    DERIVATIVE_REQUESTS = prometheus_client.Counter(
+        'image_service_derivative_requests_total', 'Requested manipulated images by mode and whether they '
+        'had to be created (miss), were stored (hit) or in the memory cache (memory_hit).', ['mode', 'result'])
+    SERVED_BYTES = prometheus_client.Counter('image_service_served_bytes_total', 'Bytes of images served.')
+    RESIZE_PENDING = prometheus_client.Gauge('image_service_resize_pending', 'Queued or running resize jobs.',
+                                             multiprocess_mode='livesum')
+    OVERLOAD_RESPONSES = prometheus_client.Counter(
+        'image_service_overload_responses_total', 'Missing manipulated images that were created in the '
+        'background because of overload, by response (accepted: 202, nearest: a larger image, rejected: '
+        '503 because the background queue is full).', ['response'])
+    BACKGROUND_PENDING = prometheus_client.Gauge(
+        'image_service_background_pending', 'Missing manipulated images waiting to be created or being created '
+        'in the background because of overload.', multiprocess_mode='livesum')
+
+
+def observe(stage_name, seconds):
+    if prometheus_client:
+        STAGE_SECONDS.labels(stage_name).observe(seconds)
+
+
+@contextmanager
+def stage(name):
+    """times the block as stage name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """decorator, times every call of the function as stage name"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def megapixel_bucket(size):
+    megapixels = size[0] * size[1] / 1000000.0
+    lower = 0
+    for upper in MEGAPIXEL_BUCKETS:
+        if megapixels < upper:
+            return '%d-%d' % (lower, upper)
+        lower = upper
+    return '%d+' % lower
+
+
+@contextmanager
+def resize(original_size):
+    """times the block as creating a manipulated image of an original of original_size"""
+    start = time.perf_counter()
+    yield
+    if prometheus_client:
+        RESIZE_SECONDS.labels(megapixel_bucket(original_size)).observe(time.perf_counter() - start)
+
+
+def derivative_request(mode, result):
+    if prometheus_client:
+        DERIVATIVE_REQUESTS.labels(mode, result).inc()
+
+
+def resize_pending(delta):
+    if prometheus_client:
+        RESIZE_PENDING.inc(delta)
+
+
+def background_pending(delta):
+    if prometheus_client:
+        BACKGROUND_PENDING.inc(delta)
+
+
+def overload_response(response):
+    if prometheus_client:
+        OVERLOAD_RESPONSES.labels(response).inc()
+
+
+def served(num_bytes):
+    if prometheus_client and num_bytes:
+        SERVED_BYTES.inc(num_bytes)
+
+
+def render():
+    """returns the metrics in the prometheus text format and its content type"""
+    registry = prometheus_client.REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,110 @@
+"""moves the images of a storage directory to the flat or the sharded layout (see
+FileSystemStorage). works for content addressed storages and the directory of a
+TieredStorage too. stop the service while it runs, an interrupted migration can
+simply be run again.
+
+    python -m image_service.migrate STORAGE_DIRECTORY --sharded|--flat [--dry-run]
+"""
+import argparse
+import os
+import os.path as op
+import re
+import sys
+
+from werkzeug.utils import secure_filename
+
+from image_service.storage import FileSystemStorage
+
+SHARD = re.compile(r'^[0-9a-f]{2}$')
+# directories of their own, with entries of the same layout
+SPECIAL_DIRECTORIES = ('.blobs', '.names', '.refs')
+
+
+def _entries(directory):
+    """(directory, name) of all entries of directory and its shard directories"""
+    for entry in os.scandir(directory):
+        if SHARD.match(entry.name) and entry.is_dir(follow_symlinks=False):
+            for shard_entry in _entries(entry.path):
+                yield shard_entry
+        else:
+            yield directory, entry.name
+
+
+def _shard_key(name):
+    # manipulated images are next to their original
+    return secure_filename(name[1:]) if name.startswith('_') else name
+
+
+def _move(storage, directory, dry_run):
+    moves = []
+    for parent, name in list(_entries(directory)):
+        path = op.join(parent, name)
+        if name.startswith('.') or name.endswith('.lock'):
+            # stale lock and temp files, the special directories are moved on their own
+            if name.endswith(('.lock', '.tmp')) and not dry_run:
+                os.remove(path)
+            continue
+        target_dir = storage._shard_directory(directory, _shard_key(name))
+        if target_dir == parent:
+            continue
+        moves.append((path, op.join(target_dir, name)))
+        if not dry_run:
+            os.makedirs(target_dir, exist_ok=True)
+            os.rename(path, op.join(target_dir, name))
+    return moves
+
+
+def _relink(storage, image_dir):
+    """points the names of a content addressed storage to the new blob paths"""
+    blobs_dir = op.join(image_dir, '.blobs')
+    for parent, name in list(_entries(image_dir)):
+        path = op.join(parent, name)
+        if not op.islink(path):
+            continue
+        blob = op.basename(os.readlink(path))
+        target = op.relpath(op.join(storage._shard_directory(blobs_dir, blob), blob), parent)
+        if os.readlink(path) != target:
+            tmp_path = op.join(parent, '.%s.tmp' % name)
+            os.symlink(target, tmp_path)
+            os.rename(tmp_path, path)
+
+
+def _remove_empty_shards(directory):
+    for parent, _, _ in os.walk(directory, topdown=False):
+        if parent != directory and SHARD.match(op.basename(parent)) and not os.listdir(parent):
+            os.rmdir(parent)
+
+
+def migrate(image_dir, sharded, dry_run=False):
+    """moves all entries of image_dir (and of its .blobs, .names and .refs) to the
+       given layout, returns the list of (old path, new path)
+    """
+    storage = FileSystemStorage(image_dir, sharded=sharded)
+    directories = [image_dir] + [op.join(image_dir, name) for name in SPECIAL_DIRECTORIES
+                                 if op.isdir(op.join(image_dir, name))]
+    moves = []
+    for directory in directories:
+        moves.extend(_move(storage, directory, dry_run))
+    if not dry_run:
+        _relink(storage, image_dir)
+        for directory in directories:
+            _remove_empty_shards(directory)
+    return moves
+
+
+def main():
+    parser = argparse.ArgumentParser(description='moves the images of a storage directory to another layout')
+    parser.add_argument('storage_directory')
+    layout = parser.add_mutually_exclusive_group(required=True)
+    layout.add_argument('--sharded', dest='sharded', action='store_true')
+    layout.add_argument('--flat', dest='sharded', action='store_false')
+    parser.add_argument('--dry-run', action='store_true', help='only print the moves')
+    args = parser.parse_args()
+    if not op.isdir(args.storage_directory):
+        sys.exit('%s is not a directory' % args.storage_directory)
+    for old_path, new_path in migrate(args.storage_directory, args.sharded, args.dry_run):
+        print('%s -> %s' % (old_path, new_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""bounds the manipulated images that requests can create, so crawlers and attackers
+can't make the service resize and store every possible size of an image.
+"""
+import math
+
+
+class SizePolicy(object):
+    """maps a requested size to the canonical size it's created in, None if it
+       isn't allowed. with allowed_sizes only those are created, other sizes are
+       snapped to the smallest allowed one that contains them (or the largest one).
+       otherwise sizes are rounded up to multiples of step. sizes larger than
+       max_size (width, height, 0 for no limit) aren't allowed at all.
+    """
+
+    def __init__(self, allowed_sizes=None, step=None, max_size=None):
+        # smallest first
+        self._allowed_sizes = sorted(allowed_sizes or (), key=lambda size: (size[0] * size[1], size))
+        self._step = step
+        self._max_width, self._max_height = max_size or (0, 0)
+
+    def canonical_size(self, size):
+        width, height = size
+        if width < 1 or height < 1:
+            return None
+        if (self._max_width and width > self._max_width) or (self._max_height and height > self._max_height):
+            return None
+        if self._allowed_sizes:
+            for allowed_size in self._allowed_sizes:
+                if allowed_size[0] >= width and allowed_size[1] >= height:
+                    return allowed_size
+            return self._allowed_sizes[-1]
+        if self._step:
+            width, height = (int(math.ceil(float(dimension) / self._step)) * self._step for dimension in size)
+            # rounding up may go beyond the limit, the limit itself is fine
+            width = min(width, self._max_width or width)
+            height = min(height, self._max_height or height)
+        return width, height
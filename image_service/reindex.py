@@ -0,0 +1,26 @@
+"""rebuilds the metadata index (see index.py) of a storage directory from its
+files, for either layout. stop the service while it runs.
+
+    python -m image_service.reindex STORAGE_DIRECTORY
+"""
+import argparse
+import json
+import os.path as op
+import sys
+
+from image_service.storage import FileSystemStorage
+
+
+def main():
+    parser = argparse.ArgumentParser(description='rebuilds the metadata index of a storage directory')
+    parser.add_argument('storage_directory')
+    args = parser.parse_args()
+    if not op.isdir(args.storage_directory):
+        sys.exit('%s is not a directory' % args.storage_directory)
+    storage = FileSystemStorage(args.storage_directory, indexed=True)
+    storage.rebuild_index()
+    print(json.dumps(storage.index_stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+import mimetypes
+from collections import namedtuple
+from io import BytesIO
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:  # only needed for STORAGE_BACKEND = 's3'
+    boto3 = None
+
+from werkzeug.exceptions import NotFound
+from werkzeug.utils import secure_filename
+
+from image_service import image, metrics
+from image_service.executor import InlineExecutor
+from image_service.storage import Storage, ImageBuffer, SingleFlight, parse_manipulated_filename
+
+
+ImageStat = namedtuple('ImageStat', 'st_size st_mtime')
+
+# dimensions() reads this many bytes from the start of an original
+HEADER_BYTES = 64 * 1024
+
+
+class S3Image(ImageBuffer):
+    """an image downloaded from s3, stat has its size and modification time"""
+
+
+def _not_found(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def _content_type(extension):
+    return mimetypes.types_map.get('.%s' % extension.lower(), 'application/octet-stream')
+
+
+class S3Storage(Storage):
+    """stores images in an s3 compatible object store, with the same layout as
+       FileSystemStorage: <prefix><name>.<extension> for originals and
+       <prefix>_<name>.<extension>/<mode>-<width>x<height>.<extension> for
+       manipulated images.
+
+       the boto3 client (and its connection pool) is shared by all threads.
+       get() needs a single GET for existing images, originals larger than
+       multipart_threshold are uploaded in parts.
+    """
+
+    def __init__(self, bucket, prefix='', executor=None, format_options=None, endpoint_url=None,
+                 region_name=None, max_pool_connections=10, multipart_threshold=8 * 1024 * 1024, client=None):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError('the s3 storage needs boto3 (pip install boto3)')
+            client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region_name,
+                                  config=Config(max_pool_connections=max_pool_connections))
+        self._client = client
+        self._bucket = bucket
+        self._prefix = prefix
+        self._executor = executor or InlineExecutor()
+        self._format_options = format_options or {}
+        self._transfer_config = TransferConfig(multipart_threshold=multipart_threshold)
+        # s3 has no locks, concurrent requests of other processes may both create an image
+        self._single_flight = SingleFlight(file_locks=False)
+
+    def exists(self, name, extension, mode=None, size=None, output_extension=None):
+        try:
+            self.stat(name, extension, mode, size, output_extension)
+            return True
+        except NotFound:
+            return False
+
+    def stat(self, name, extension, mode=None, size=None, output_extension=None):
+        self._check_mode_size(mode, size)
+        try:
+            head = self._client.head_object(Bucket=self._bucket,
+                                            Key=self._key(name, extension, mode, size, output_extension))
+        except ClientError as e:
+            if _not_found(e):
+                raise NotFound()
+            raise
+        return ImageStat(head['ContentLength'], head['LastModified'].timestamp())
+
+    @metrics.timed('save')
+    def save(self, name, extension, binary_image_data, mode=None, size=None, output_extension=None):
+        self._check_mode_size(mode, size)
+        key = self._key(name, extension, mode, size, output_extension)
+        if mode:
+            self._client.put_object(Bucket=self._bucket, Key=key, Body=bytes(binary_image_data),
+                                    ContentType=_content_type(output_extension or extension))
+            return
+        self._upload_original(name, extension, BytesIO(binary_image_data))
+
+    @metrics.timed('save')
+    def save_stream(self, name, extension, stream):
+        self._upload_original(name, extension, stream)
+
+    def get(self, name, extension, mode=None, size=None, output_extension=None):
+        self._check_mode_size(mode, size)
+        key = self._key(name, extension, mode, size, output_extension)
+        try:
+            image_file = self._download(key)
+        except NotFound:
+            if not mode:
+                raise
+        else:
+            if mode:
+                metrics.derivative_request(mode, 'hit')
+            return image_file
+        with self._single_flight(key):
+            try:
+                return self._download(key)
+            except NotFound:
+                return self._create_manipulated(name, extension, mode, size, output_extension)
+
+    def create_manipulated(self, name, extension, specs):
+        for mode, size in specs:
+            self._check_mode_size(mode, size)
+        missing = [(mode, size) for mode, size in specs if not self.exists(name, extension, mode, size)]
+        if not missing:
+            return
+        original = self._original(name, extension)
+        manipulated_images = self._executor.run(image.manipulate_bytes_many, original, missing, extension,
+                                                self._format_options.get(extension.lower()))
+        for mode, size, manipulated_image in manipulated_images:
+            self.save(name, extension, manipulated_image.getvalue(), mode, size)
+
+    def dimensions(self, name, extension):
+        """only gets the first HEADER_BYTES of the original"""
+        try:
+            response = self._client.get_object(Bucket=self._bucket, Key=self._key(name, extension),
+                                               Range='bytes=0-%d' % (HEADER_BYTES - 1))
+        except ClientError as e:
+            if _not_found(e):
+                raise NotFound()
+            raise
+        with response['Body'] as body:
+            identity = image.identify(BytesIO(body.read()))
+        return identity[:2] if identity else None
+
+    def delete(self, name, extension, mode=None, size=None, output_extension=None):
+        # s3 doesn't complain about deleting missing keys
+        self.stat(name, extension, mode, size, output_extension)
+        self._client.delete_object(Bucket=self._bucket, Key=self._key(name, extension, mode, size, output_extension))
+        if mode is None and size is None:
+            self._delete_manipulated(name, extension)
+
+    def safe_name(self, name, extension):
+        """reserves the name with a placeholder that is only written if the key doesn't
+           exist yet (conditional put), the next suffix is kept in .names/<name>.<extension>
+        """
+        counter_key = '%s.names/%s' % (self._prefix, secure_filename('%s.%s' % (name, extension)))
+        try:
+            counter = int(self._download(counter_key).getvalue())
+        except (NotFound, ValueError):
+            counter = 0
+        safe_name = name if counter == 0 else '%s-%d' % (name, counter)
+        while not self._reserve(safe_name, extension):
+            counter += 1
+            safe_name = '%s-%d' % (name, counter)
+        self._client.put_object(Bucket=self._bucket, Key=counter_key, Body=str(counter + 1).encode())
+        return safe_name
+
+    def release_name(self, name, extension):
+        try:
+            placeholder = self.stat(name, extension)
+        except NotFound:
+            return
+        if not placeholder.st_size:
+            self._client.delete_object(Bucket=self._bucket, Key=self._key(name, extension))
+
+    def manipulated(self, name, extension):
+        prefix = self._manipulated_prefix(name, extension)
+        specs = []
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket, Prefix=prefix):
+            for item in page.get('Contents', ()):
+                spec = parse_manipulated_filename(item['Key'][len(prefix):])
+                if spec:
+                    specs.append(spec)
+        return specs
+
+    def _reserve(self, name, extension):
+        try:
+            self._client.put_object(Bucket=self._bucket, Key=self._key(name, extension), Body=b'', IfNoneMatch='*')
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', '412'):
+                return False
+            raise
+
+    def _upload_original(self, name, extension, stream):
+        self._client.upload_fileobj(stream, self._bucket, self._key(name, extension),
+                                    ExtraArgs={'ContentType': _content_type(extension)},
+                                    Config=self._transfer_config)
+        # a new original invalidates all manipulated versions of it
+        self._delete_manipulated(name, extension)
+
+    def _download(self, key):
+        try:
+            response = self._client.get_object(Bucket=self._bucket, Key=key)
+        except ClientError as e:
+            if _not_found(e):
+                raise NotFound()
+            raise
+        with response['Body'] as body:
+            binary_image_data = body.read()
+        return S3Image(binary_image_data, ImageStat(len(binary_image_data), response['LastModified'].timestamp()))
+
+    def _original(self, name, extension):
+        with metrics.stage('read'):
+            return self._download(self._key(name, extension)).getvalue()
+
+    def _create_manipulated(self, name, extension, mode, size, output_extension=None):
+        metrics.derivative_request(mode, 'miss')
+        output_extension = output_extension or extension
+        original = self._original(name, extension)
+        manipulated_image = self._executor.run(image.manipulate_bytes, original, mode, size, output_extension,
+                                               self._format_options.get(output_extension.lower()))
+        binary_image_data = manipulated_image.getvalue()
+        self.save(name, extension, binary_image_data, mode, size, output_extension)
+        return S3Image(binary_image_data, self.stat(name, extension, mode, size, output_extension))
+
+    def _delete_manipulated(self, name, extension):
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket, Prefix=self._manipulated_prefix(name, extension)):
+            keys = [{'Key': item['Key']} for item in page.get('Contents', ())]
+            if keys:
+                self._client.delete_objects(Bucket=self._bucket, Delete={'Objects': keys, 'Quiet': True})
+
+    def _manipulated_prefix(self, name, extension):
+        return '%s_%s/' % (self._prefix, secure_filename('%s.%s' % (name, extension)))
+
+    def _key(self, name, extension, mode=None, size=None, output_extension=None):
+        if mode:
+            return self._manipulated_prefix(name, extension) + secure_filename(
+                '%s-%dx%d.%s' % (mode, size[0], size[1], output_extension or extension))
+        return self._prefix + secure_filename('%s.%s' % (name, extension))
+
@@ -0,0 +1,42 @@
+"""signed urls of manipulated images. with URL_SIGNING_KEY only the urls signed
+with it create manipulated images, e.g. the ones a frontend generated:
+
+    /images/<name>@<mode>-<width>x<height>.<extension>?sig=<signature>[&expires=<unix time>]
+
+the signature is the urlsafe base64 (without padding) of the hmac-sha256 of
+"<name>@<mode>-<width>x<height>.<extension>", followed by "|<expires>" for urls that expire.
+"""
+import base64
+import hashlib
+import hmac
+import time
+from urllib.parse import urlencode
+
+
+def _message(name, extension, mode, size, expires=None):
+    message = '%s@%s-%dx%d.%s' % (name, mode, size[0], size[1], extension)
+    if expires is not None:
+        message += '|%d' % expires
+    return message.encode('utf-8')
+
+
+def signature(key, name, extension, mode, size, expires=None):
+    digest = hmac.new(key.encode('utf-8'), _message(name, extension, mode, size, expires), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def signed_query(key, name, extension, mode, size, expires=None):
+    """query string of a signed url"""
+    query = [('sig', signature(key, name, extension, mode, size, expires))]
+    if expires is not None:
+        query.append(('expires', expires))
+    return urlencode(query)
+
+
+def check_signature(key, signed, name, extension, mode, size, expires=None):
+    """true if signed is the signature of the url and it hasn't expired, compared in constant time"""
+    if expires is not None and expires < time.time():
+        return False
+    expected = signature(key, name, extension, mode, size, expires)
+    # compare_digest needs ascii for str, anything else is wrong anyway
+    return hmac.compare_digest(expected.encode('ascii'), signed.encode('utf-8'))
@@ -1,19 +1,241 @@
 import os
 import os.path as op
+import re
+import errno
+import hashlib
 import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+try:
+    import fcntl
+except ImportError:  # not available on windows, we only lock within the process there
+    fcntl = None
 
 from flask import safe_join
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import NotFound
 
-from image_service import image
+from image_service import image, metrics
+from image_service.executor import InlineExecutor
+from image_service.index import MetadataIndex
 
 
-class FileSystemStorage(object):
-    def __init__(self, image_dir):
-        self._image_dir = image_dir
-        if not op.isdir(self._image_dir):
-            os.makedirs(self._image_dir)
+def _create_on_enoent(create, path):
+    """calls create(path), creating the directory of path if it doesn't exist yet.
+       reads never create directories, writes only check for them when they fail.
+    """
+    try:
+        return create(path)
+    except FileNotFoundError:
+        # concurrent writes may create it at the same time
+        os.makedirs(op.dirname(path), exist_ok=True)
+        return create(path)
+
+
+def _locked_file(lock_path):
+    """opens and flock()s lock_path. the previous holder may have removed the file
+       while we waited, then the (now unlinked) file is locked again under its path.
+    """
+    while True:
+        lock_file = _create_on_enoent(lambda path: open(path, 'a'), lock_path)
+        if not fcntl:
+            return lock_file
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            current = os.stat(lock_path)
+        except OSError:
+            current = None
+        locked = os.fstat(lock_file.fileno())
+        if current is not None and (current.st_dev, current.st_ino) == (locked.st_dev, locked.st_ino):
+            return lock_file
+        lock_file.close()
+
+
+@contextmanager
+def _file_lock(lock_path):
+    """exclusive lock on lock_path, held across processes (flock). the lock
+       file is removed on release, so no lock files are left behind.
+    """
+    with _locked_file(lock_path) as lock_file:
+        try:
+            yield
+        finally:
+            if fcntl:
+                # waiting processes notice it and lock a new file
+                try:
+                    os.remove(lock_path)
+                except OSError as e:
+                    # e.g. the directory of a manipulated image has been removed meanwhile
+                    if e.errno != errno.ENOENT:
+                        raise
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class SingleFlight(object):
+    """makes sure only one caller at a time works on a given lock file.
+       threads of the same process wait on an in-process lock, other processes
+       (e.g. uwsgi workers) wait on the flock() of the lock file.
+       with file_locks=False the key is only locked within the process.
+    """
+
+    def __init__(self, file_locks=True):
+        self._file_locks = file_locks
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    @contextmanager
+    def __call__(self, lock_path):
+        with self._lock:
+            entry = self._locks.setdefault(lock_path, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if self._file_locks:
+                    with _file_lock(lock_path):
+                        yield
+                else:
+                    yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[lock_path]
+
+
+# streams are copied in chunks of this size
+CHUNK_SIZE = 64 * 1024
+# filename of a manipulated image, see _path_to_image
+MANIPULATED_FILENAME = re.compile(r'^(crop|fit)-(\d+)x(\d+)\.(\w+)$')
+
+
+def parse_manipulated_filename(filename):
+    """(mode, size, output_extension) of a manipulated image's filename, None for other files"""
+    match = MANIPULATED_FILENAME.match(filename)
+    if not match:
+        return None
+    return match.group(1), (int(match.group(2)), int(match.group(3))), match.group(4)
+
+
+def _write_atomic(path, write):
+    fd, tmp_path = _create_on_enoent(lambda path: tempfile.mkstemp(dir=op.dirname(path), prefix='.', suffix='.tmp'),
+                                     path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def write_atomic(path, binary_data):
+    """writes to a temp file in the same directory and renames it to path,
+       so readers see either the old or the new file but never a partial one.
+    """
+    _write_atomic(path, lambda f: f.write(binary_data))
+
+
+def write_atomic_stream(path, stream):
+    """like write_atomic, copies the file like object stream in chunks"""
+    _write_atomic(path, lambda f: shutil.copyfileobj(stream, f, CHUNK_SIZE))
+
+
+def _copy_hashed(stream, f, digest):
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+        f.write(chunk)
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageBuffer(BytesIO):
+    """an image in memory, stat has the size and modification time of the stored image"""
+
+    def __init__(self, binary_image_data, stat):
+        super(ImageBuffer, self).__init__(binary_image_data)
+        self.stat = stat
+
+
+class Storage(object):
+    """interface of the storages. images are identified by name and extension,
+       manipulated versions additionally by mode ('crop' or 'fit'), size and an
+       optional output_extension. missing images raise NotFound.
+       see FileSystemStorage for the reference implementation (and its tests).
+    """
+
+    # called with (name, extension, mode, size, output_extension) of every manipulated image
+    # the storage deletes on its own (e.g. above max_manipulated), to drop it from caches
+    on_evict = None
+    # reads only update the atime of an image when it's older than this (seconds)
+    atime_resolution = 60
+
+    def exists(self, name, extension, mode=None, size=None, output_extension=None):
+        raise NotImplementedError()
+
+    def stat(self, name, extension, mode=None, size=None, output_extension=None):
+        """returns an object with st_size and st_mtime, without creating missing images"""
+        raise NotImplementedError()
+
+    def path(self, name, extension, mode=None, size=None, output_extension=None):
+        """local path of an image, only for storages in the local filesystem"""
+        raise NotImplementedError()
+
+    def save(self, name, extension, binary_image_data, mode=None, size=None, output_extension=None):
+        raise NotImplementedError()
+
+    def save_stream(self, name, extension, stream):
+        """saves an original from a file like object. storages should override this
+           to not read the whole stream into memory.
+        """
+        self.save(name, extension, stream.read())
+
+    def get(self, name, extension, mode=None, size=None, output_extension=None):
+        """returns a file like object, missing manipulated images are created. objects
+           without fileno() (e.g. an ImageBuffer) have a stat of the returned image.
+        """
+        raise NotImplementedError()
+
+    def create_manipulated(self, name, extension, specs):
+        raise NotImplementedError()
+
+    def touch(self, name, extension, mode, size, output_extension=None):
+        """counts a read of a manipulated image that a cache served, for storages that evict
+           the least recently read ones. caches call it at most every atime_resolution seconds.
+        """
+
+    def dimensions(self, name, extension):
+        """(width, height) of an original, read from its header. None if it can't be read"""
+        raise NotImplementedError()
+
+    def delete(self, name, extension, mode=None, size=None, output_extension=None):
+        raise NotImplementedError()
+
+    def safe_name(self, name, extension):
+        """returns and reserves an unused name based on name"""
+        raise NotImplementedError()
+
+    def release_name(self, name, extension):
+        """removes the reservation of safe_name() if no image has been saved under the name"""
+        raise NotImplementedError()
+
+    def manipulated(self, name, extension):
+        """list of (mode, size, output_extension) of the stored manipulated versions of an image"""
+        raise NotImplementedError()
+
+    def _evicted(self, name, extension, mode, size, output_extension):
+        if self.on_evict:
+            # like in get(), output_extension is None for the format of the original
+            self.on_evict(name, extension, mode, size, None if output_extension == extension else output_extension)
 
     def _check_mode_size(self, mode=None, size=None):
         if (mode or size) and (not mode or not size):
@@ -21,62 +243,715 @@ class FileSystemStorage(object):
         if mode and not mode in ('crop', 'fit'):
             raise ValueError('only fit or crop allowed for mode')
 
-    def exists(self, name, extension, mode=None, size=None):
-        return op.isfile(self._path_to_image(name, extension, mode, size))
 
-    def save(self, name, extension, binary_image_data, mode=None, size=None):
+def _open_existing(path):
+    """opens path for reading, None if it doesn't exist"""
+    try:
+        return open(path, 'rb')
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EISDIR):
+            return None
+        raise
+
+
+class FileSystemStorage(Storage):
+    """stores the images as files in image_dir. with sharded=True they're spread over
+       two levels of subdirectories (image_dir/ab/cd/, from the md5 of the filename),
+       so no directory gets millions of entries. see migrate.py to change the layout.
+       with indexed=True exists(), stat() and manipulated() are answered by a sqlite
+       index (see index.py) instead of the filesystem, so nothing else may change image_dir.
+       with max_manipulated an image keeps at most that many manipulated versions, the
+       least recently read ones (by atime) are deleted when a new one is saved.
+    """
+
+    def __init__(self, image_dir, executor=None, format_options=None, sharded=False, indexed=False,
+                 max_manipulated=None):
+        self._image_dir = image_dir
+        self._sharded = sharded
+        self._max_manipulated = max_manipulated
+        self._executor = executor or InlineExecutor()
+        # encoder options (e.g. quality) per output extension
+        self._format_options = format_options or {}
+        self._single_flight = SingleFlight()
+        if not op.isdir(self._image_dir):
+            os.makedirs(self._image_dir)
+        self._index = MetadataIndex(op.join(self._image_dir, '.index.sqlite')) if indexed else None
+
+    def exists(self, name, extension, mode=None, size=None, output_extension=None):
+        if self._index:
+            return self._index.stat(name, extension, mode, size, output_extension) is not None
+        return op.isfile(self._path_to_image(name, extension, mode, size, output_extension))
+
+    def stat(self, name, extension, mode=None, size=None, output_extension=None):
+        """os.stat() of a stored image, without creating missing manipulated images"""
+        self._check_mode_size(mode, size)
+        if self._index:
+            stat = self._index.stat(name, extension, mode, size, output_extension)
+            if stat is None:
+                raise NotFound()
+            return stat
+        try:
+            return os.stat(self._path_to_image(name, extension, mode, size, output_extension))
+        except OSError:
+            raise NotFound()
+
+    def path(self, name, extension, mode=None, size=None, output_extension=None):
+        """path of a stored image in the filesystem (e.g. for X-Sendfile)"""
         self._check_mode_size(mode, size)
-        if self.exists(name, extension, mode, size):
-            self.delete(name, extension, mode, size)
-        with open(self._path_to_image(name, extension, mode, size), 'wb') as f:
-            f.write(binary_image_data)
+        return self._path_to_image(name, extension, mode, size, output_extension)
 
-    def get(self, name, extension, mode=None, size=None):
+    @metrics.timed('save')
+    def save(self, name, extension, binary_image_data, mode=None, size=None, output_extension=None):
+        """saves an image and returns the os.stat() of the written file"""
         self._check_mode_size(mode, size)
-        image_path = self._path_to_image(name, extension, mode, size)
-        if mode and not op.isfile(image_path):
-            original_image = self.get(name, extension)
-            if mode == 'crop':
-                manipulated_image = image.crop_image(original_image, size)
-            elif mode == 'fit':
-                manipulated_image = image.fit_image(original_image, size)
-            self.save(name, extension, manipulated_image.read(), mode, size)
-
-        if op.isfile(image_path):
-            return open(image_path, 'rb')
+        image_path = self._path_to_image(name, extension, mode, size, output_extension)
+        write_atomic(image_path, binary_image_data)
+        stat = os.stat(image_path)
+        if self._index:
+            self._index_image(image_path, name, extension, mode, size, output_extension,
+                              None if mode else hashlib.sha256(binary_image_data).hexdigest(), stat)
+        # a new original invalidates all manipulated versions of it
+        if mode is None:
+            self._delete_manipulated(name, extension)
+        elif self._max_manipulated:
+            self._limit_manipulated(name, extension, (mode, size, output_extension or extension))
+        return stat
+
+    @metrics.timed('save')
+    def save_stream(self, name, extension, stream):
+        image_path = self._path_to_image(name, extension)
+        if self._index:
+            digest = hashlib.sha256()
+            _write_atomic(image_path, lambda f: _copy_hashed(stream, f, digest))
+            self._index_image(image_path, name, extension, content_hash=digest.hexdigest())
         else:
-            raise NotFound()
+            write_atomic_stream(image_path, stream)
+        self._delete_manipulated(name, extension)
+
+    def get(self, name, extension, mode=None, size=None, output_extension=None):
+        """opens a stored image, missing manipulated images are created first.
+           output_extension stores and returns the manipulated image in another format.
+        """
+        self._check_mode_size(mode, size)
+        image_path = self._path_to_image(name, extension, mode, size, output_extension)
+        # a stored image costs a single open()
+        image_file = _open_existing(image_path)
+        if image_file is None:
+            # requests for missing originals must not create a directory and lock file
+            if not mode or not self.exists(name, extension):
+                raise NotFound()
+            # concurrent requests for the same missing image wait for the first one to create it
+            with self._single_flight(self._lock_path(image_path)):
+                image_file = _open_existing(image_path)
+                if image_file is None:
+                    return self._create_manipulated(name, extension, mode, size, output_extension)
+        if mode:
+            metrics.derivative_request(mode, 'hit')
+            if self._max_manipulated:
+                self._touch(image_path, image_file)
+        return image_file
+
+    def touch(self, name, extension, mode, size, output_extension=None):
+        if self._max_manipulated:
+            self._touch(self._path_to_image(name, extension, mode, size, output_extension))
 
-    def delete(self, name, extension, mode=None, size=None):
-        path_to_image = self._path_to_image(name, extension, mode, size)
+    def create_manipulated(self, name, extension, specs):
+        """creates all missing (mode, size) versions in specs, decoding the original only once"""
+        for mode, size in specs:
+            self._check_mode_size(mode, size)
+        missing = [(mode, size) for mode, size in specs if not self.exists(name, extension, mode, size)]
+        if not missing:
+            return
+        manipulated_images = self._manipulate_original_many(name, extension, missing,
+                                                            self._format_options.get(extension.lower()))
+        for mode, size, manipulated_image in manipulated_images:
+            image_path = self._path_to_image(name, extension, mode, size)
+            with self._single_flight(self._lock_path(image_path)):
+                if not op.isfile(image_path):
+                    with manipulated_image.getbuffer() as binary_image_data:
+                        self.save(name, extension, binary_image_data, mode, size)
+
+    def delete(self, name, extension, mode=None, size=None, output_extension=None):
+        path_to_image = self._path_to_image(name, extension, mode, size, output_extension)
         try:
             os.remove(path_to_image)
         except OSError:
             raise NotFound()
         # only delete all files when no mode and size are given...
         if mode is None and size is None:
-            manipulated_dir = self._manipulated_directory(name, extension)
-            if op.isdir(manipulated_dir):
-                shutil.rmtree(self._manipulated_directory(name, extension))
+            self._delete_manipulated(name, extension)
+        if self._index:
+            self._index.delete(name, extension, mode, size, output_extension)
 
     def safe_name(self, name, extension):
-        counter = 1
-        safe_name = name
-        while self.exists(safe_name, extension):
-            safe_name = '%s-%d' % (name, counter)
+        """returns an unused name based on name and reserves it with an empty placeholder
+           (created exclusively), so concurrent uploads never get the same name. the
+           next suffix to try is remembered per name in .names/, so the cost doesn't grow
+           with the number of images that already have this name.
+        """
+        counter_path = self._counter_path(name, extension)
+        try:
+            with open(counter_path) as counter_file:
+                counter = int(counter_file.read())
+        except (IOError, ValueError):
+            counter = 0
+        safe_name = name if counter == 0 else '%s-%d' % (name, counter)
+        while not self._reserve(safe_name, extension):
             counter += 1
+            safe_name = '%s-%d' % (name, counter)
+        # concurrent calls may write a smaller counter, that only costs a few more tries
+        write_atomic(counter_path, str(counter + 1).encode())
         return safe_name
 
+    def release_name(self, name, extension):
+        image_path = self._path_to_image(name, extension)
+        try:
+            placeholder = os.lstat(image_path)
+        except OSError:
+            return
+        # saved after all (symlinks are the images of ContentAddressedStorage)
+        if placeholder.st_size or op.islink(image_path):
+            return
+        os.remove(image_path)
+        if self._index:
+            self._index.delete(name, extension)
+
+    def manipulated(self, name, extension):
+        if self._index:
+            return self._index.manipulated(name, extension)
+        try:
+            filenames = os.listdir(self._manipulated_directory(name, extension))
+        except OSError:
+            return []
+        return [spec for spec in map(parse_manipulated_filename, filenames) if spec]
+
+    def dimensions(self, name, extension):
+        metadata = self._index.original(name, extension) if self._index else None
+        if metadata and metadata['width']:
+            return metadata['width'], metadata['height']
+        identity = image.identify(self._original_path(name, extension))
+        return identity[:2] if identity else None
+
+    def metadata(self, name, extension):
+        """dimensions, format, size and content hash of an original, only with the index"""
+        metadata = self._index.original(name, extension) if self._index else None
+        if metadata is None:
+            raise NotFound()
+        return metadata
+
+    def index_stats(self):
+        """number and bytes of the originals and manipulated images, None without the index"""
+        return self._index.stats() if self._index else None
+
+    def rebuild_index(self):
+        """recreates the index from the files in image_dir"""
+        originals, manipulated = [], []
+        for parent, directories, filenames in os.walk(self._image_dir):
+            # .names, .blobs, ...
+            directories[:] = [directory for directory in directories if not directory.startswith('.')]
+            directory = op.basename(parent)
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                path = op.join(parent, filename)
+                if parent != self._image_dir and directory.startswith('_'):
+                    name, _, extension = directory[1:].rpartition('.')
+                    spec = parse_manipulated_filename(filename)
+                    if name and spec:
+                        manipulated.append((name, extension) + spec + (os.stat(path),))
+                else:
+                    name, _, extension = filename.rpartition('.')
+                    if name:
+                        originals.append((name, extension, os.stat(path), image.identify(path), _file_hash(path)))
+        self._index.replace(originals, manipulated)
+
+    def _reserve(self, name, extension):
+        image_path = self._path_to_image(name, extension)
+        try:
+            os.close(_create_on_enoent(lambda path: os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644),
+                                       image_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        if self._index:
+            self._index.put_original(name, extension, os.stat(image_path))
+        return True
+
+    def _touch(self, image_path, image_file=None):
+        """updates the atime of a read image (opened as image_file), relatime/noatime mounts
+           don't keep it up to date for us. mtime stays unchanged, it's the etag of the image.
+        """
+        try:
+            stat = os.fstat(image_file.fileno()) if image_file else os.stat(image_path)
+        except OSError:
+            # evicted meanwhile
+            return
+        now = time.time()
+        if now - stat.st_atime > self.atime_resolution:
+            try:
+                os.utime(image_path, (now, stat.st_mtime))
+            except OSError:
+                pass
+
+    def _limit_manipulated(self, name, extension, keep):
+        """deletes the least recently read manipulated versions of an image above
+           max_manipulated, except keep (mode, size, output_extension)
+        """
+        specs = self.manipulated(name, extension)
+        if len(specs) <= self._max_manipulated:
+            return
+        versions = []
+        for spec in specs:
+            if spec == keep:
+                continue
+            try:
+                versions.append((os.stat(self._path_to_image(name, extension, *spec)).st_atime, spec))
+            except OSError:
+                continue
+        for _, spec in sorted(versions)[:len(specs) - self._max_manipulated]:
+            try:
+                self.delete(name, extension, *spec)
+            except NotFound:
+                # deleted by a concurrent request
+                continue
+            self._evicted(name, extension, *spec)
+
+    def _index_image(self, image_path, name, extension, mode=None, size=None, output_extension=None,
+                     content_hash=None, stat=None):
+        stat = stat or os.stat(image_path)
+        if mode:
+            self._index.put_manipulated(name, extension, mode, size, output_extension, stat)
+        else:
+            self._index.put_original(name, extension, stat, image.identify(image_path), content_hash)
+
+    def _create_manipulated(self, name, extension, mode, size, output_extension=None):
+        """creates, saves and returns the manipulated image. the returned buffer is
+           the one that has been written to disk, so it doesn't have to be read again,
+           its stat is the one of the written file.
+        """
+        metrics.derivative_request(mode, 'miss')
+        output_extension = output_extension or extension
+        save_options = self._format_options.get(output_extension.lower())
+        # a large enough stored version is much cheaper to decode than the original
+        source = self._pyramid_source(name, extension, mode, size)
+        if source is None:
+            manipulated_image = self._manipulate_original(name, extension, mode, size, output_extension, save_options)
+        else:
+            manipulated_image = self._executor.run(image.manipulate_bytes, source[0], mode, size, output_extension,
+                                                   save_options, source[1])
+        with manipulated_image.getbuffer() as binary_image_data:
+            manipulated_image.stat = self.save(name, extension, binary_image_data, mode, size, output_extension)
+        return manipulated_image
+
+    def _manipulate_original(self, name, extension, mode, size, output_extension, save_options):
+        return self._executor.run(image.manipulate_file, self._original_path(name, extension), mode, size,
+                                  output_extension, save_options)
+
+    def _manipulate_original_many(self, name, extension, specs, save_options):
+        return self._executor.run(image.manipulate_file_many, self._original_path(name, extension), specs,
+                                  save_options)
+
+    def _pyramid_source(self, name, extension, mode, size):
+        """data of the smallest stored fitted version (in the format of the original) that is
+           large enough to create mode and size from (see image.can_manipulate_from()) and the
+           dimensions of the original. fitting it into size gives the size that fitting the
+           original would, not one of its rounded dimensions. None if there is none.
+        """
+        # fitted versions are never larger than their size, so this only skips versions that are too small
+        sizes = [stored_size for stored_mode, stored_size, stored_extension in self.manipulated(name, extension)
+                 if stored_mode == 'fit' and stored_extension == extension and
+                 image.can_manipulate_from(stored_size, mode, size)]
+        if not sizes:
+            return None
+        original_size = self.dimensions(name, extension)
+        if original_size is None:
+            return None
+        for stored_size in sorted(sizes, key=lambda stored_size: stored_size[0] * stored_size[1]):
+            image_file = _open_existing(self._path_to_image(name, extension, 'fit', stored_size))
+            if image_file is None:
+                continue
+            with metrics.stage('read'), image_file:
+                identity = image.identify(image_file)
+                if identity and image.can_manipulate_from(identity[:2], mode, size):
+                    image_file.seek(0)
+                    return image_file.read(), original_size
+        return None
+
+    def _original_path(self, name, extension):
+        original_path = self._path_to_image(name, extension)
+        if not op.isfile(original_path):
+            raise NotFound()
+        return original_path
+
+    def _delete_manipulated(self, name, extension):
+        if self._index:
+            # the directory isn't even looked at when there are no manipulated versions
+            if not self._index.manipulated(name, extension):
+                return
+            self._index.delete_manipulated(name, extension)
+        manipulated_dir = self._manipulated_directory(name, extension)
+        if op.isdir(manipulated_dir):
+            shutil.rmtree(manipulated_dir)
+
+    def _lock_path(self, image_path):
+        directory, filename = op.split(image_path)
+        return op.join(directory, '.%s.lock' % filename)
+
+    def _shard_directory(self, base_dir, filename):
+        if not self._sharded:
+            return base_dir
+        digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+        return op.join(base_dir, digest[:2], digest[2:4])
+
+    def _counter_path(self, name, extension):
+        filename = secure_filename('%s.%s' % (name, extension))
+        return op.join(self._shard_directory(op.join(self._image_dir, '.names'), filename), filename)
+
     def _manipulated_directory(self, name, extension):
-        return safe_join(self._image_dir, '_%s.%s' % (name, extension))
+        # next to the original
+        return safe_join(self._shard_directory(self._image_dir, secure_filename('%s.%s' % (name, extension))),
+                         '_%s.%s' % (name, extension))
 
-    def _path_to_image(self, name, extension, mode=None, size=None):
+    @metrics.timed('path')
+    def _path_to_image(self, name, extension, mode=None, size=None, output_extension=None):
+        """path of an image, without touching the filesystem (writes create missing directories)"""
         if mode:
-            filename = secure_filename('%s-%dx%d.%s' % (mode, size[0], size[1], extension))
+            # every output format of a manipulated image is a file of its own
+            filename = secure_filename('%s-%dx%d.%s' % (mode, size[0], size[1], output_extension or extension))
             directory = self._manipulated_directory(name, extension)
         else:
             filename = secure_filename(name + '.' + extension)
-            directory = self._image_dir
-        if not op.isdir(directory):
-            os.makedirs(directory)
+            directory = self._shard_directory(self._image_dir, filename)
         return safe_join(directory, filename)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """stores every distinct original only once, named by the sha256 of its content.
+
+       <name>.<extension> is a symlink to .blobs/<hash>.<extension>. the blobs
+       (and their manipulated versions) are kept in a FileSystemStorage of
+       their own, so identical uploads share one set of manipulated images.
+       .refs/<hash>.<extension>/ has an entry per name pointing to a blob, the
+       blob is deleted together with its last name.
+    """
+
+    def __init__(self, image_dir, executor=None, format_options=None, sharded=False, max_manipulated=None):
+        super(ContentAddressedStorage, self).__init__(image_dir, executor, format_options, sharded)
+        self._blobs = FileSystemStorage(op.join(image_dir, '.blobs'), self._executor, self._format_options, sharded,
+                                        max_manipulated=max_manipulated)
+        self._blobs.on_evict = self._blob_evicted
+        self._refs_dir = op.join(image_dir, '.refs')
+        if not op.isdir(self._refs_dir):
+            os.makedirs(self._refs_dir, exist_ok=True)
+
+    def exists(self, name, extension, mode=None, size=None, output_extension=None):
+        if mode is None:
+            return super(ContentAddressedStorage, self).exists(name, extension)
+        try:
+            return self._blobs.exists(self._hash(name, extension), extension, mode, size, output_extension)
+        except NotFound:
+            return False
+
+    def save(self, name, extension, binary_image_data, mode=None, size=None, output_extension=None):
+        self._check_mode_size(mode, size)
+        if mode:
+            return self._blobs.save(self._hash(name, extension), extension, binary_image_data, mode, size,
+                                    output_extension)
+        new_hash = hashlib.sha256(binary_image_data).hexdigest()
+        self._link(name, extension, new_hash, lambda: self._blobs.save(new_hash, extension, binary_image_data))
+
+    def save_stream(self, name, extension, stream):
+        # the hash is only known at the end, so the stream is copied to a temp file first
+        content_hash = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self._blobs._image_dir, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    content_hash.update(chunk)
+                    tmp_file.write(chunk)
+            os.chmod(tmp_path, 0o644)
+            new_hash = content_hash.hexdigest()
+            self._link(name, extension, new_hash, lambda: _create_on_enoent(
+                lambda blob_path: os.rename(tmp_path, blob_path), self._blobs.path(new_hash, extension)))
+        finally:
+            # the blob already existed
+            if op.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _link(self, name, extension, new_hash, save_blob):
+        """points name to the blob new_hash, save_blob() is called if it doesn't exist yet"""
+        link_path = self._path_to_image(name, extension)
+        with self._single_flight(self._lock_path(link_path)):
+            try:
+                old_hash = self._hash(name, extension)
+            except NotFound:
+                old_hash = None
+            if new_hash == old_hash:
+                return
+            self._ref(new_hash, name, extension, save_blob)
+            tmp_link_path = self._lock_path(link_path) + '.tmp'
+            os.symlink(op.relpath(self._blobs.path(new_hash, extension), op.dirname(link_path)), tmp_link_path)
+            os.rename(tmp_link_path, link_path)
+            if old_hash:
+                self._unref(old_hash, name, extension)
+
+    def path(self, name, extension, mode=None, size=None, output_extension=None):
+        self._check_mode_size(mode, size)
+        return self._blobs.path(self._hash(name, extension), extension, mode, size, output_extension)
+
+    def stat(self, name, extension, mode=None, size=None, output_extension=None):
+        self._check_mode_size(mode, size)
+        return self._blobs.stat(self._hash(name, extension), extension, mode, size, output_extension)
+
+    def get(self, name, extension, mode=None, size=None, output_extension=None):
+        self._check_mode_size(mode, size)
+        return self._blobs.get(self._hash(name, extension), extension, mode, size, output_extension)
+
+    def create_manipulated(self, name, extension, specs):
+        self._blobs.create_manipulated(self._hash(name, extension), extension, specs)
+
+    def manipulated(self, name, extension):
+        try:
+            return self._blobs.manipulated(self._hash(name, extension), extension)
+        except NotFound:
+            return []
+
+    def touch(self, name, extension, mode, size, output_extension=None):
+        try:
+            self._blobs.touch(self._hash(name, extension), extension, mode, size, output_extension)
+        except NotFound:
+            pass
+
+    def delete(self, name, extension, mode=None, size=None, output_extension=None):
+        if mode:
+            self._blobs.delete(self._hash(name, extension), extension, mode, size, output_extension)
+            return
+        link_path = self._path_to_image(name, extension)
+        with self._single_flight(self._lock_path(link_path)):
+            try:
+                content_hash = self._hash(name, extension)
+            except NotFound:
+                # a placeholder of safe_name() that never got an image
+                if op.islink(link_path) or not op.isfile(link_path):
+                    raise
+                os.remove(link_path)
+                return
+            os.remove(link_path)
+            self._unref(content_hash, name, extension)
+
+    def _blob_evicted(self, content_hash, extension, mode, size, output_extension):
+        """a version of a blob has been evicted, for all names that point to it"""
+        try:
+            filenames = os.listdir(self._blob_refs(content_hash, extension))
+        except OSError:
+            return
+        for filename in filenames:
+            self._evicted(filename.rpartition('.')[0], extension, mode, size, output_extension)
+
+    def _hash(self, name, extension):
+        try:
+            blob_path = os.readlink(self._path_to_image(name, extension))
+        except OSError:
+            raise NotFound()
+        return op.basename(blob_path).rsplit('.', 1)[0]
+
+    def _blob_refs(self, content_hash, extension):
+        filename = '%s.%s' % (content_hash, extension)
+        return op.join(self._shard_directory(self._refs_dir, filename), filename)
+
+    def _ref(self, content_hash, name, extension, save_blob):
+        refs_dir = self._blob_refs(content_hash, extension)
+        with self._single_flight(refs_dir + '.lock'):
+            if not self._blobs.exists(content_hash, extension):
+                save_blob()
+            if not op.isdir(refs_dir):
+                os.makedirs(refs_dir)
+            open(op.join(refs_dir, secure_filename('%s.%s' % (name, extension))), 'a').close()
+
+    def _unref(self, content_hash, name, extension):
+        refs_dir = self._blob_refs(content_hash, extension)
+        with self._single_flight(refs_dir + '.lock'):
+            try:
+                os.remove(op.join(refs_dir, secure_filename('%s.%s' % (name, extension))))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            try:
+                os.rmdir(refs_dir)
+            except OSError as e:
+                # other names still use the blob
+                if e.errno in (errno.ENOTEMPTY, errno.EEXIST):
+                    return
+                if e.errno != errno.ENOENT:
+                    raise
+            if self._blobs.exists(content_hash, extension):
+                self._blobs.delete(content_hash, extension)
+
+
+class TieredStorage(FileSystemStorage):
+    """keeps the originals in a cold storage (e.g. a FileSystemStorage on a network
+       volume or an S3Storage) and the manipulated images in the local image_dir,
+       which is a cache of about max_bytes. when it's full, the least recently read
+       manipulated images (by atime) are evicted, get() creates them again from the
+       cold original when they're requested.
+
+       image_dir is local to the host: with several hosts, replacing an original
+       only removes the manipulated images of the host that handled the upload.
+    """
+
+    # eviction goes down to this fraction of max_bytes, so not every miss evicts
+    low_water_mark = 0.9
+
+    def __init__(self, cold, image_dir, max_bytes, executor=None, format_options=None, sharded=False,
+                 max_manipulated=None):
+        super(TieredStorage, self).__init__(image_dir, executor, format_options, sharded,
+                                            max_manipulated=max_manipulated)
+        self._cold = cold
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._used = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._evict()
+
+    def exists(self, name, extension, mode=None, size=None, output_extension=None):
+        if mode is None:
+            return self._cold.exists(name, extension)
+        return super(TieredStorage, self).exists(name, extension, mode, size, output_extension)
+
+    def stat(self, name, extension, mode=None, size=None, output_extension=None):
+        if mode is None:
+            return self._cold.stat(name, extension)
+        return super(TieredStorage, self).stat(name, extension, mode, size, output_extension)
+
+    def path(self, name, extension, mode=None, size=None, output_extension=None):
+        if mode is None:
+            return self._cold.path(name, extension)
+        return super(TieredStorage, self).path(name, extension, mode, size, output_extension)
+
+    def save(self, name, extension, binary_image_data, mode=None, size=None, output_extension=None):
+        self._check_mode_size(mode, size)
+        if mode is None:
+            self._cold.save(name, extension, binary_image_data)
+            self._delete_manipulated(name, extension)
+            return
+        stat = super(TieredStorage, self).save(name, extension, binary_image_data, mode, size, output_extension)
+        with self._lock:
+            self._used += len(binary_image_data)
+            full = self._used > self._max_bytes
+        if full:
+            self._evict()
+        return stat
+
+    def save_stream(self, name, extension, stream):
+        self._cold.save_stream(name, extension, stream)
+        self._delete_manipulated(name, extension)
+
+    def get(self, name, extension, mode=None, size=None, output_extension=None):
+        if mode is None:
+            return self._cold.get(name, extension)
+        self._check_mode_size(mode, size)
+        image_path = self._path_to_image(name, extension, mode, size, output_extension)
+        try:
+            image_file = open(image_path, 'rb')
+        except IOError:
+            # misses are counted when the image is created
+            return super(TieredStorage, self).get(name, extension, mode, size, output_extension)
+        metrics.derivative_request(mode, 'hit')
+        with self._lock:
+            self._hits += 1
+        self._touch(image_path, image_file)
+        return image_file
+
+    def delete(self, name, extension, mode=None, size=None, output_extension=None):
+        if mode is None and size is None:
+            self._cold.delete(name, extension)
+            self._delete_manipulated(name, extension)
+            return
+        super(TieredStorage, self).delete(name, extension, mode, size, output_extension)
+
+    def touch(self, name, extension, mode, size, output_extension=None):
+        # the local tier evicts by atime also without max_manipulated
+        self._touch(self._path_to_image(name, extension, mode, size, output_extension))
+
+    def dimensions(self, name, extension):
+        return self._cold.dimensions(name, extension)
+
+    def safe_name(self, name, extension):
+        return self._cold.safe_name(name, extension)
+
+    def release_name(self, name, extension):
+        self._cold.release_name(name, extension)
+
+    def tier_stats(self):
+        """hits and misses of the local tier, every miss read the original from the cold tier"""
+        with self._lock:
+            requests = self._hits + self._misses
+            return dict(hits=self._hits, misses=self._misses, evictions=self._evictions,
+                        hit_ratio=float(self._hits) / requests if requests else 0.0,
+                        bytes=self._used, max_bytes=self._max_bytes)
+
+    def _cold_original(self, name, extension):
+        with metrics.stage('read'), self._cold.get(name, extension) as original:
+            return original.read()
+
+    def _create_manipulated(self, name, extension, mode, size, output_extension=None):
+        with self._lock:
+            self._misses += 1
+        return super(TieredStorage, self)._create_manipulated(name, extension, mode, size, output_extension)
+
+    def _manipulate_original(self, name, extension, mode, size, output_extension, save_options):
+        return self._executor.run(image.manipulate_bytes, self._cold_original(name, extension), mode, size,
+                                  output_extension, save_options)
+
+    def _manipulate_original_many(self, name, extension, specs, save_options):
+        return self._executor.run(image.manipulate_bytes_many, self._cold_original(name, extension), specs,
+                                  extension, save_options)
+
+    def _manipulated_files(self):
+        """yields (atime, size, path) of all manipulated images in the local tier"""
+        for directory, _, _ in os.walk(self._image_dir):
+            if not op.basename(directory).startswith('_'):
+                continue
+            for entry in os.scandir(directory):
+                # skips lock and temp files
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield stat.st_atime, stat.st_size, entry.path
+
+    def _evicted_file(self, path):
+        directory, filename = op.split(path)
+        name, _, extension = op.basename(directory)[1:].rpartition('.')
+        spec = parse_manipulated_filename(filename)
+        if name and spec:
+            self._evicted(name, extension, *spec)
+
+    def _evict(self):
+        """removes the least recently read manipulated images until the local tier is
+           below low_water_mark. other processes write to the same directory, so the
+           usage is measured again instead of trusting self._used.
+        """
+        with self._single_flight(op.join(self._image_dir, '.evict.lock')):
+            files = sorted(self._manipulated_files())
+            used = sum(size for _, size, _ in files)
+            evicted = 0
+            if used > self._max_bytes:
+                for _, size, path in files:
+                    if used <= self._max_bytes * self.low_water_mark:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    used -= size
+                    evicted += 1
+                    self._evicted_file(path)
+            with self._lock:
+                self._used = used
+                self._evictions += evicted
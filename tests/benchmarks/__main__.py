@@ -0,0 +1,85 @@
+"""runs the benchmark suite and writes its results as json, together with the
+commit and versions they were measured with. compare two of those files to find
+regressions between commits:
+
+    python -m tests.benchmarks [--output results.json] [--quick]
+    python -m tests.benchmarks compare old.json new.json [--threshold 0.1]
+
+bench_draft and bench_executor are run on their own, see their docstrings.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import PIL
+
+from tests.benchmarks import bench_image, bench_load, bench_storage
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(quick):
+    if quick:
+        benchmarks = [bench_image.run([1], ['jpg', 'png'], [(200, 200)], 3),
+                      bench_storage.run(1, 10),
+                      bench_load.run(5, 200, 4, 1, 1)]
+    else:
+        benchmarks = [bench_image.run([1, 4, 12], ['jpg', 'png', 'webp'], [(100, 100), (400, 400), (1000, 1000)], 5),
+                      bench_storage.run(4, 50),
+                      bench_load.run(20, 1000, 8, 1, 2)]
+    return dict(commit=_commit(), python=platform.python_version(), pillow=PIL.__version__,
+                cpus=os.cpu_count(), platform=platform.platform(), quick=quick, benchmarks=benchmarks)
+
+
+def _means(results):
+    return {(benchmark['benchmark'], result['name']): result['mean_seconds']
+            for benchmark in results['benchmarks'] for result in benchmark['results']}
+
+
+def compare(old, new, threshold):
+    """relative change of the mean time of every benchmark in both files,
+       changes above threshold are regressions
+    """
+    old_means, new_means = _means(old), _means(new)
+    changes = []
+    for key in sorted(set(old_means) & set(new_means)):
+        change = new_means[key] / old_means[key] - 1 if old_means[key] else 0.0
+        changes.append(dict(benchmark=key[0], name=key[1], old_mean_seconds=old_means[key],
+                            new_mean_seconds=new_means[key], change=change, regression=change > threshold))
+    return dict(old_commit=old.get('commit'), new_commit=new.get('commit'), threshold=threshold, changes=changes)
+
+
+def main():
+    if sys.argv[1:2] == ['compare']:
+        parser = argparse.ArgumentParser(prog='python -m tests.benchmarks compare')
+        parser.add_argument('old')
+        parser.add_argument('new')
+        parser.add_argument('--threshold', type=float, default=0.1)
+        args = parser.parse_args(sys.argv[2:])
+        with open(args.old) as old_file, open(args.new) as new_file:
+            result = compare(json.load(old_file), json.load(new_file), args.threshold)
+        print(json.dumps(result, indent=2))
+        # non zero exit status for ci
+        sys.exit(1 if any(change['regression'] for change in result['changes']) else 0)
+    parser = argparse.ArgumentParser(prog='python -m tests.benchmarks')
+    parser.add_argument('--output')
+    parser.add_argument('--quick', action='store_true')
+    args = parser.parse_args()
+    output = json.dumps(run(args.quick), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
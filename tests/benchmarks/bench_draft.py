@@ -0,0 +1,95 @@
+"""compares decoding jpegs with and without draft mode for fit and crop.
+
+every measurement runs in its own process, so peak rss (ru_maxrss) is not
+influenced by earlier runs. usage:
+
+    python -m tests.benchmarks.bench_draft [--megapixels 24] [--size 200x200] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image as PILImage
+
+from image_service import image
+
+
+def _peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes on linux
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def create_jpeg(path, megapixels):
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    gradient = PILImage.linear_gradient('L').resize((width, height))
+    PILImage.merge('RGB', (gradient, gradient.rotate(90).resize((width, height)), gradient)) \
+        .save(path, 'JPEG', quality=90)
+
+
+def run_single(path, mode, size, draft, repeat):
+    manipulate = image.crop_image if mode == 'crop' else image.fit_image
+    timings = []
+    for _ in range(repeat):
+        with open(path, 'rb') as jpg_file:
+            start = time.time()
+            manipulate(jpg_file, size, draft=draft)
+            timings.append(time.time() - start)
+    return dict(mode=mode, draft=draft, size=list(size),
+                best_seconds=min(timings), mean_seconds=sum(timings) / len(timings),
+                peak_rss_kb=_peak_rss_kb())
+
+
+def _run_module(*args):
+    # ru_maxrss survives fork and exec, so this process must stay small
+    output = subprocess.check_output([sys.executable, '-m', 'tests.benchmarks.bench_draft'] + list(args))
+    return output.decode()
+
+
+def run(megapixels, size, repeat):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.jpg')
+    results = []
+    try:
+        _run_module('--create', path, '--megapixels', str(megapixels))
+        for mode in ('fit', 'crop'):
+            for draft in (False, True):
+                args = ['--single', path, '--mode', mode, '--size', '%dx%d' % size, '--repeat', str(repeat)]
+                if draft:
+                    args.append('--draft')
+                results.append(json.loads(_run_module(*args)))
+    finally:
+        os.remove(path)
+        os.rmdir(directory)
+    return dict(benchmark='draft', megapixels=megapixels, results=results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megapixels', type=float, default=24)
+    parser.add_argument('--size', default='200x200')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--single')
+    parser.add_argument('--create')
+    parser.add_argument('--mode', default='fit')
+    parser.add_argument('--draft', action='store_true')
+    args = parser.parse_args()
+    size = tuple(int(x) for x in args.size.split('x'))
+    if args.create:
+        create_jpeg(args.create, args.megapixels)
+        return
+    if args.single:
+        result = run_single(args.single, args.mode, size, args.draft, args.repeat)
+    else:
+        result = run(args.megapixels, size, args.repeat)
+    print(json.dumps(result, indent=None if args.single else 2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""load benchmark for the resize executors: many threads request missing
+manipulated images from one FileSystemStorage (like a threaded uwsgi worker)
+and we count the created images per second for every backend and pool size.
+
+    python -m tests.benchmarks.bench_executor [--megapixels 4] [--requests 64] [--threads 16]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from image_service.executor import create_executor
+from image_service.storage import FileSystemStorage
+from tests.benchmarks.bench_draft import create_jpeg
+
+
+def _worker_counts():
+    cpus = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cpus:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cpus:
+        counts.append(cpus)
+    return counts
+
+
+def run_backend(original, backend, workers, requests, threads):
+    storage_dir = tempfile.mkdtemp()
+    executor = create_executor(backend, workers, max_pending=requests)
+    storage = FileSystemStorage(storage_dir, executor)
+    try:
+        with open(original, 'rb') as jpg_file:
+            storage.save('bench', 'jpg', jpg_file.read())
+        # every request asks for a different size, so every request is a miss
+        sizes = [(100 + i, 100 + i) for i in range(requests)]
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=threads) as clients:
+            list(clients.map(lambda size: storage.get('bench', 'jpg', 'fit', size).close(), sizes))
+        elapsed = time.time() - start
+    finally:
+        executor.shutdown()
+        shutil.rmtree(storage_dir)
+    return dict(backend=backend, workers=workers, seconds=elapsed, images_per_second=requests / elapsed)
+
+
+def run(megapixels, requests, threads):
+    directory = tempfile.mkdtemp()
+    original = os.path.join(directory, 'bench.jpg')
+    try:
+        create_jpeg(original, megapixels)
+        results = [run_backend(original, 'inline', 1, requests, threads)]
+        for backend in ('thread', 'process'):
+            for workers in _worker_counts():
+                results.append(run_backend(original, backend, workers, requests, threads))
+    finally:
+        shutil.rmtree(directory)
+    return dict(benchmark='executor', megapixels=megapixels, requests=requests, threads=threads,
+                cpus=os.cpu_count(), results=results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megapixels', type=float, default=4)
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+    print(json.dumps(run(args.megapixels, args.requests, args.threads), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""micro benchmarks of image.fit_image and image.crop_image for every combination
+of source size, source format and target size.
+
+    python -m tests.benchmarks.bench_image [--megapixels 1 4 12] [--formats jpg png webp]
+                                           [--sizes 100x100 400x400 1000x1000] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from PIL import Image as PILImage
+
+from image_service import image
+
+PIL_FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+
+
+def create_image(path, megapixels, extension):
+    """a 4:3 image of gradients and noise, so it neither compresses unrealistically
+       well (plain gradients) nor badly (plain noise)
+    """
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    gradient = PILImage.linear_gradient('L').resize((width, height))
+    noise = PILImage.effect_noise((width, height), 32)
+    PILImage.merge('RGB', (gradient, noise, gradient.transpose(PILImage.ROTATE_180))) \
+        .save(path, PIL_FORMATS[extension])
+
+
+def summarize(timings):
+    """best, mean and percentiles (seconds) of a list of timings"""
+    timings = sorted(timings)
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(round(p / 100.0 * (len(timings) - 1))))]
+    return dict(count=len(timings), best_seconds=timings[0], mean_seconds=sum(timings) / len(timings),
+                p50_seconds=percentile(50), p90_seconds=percentile(90), p99_seconds=percentile(99))
+
+
+def run_single(path, mode, size, repeat):
+    manipulate = image.crop_image if mode == 'crop' else image.fit_image
+    timings = []
+    for _ in range(repeat):
+        with open(path, 'rb') as image_file:
+            start = time.perf_counter()
+            manipulate(image_file, size)
+            timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def run(megapixels, formats, sizes, repeat):
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for source_megapixels in megapixels:
+            for extension in formats:
+                if not image.pil_format_from_file_extension('.' + extension):
+                    continue
+                path = os.path.join(directory, 'bench-%s.%s' % (source_megapixels, extension))
+                create_image(path, source_megapixels, extension)
+                for size in sizes:
+                    for mode in ('fit', 'crop'):
+                        result = dict(name='%s-%smp-%s-%dx%d' % (mode, source_megapixels, extension, size[0], size[1]),
+                                      mode=mode, megapixels=source_megapixels, format=extension, size=list(size),
+                                      file_bytes=os.path.getsize(path))
+                        result.update(run_single(path, mode, size, repeat))
+                        results.append(result)
+    finally:
+        shutil.rmtree(directory)
+    return dict(benchmark='image', repeat=repeat, results=results)
+
+
+def parse_size(size):
+    return tuple(int(x) for x in size.split('x'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 4, 12])
+    parser.add_argument('--formats', nargs='+', default=['jpg', 'png', 'webp'])
+    parser.add_argument('--sizes', nargs='+', default=['100x100', '400x400', '1000x1000'])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.megapixels, args.formats, [parse_size(s) for s in args.sizes], args.repeat),
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
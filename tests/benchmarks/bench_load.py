@@ -0,0 +1,105 @@
+"""in-process load test of the wsgi app: client threads replay a seeded, realistic
+mix of requests for originals, fitted and cropped images. a few images and sizes
+are much more popular than the rest, so there are hits and misses like in production.
+
+    python -m tests.benchmarks.bench_load [--images 20] [--requests 1000] [--threads 8] [--seed 1]
+"""
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import image_service
+from tests.benchmarks.bench_image import create_image, summarize
+
+# share of requests per kind
+MIX = (('original', 0.2), ('fit', 0.5), ('crop', 0.3))
+# requested sizes, the first ones are the most popular
+SIZES = ((100, 100), (200, 200), (400, 300), (800, 600), (64, 64), (1024, 768), (300, 300), (150, 100))
+
+
+def _zipf_choice(rng, items):
+    weights = [1.0 / (rank + 1) for rank in range(len(items))]
+    return rng.choices(items, weights)[0]
+
+
+def create_requests(images, requests, seed):
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    urls = []
+    for _ in range(requests):
+        kind = rng.choices(kinds, weights)[0]
+        name = _zipf_choice(rng, images)
+        if kind == 'original':
+            urls.append((kind, '/images/%s.jpg' % name))
+        else:
+            width, height = _zipf_choice(rng, SIZES)
+            urls.append((kind, '/images/%s@%s-%dx%d.jpg' % (name, kind, width, height)))
+    return urls
+
+
+def _client(urls, results, lock):
+    client = image_service.app.test_client()
+    timings = defaultdict(list)
+    statuses = defaultdict(int)
+    for kind, url in urls:
+        start = time.perf_counter()
+        response = client.get(url)
+        response.get_data()
+        timings[kind].append(time.perf_counter() - start)
+        statuses[response.status_code] += 1
+    with lock:
+        for kind, kind_timings in timings.items():
+            results['timings'][kind].extend(kind_timings)
+        for status, count in statuses.items():
+            results['statuses'][status] += count
+
+
+def run(images, requests, threads, seed, megapixels):
+    directory = tempfile.mkdtemp()
+    image_service.app.config['STORAGE_DIRECTORY'] = directory
+    image_service._storage = None
+    try:
+        names = ['image%d' % i for i in range(images)]
+        for name in names:
+            create_image(image_service.storage().path(name, 'jpg'), megapixels, 'jpg')
+        urls = create_requests(names, requests, seed)
+        results = dict(timings=defaultdict(list), statuses=defaultdict(int))
+        lock = threading.Lock()
+        workers = [threading.Thread(target=_client, args=(urls[i::threads], results, lock)) for i in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        image_service._storage = None
+        shutil.rmtree(directory)
+    all_timings = [timing for kind_timings in results['timings'].values() for timing in kind_timings]
+    return dict(benchmark='load', images=images, requests=requests, threads=threads, seed=seed,
+                megapixels=megapixels, seconds=elapsed, requests_per_second=requests / elapsed,
+                statuses={str(status): count for status, count in sorted(results['statuses'].items())},
+                results=[dict(name='all', **summarize(all_timings))] +
+                        [dict(name=kind, **summarize(results['timings'][kind]))
+                         for kind, _ in MIX if results['timings'][kind]])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--megapixels', type=float, default=2)
+    args = parser.parse_args()
+    print(json.dumps(run(args.images, args.requests, args.threads, args.seed, args.megapixels), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""benchmarks FileSystemStorage.get for originals, cold manipulated images (they
+don't exist yet and are created by get()) and warm ones (they're already stored).
+
+    python -m tests.benchmarks.bench_storage [--megapixels 4] [--requests 50]
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+from image_service.storage import FileSystemStorage
+from tests.benchmarks.bench_image import create_image, summarize
+
+
+def _time_gets(storage, requests):
+    timings = []
+    for args in requests:
+        start = time.perf_counter()
+        with storage.get(*args) as image_file:
+            image_file.read()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def run(megapixels, requests):
+    directory = tempfile.mkdtemp()
+    try:
+        storage = FileSystemStorage(directory)
+        create_image(storage.path('bench', 'jpg'), megapixels, 'jpg')
+        # every size is a different manipulated image, so the first round creates all of them
+        gets = [('bench', 'jpg', mode, (100 + i, 100 + i)) for i in range(requests) for mode in ('fit', 'crop')]
+        results = [dict(name='original', **_time_gets(storage, [('bench', 'jpg')] * requests)),
+                   dict(name='cold', **_time_gets(storage, gets)),
+                   dict(name='warm', **_time_gets(storage, gets))]
+    finally:
+        shutil.rmtree(directory)
+    return dict(benchmark='storage', megapixels=megapixels, results=results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--megapixels', type=float, default=4)
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(run(args.megapixels, args.requests), indent=2))
+
+
+if __name__ == '__main__':
+    main()
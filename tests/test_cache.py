@@ -0,0 +1,168 @@
+import unittest
+import os
+import os.path as op
+import shutil
+from io import BytesIO
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from PIL import Image as PILImage
+from werkzeug.exceptions import NotFound
+
+from image_service.cache import DerivativeCache, CachingStorage
+from image_service.storage import FileSystemStorage
+
+
+class TestDerivativeCache(unittest.TestCase):
+    def test_hit_and_miss(self):
+        cache = DerivativeCache(100)
+        key = ('image', 'png', 'fit', (200, 200))
+        self.assertIsNone(cache.get(key))
+        cache.put(key, b'1234', 'stat')
+        self.assertEqual((b'1234', 'stat'), cache.get(key))
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(4, stats['bytes'])
+
+    def test_evicts_least_recently_used(self):
+        cache = DerivativeCache(10)
+        cache.put(('a', 'png', 'fit', (1, 1)), b'1234', None)
+        cache.put(('b', 'png', 'fit', (1, 1)), b'1234', None)
+        cache.get(('a', 'png', 'fit', (1, 1)))
+        cache.put(('c', 'png', 'fit', (1, 1)), b'1234', None)
+        self.assertIsNotNone(cache.get(('a', 'png', 'fit', (1, 1))))
+        self.assertIsNone(cache.get(('b', 'png', 'fit', (1, 1))))
+        self.assertIsNotNone(cache.get(('c', 'png', 'fit', (1, 1))))
+        self.assertEqual(1, cache.stats()['evictions'])
+        self.assertEqual(8, cache.stats()['bytes'])
+
+    def test_does_not_cache_entries_larger_than_budget(self):
+        cache = DerivativeCache(3)
+        cache.put(('a', 'png', 'fit', (1, 1)), b'1234', None)
+        self.assertEqual(0, cache.stats()['entries'])
+
+    def test_invalidate_all_versions(self):
+        cache = DerivativeCache(100)
+        cache.put(('a', 'png', 'fit', (1, 1)), b'1', None)
+        cache.put(('a', 'png', 'crop', (1, 1)), b'2', None)
+        cache.put(('b', 'png', 'fit', (1, 1)), b'3', None)
+        cache.invalidate('a', 'png')
+        self.assertIsNone(cache.get(('a', 'png', 'fit', (1, 1))))
+        self.assertIsNone(cache.get(('a', 'png', 'crop', (1, 1))))
+        self.assertEqual((b'3', None), cache.get(('b', 'png', 'fit', (1, 1))))
+        self.assertEqual(1, cache.stats()['bytes'])
+
+    def test_put_with_outdated_generation(self):
+        cache = DerivativeCache(100)
+        generation = cache.generation('a', 'png')
+        cache.invalidate('a', 'png')
+        cache.put(('a', 'png', 'fit', (1, 1)), b'1', None, generation=generation)
+        self.assertIsNone(cache.get(('a', 'png', 'fit', (1, 1))))
+
+    def test_other_validator_invalidates_the_image(self):
+        cache = DerivativeCache(100)
+        cache.put(('a', 'png', 'fit', (1, 1)), b'1', None, 'old')
+        cache.put(('a', 'png', 'crop', (1, 1)), b'2', None, 'old')
+        self.assertEqual((b'1', None), cache.get(('a', 'png', 'fit', (1, 1)), 'old'))
+        self.assertIsNone(cache.get(('a', 'png', 'fit', (1, 1)), 'new'))
+        self.assertEqual(0, cache.stats()['entries'])
+
+
+class TestCachingStorage(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = op.join(op.dirname(op.dirname(op.realpath(__file__))), 'test_storage')
+        self.storage = CachingStorage(FileSystemStorage(self.storage_dir), DerivativeCache(1024 * 1024))
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_dir)
+
+    def _test_image_path(self, image_name):
+        current_dir = op.dirname(op.realpath(__file__))
+        return op.join(current_dir, 'test_images', image_name)
+
+    def _save_png(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            self.storage.save('png_image', 'png', png_file.read())
+
+    def test_serves_manipulated_from_memory(self):
+        self._save_png()
+        first = self.storage.get('png_image', 'png', 'fit', (200, 200)).read()
+        second = self.storage.get('png_image', 'png', 'fit', (200, 200))
+        self.assertEqual(first, second.read())
+        self.assertEqual(1, self.storage.stats()['hits'])
+        self.assertEqual(1, self.storage.stats()['misses'])
+        second.seek(0)
+        self.assertEqual((200, 150), PILImage.open(second).size)
+
+    def test_memory_hits_have_the_stat_of_the_stored_image(self):
+        self._save_png()
+        created = self.storage.get('png_image', 'png', 'fit', (200, 200))
+        stat = os.stat(self.storage.path('png_image', 'png', 'fit', (200, 200)))
+        self.assertEqual((stat.st_size, stat.st_mtime), (created.stat.st_size, created.stat.st_mtime))
+        # hits only stat() the original
+        with mock.patch.object(FileSystemStorage, 'stat', wraps=self.storage._storage.stat) as storage_stat:
+            self.assertEqual(stat, self.storage.get('png_image', 'png', 'fit', (200, 200)).stat)
+        storage_stat.assert_called_once_with('png_image', 'png')
+        self.assertEqual(1, self.storage.stats()['hits'])
+
+    def test_memory_hits_count_as_reads_of_the_storage(self):
+        storage = FileSystemStorage(self.storage_dir, max_manipulated=2)
+        storage.atime_resolution = 0
+        self.storage = CachingStorage(storage, DerivativeCache(1024 * 1024))
+        self._save_png()
+        self.storage.get('png_image', 'png', 'fit', (100, 100))
+        self.storage.get('png_image', 'png', 'fit', (110, 110))
+        for _ in range(5):
+            self.storage.get('png_image', 'png', 'fit', (100, 100))
+        self.assertEqual(5, self.storage.stats()['hits'])
+        self.storage.get('png_image', 'png', 'fit', (120, 120))
+        # the least recently read one is evicted, not the hot one
+        self.assertEqual([('fit', (100, 100), 'png'), ('fit', (120, 120), 'png')],
+                         sorted(storage.manipulated('png_image', 'png')))
+        # and still in memory
+        self.storage.get('png_image', 'png', 'fit', (100, 100))
+        self.assertEqual(6, self.storage.stats()['hits'])
+
+    def test_touch_at_most_every_atime_resolution(self):
+        self._save_png()
+        self.storage.get('png_image', 'png', 'fit', (200, 200))
+        with mock.patch.object(FileSystemStorage, 'touch') as touch:
+            self.storage.get('png_image', 'png', 'fit', (200, 200))
+            touch.assert_not_called()
+            self.storage._storage.atime_resolution = 0
+            self.storage.get('png_image', 'png', 'fit', (200, 200))
+            touch.assert_called_once_with('png_image', 'png', 'fit', (200, 200), None)
+
+    def test_save_invalidates(self):
+        self._save_png()
+        self.storage.get('png_image', 'png', 'fit', (200, 200))
+        self._save_png()
+        self.assertEqual(0, self.storage.stats()['entries'])
+
+    def test_delete_invalidates(self):
+        self._save_png()
+        self.storage.get('png_image', 'png', 'fit', (200, 200))
+        self.storage.delete('png_image', 'png')
+        self.assertEqual(0, self.storage.stats()['entries'])
+        self.assertRaises(NotFound, self.storage.get, 'png_image', 'png', 'fit', (200, 200))
+
+    def test_original_replaced_by_another_process(self):
+        self._save_png()
+        other_process = CachingStorage(FileSystemStorage(self.storage_dir), DerivativeCache(1024 * 1024))
+        self.assertEqual((200, 150), PILImage.open(other_process.get('png_image', 'png', 'fit', (200, 200))).size)
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            rotated = PILImage.open(png_file).rotate(90, expand=True)
+            rotated_file = BytesIO()
+            rotated.save(rotated_file, 'PNG')
+        self.storage.save('png_image', 'png', rotated_file.getvalue())
+        self.assertEqual((150, 200), PILImage.open(other_process.get('png_image', 'png', 'fit', (200, 200))).size)
+
+    def test_original_deleted_by_another_process(self):
+        self._save_png()
+        other_process = CachingStorage(FileSystemStorage(self.storage_dir), DerivativeCache(1024 * 1024))
+        other_process.get('png_image', 'png', 'fit', (200, 200))
+        self.storage.delete('png_image', 'png')
+        self.assertRaises(NotFound, other_process.get, 'png_image', 'png', 'fit', (200, 200))
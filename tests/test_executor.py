@@ -0,0 +1,73 @@
+import unittest
+import os.path as op
+import shutil
+import threading
+import time
+
+from PIL import Image as PILImage
+
+from image_service import image
+from image_service.executor import create_executor, InlineExecutor, ResizeQueueFull, ResizeTimeout
+from image_service.storage import FileSystemStorage
+
+
+def _wait(event):
+    event.wait()
+    return 'done'
+
+
+class TestExecutor(unittest.TestCase):
+    def _test_image_path(self, image_name):
+        current_dir = op.dirname(op.realpath(__file__))
+        return op.join(current_dir, 'test_images', image_name)
+
+    def test_inline(self):
+        executor = create_executor('inline')
+        self.assertIsInstance(executor, InlineExecutor)
+        self.assertEqual(3, executor.run(max, 1, 3))
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, create_executor, 'nonsense')
+
+    def test_thread_pool_queue_full(self):
+        executor = create_executor('thread', workers=1, max_pending=1)
+        event = threading.Event()
+        thread = threading.Thread(target=executor.run, args=(_wait, event))
+        thread.start()
+        while not executor.pending:
+            time.sleep(0.01)
+        self.assertRaises(ResizeQueueFull, executor.run, max, 1, 2)
+        event.set()
+        thread.join()
+        self.assertEqual(0, executor.pending)
+        self.assertEqual(2, executor.run(max, 1, 2))
+        executor.shutdown()
+
+    def test_thread_pool_timeout(self):
+        executor = create_executor('thread', workers=1, timeout=0.05)
+        event = threading.Event()
+        self.assertRaises(ResizeTimeout, executor.run, _wait, event)
+        event.set()
+        executor.shutdown()
+        self.assertEqual(0, executor.pending)
+
+    def test_process_pool(self):
+        executor = create_executor('process', workers=1)
+        manipulated_image = executor.run(image.manipulate_file, self._test_image_path('png_image.png'),
+                                         'crop', (200, 100))
+        self.assertEqual((200, 100), PILImage.open(manipulated_image).size)
+        executor.shutdown()
+
+    def test_storage_with_process_pool(self):
+        storage_dir = op.join(op.dirname(op.dirname(op.realpath(__file__))), 'test_storage')
+        executor = create_executor('process', workers=1)
+        storage = FileSystemStorage(storage_dir, executor)
+        try:
+            with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+                storage.save('png_image', 'png', png_file.read())
+            self.assertEqual((200, 150), PILImage.open(storage.get('png_image', 'png', 'fit', (200, 200))).size)
+            storage.create_manipulated('png_image', 'png', [('crop', (50, 50))])
+            self.assertTrue(storage.exists('png_image', 'png', 'crop', (50, 50)))
+        finally:
+            executor.shutdown()
+            shutil.rmtree(storage_dir)
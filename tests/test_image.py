@@ -1,9 +1,10 @@
 import unittest
 import os
+from io import BytesIO
 
-from PIL import Image as PILImage
+from PIL import Image as PILImage, features
 
-from image_service import image
+from image_service import image, metrics
 
 
 class TestImage(unittest.TestCase):
@@ -20,6 +21,22 @@ class TestImage(unittest.TestCase):
             pil_image = PILImage.open(image.fit_image(png_file, [200, 200]))
             self.assertEqual((200, 150), pil_image.size)
 
+    def test_fitted_size_like_thumbnail(self):
+        for image_size in ((1841, 893), (640, 480), (100, 300), (3, 1000)):
+            for size in ((166, 166), (411, 411), (200, 100), (50, 1000), (2000, 2000)):
+                pil_image = PILImage.new('RGB', image_size)
+                pil_image.thumbnail(size)
+                self.assertEqual(pil_image.size, image.fitted_size(image_size, size))
+
+    def test_fit_image_of_fitted_version(self):
+        fitted = image.fit_image(image.binary_image(PILImage.new('RGB', (1841, 893)), 'PNG'), (411, 411),
+                                 output_extension='png')
+        self.assertEqual((411, 199), PILImage.open(fitted).size)
+        fitted.seek(0)
+        # the aspect ratio of 411x199 would give 166x80
+        from_fitted = image.manipulate_bytes(fitted.getvalue(), 'fit', (166, 166), 'png', original_size=(1841, 893))
+        self.assertEqual((166, 81), PILImage.open(from_fitted).size)
+
     def test_crop_image(self):
         image_path = 'png_image.png'
         with open(self._test_image_path('%s' % image_path), 'rb') as png_file:
@@ -28,3 +45,164 @@ class TestImage(unittest.TestCase):
             png_file.seek(0)
             pil_image = PILImage.open(image.crop_image(png_file, [200, 200]))
             self.assertEqual((200, 200), pil_image.size)
+
+    def test_draft_jpeg(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            pil_image = PILImage.open(jpg_file)
+            image.draft_image(pil_image, (200, 200))
+            # 1600x1200 scaled by 1/4 is still more than twice the target size
+            self.assertEqual((400, 300), pil_image.size)
+
+    def test_draft_jpeg_cover(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            pil_image = PILImage.open(jpg_file)
+            image.draft_image(pil_image, (300, 300), cover=True)
+            self.assertEqual((800, 600), pil_image.size)
+
+    def test_draft_png_untouched(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            pil_image = PILImage.open(png_file)
+            image.draft_image(pil_image, (20, 20))
+            self.assertEqual((640, 480), pil_image.size)
+
+    def test_crop_jpeg_with_draft(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            pil_image = PILImage.open(image.crop_image(jpg_file, [250, 100]))
+            self.assertEqual((250, 100), pil_image.size)
+            jpg_file.seek(0)
+            pil_image = PILImage.open(image.fit_image(jpg_file, [250, 100]))
+            self.assertEqual((133, 100), pil_image.size)
+
+    def test_manipulated_images(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            specs = [('fit', (200, 200)), ('crop', (100, 100)), ('fit', (800, 800))]
+            sizes = [(mode, size, PILImage.open(binary).size)
+                     for mode, size, binary in image.manipulated_images(jpg_file, specs)]
+        self.assertEqual([('fit', (200, 200), (200, 150)),
+                          ('crop', (100, 100), (100, 100)),
+                          ('fit', (800, 800), (800, 600))], sizes)
+
+    def test_fit_image_output_extension(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            pil_image = PILImage.open(image.fit_image(jpg_file, [200, 200], output_extension='png'))
+            self.assertEqual(('PNG', (200, 150)), (pil_image.format, pil_image.size))
+            jpg_file.seek(0)
+            self.assertRaises(ValueError, image.crop_image, jpg_file, [200, 200], output_extension='txt')
+
+    def test_save_options(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            low = image.fit_image(jpg_file, [400, 400], save_options={'quality': 10}).getvalue()
+            jpg_file.seek(0)
+            high = image.fit_image(jpg_file, [400, 400], save_options={'quality': 95}).getvalue()
+        self.assertLess(len(low), len(high))
+
+    def _set_limits(self, max_pixels, max_decoded_bytes):
+        self.addCleanup(image.set_limits, image.MAX_PIXELS, image.MAX_DECODED_BYTES)
+        image.set_limits(max_pixels, max_decoded_bytes)
+
+    def test_png_over_memory_limit(self):
+        # 640x480 decoded as rgb needs 4 bytes per pixel, pngs can't be decoded at a reduced scale
+        self._set_limits(0, 640 * 480 * 4 - 1)
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            self.assertRaises(image.ImageTooLarge, image.fit_image, png_file, [10, 10])
+            png_file.seek(0)
+            self.assertRaises(image.ImageTooLarge, image.crop_image, png_file, [10, 10])
+            png_file.seek(0)
+            self.assertRaises(image.ImageTooLarge, image.check_image, png_file)
+
+    def test_jpeg_decoded_at_reduced_scale_within_memory_limit(self):
+        # the full 1600x1200 image needs ~7.7mb, fitting it into 200x200 decodes it at 400x300
+        self._set_limits(0, 1024 * 1024)
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            self.assertEqual((200, 150), PILImage.open(image.fit_image(jpg_file, [200, 200])).size)
+            jpg_file.seek(0)
+            self.assertRaises(image.ImageTooLarge, image.fit_image, jpg_file, [1000, 1000])
+            jpg_file.seek(0)
+            image.check_image(jpg_file)
+
+    def test_over_pixel_limit(self):
+        self._set_limits(640 * 480 - 1, 0)
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            self.assertRaises(image.ImageTooLarge, image.fit_image, png_file, [10, 10])
+            png_file.seek(0)
+            self.assertRaises(image.ImageTooLarge, list, image.manipulated_images(png_file, [('fit', (10, 10))]))
+
+    def _animated_gif(self, frames=3, size=(120, 90), loop=0):
+        """a square moving over a transparent background, shown 100, 200, ... ms per frame.
+           with loop=None it plays once.
+        """
+        pil_frames = []
+        for index in range(frames):
+            frame = PILImage.new('RGBA', size, (0, 0, 0, 0))
+            frame.paste((255, 0, 0, 255), (index * 30, 0, index * 30 + 30, 30))
+            pil_frames.append(frame)
+        binary = BytesIO()
+        loop_option = {} if loop is None else dict(loop=loop)
+        pil_frames[0].save(binary, 'GIF', save_all=True, append_images=pil_frames[1:],
+                           duration=[100 * (index + 1) for index in range(frames)], disposal=2, **loop_option)
+        binary.seek(0)
+        return binary
+
+    def _frames(self, binary):
+        pil_image = PILImage.open(binary)
+        frames = []
+        for index in range(pil_image.n_frames):
+            pil_image.seek(index)
+            pil_image.load()
+            frames.append((pil_image.size, pil_image.info['duration'], getattr(pil_image, 'disposal_method', None)))
+        return pil_image.format, frames
+
+    def test_fit_animated_gif(self):
+        binary = image.fit_image(self._animated_gif(), [60, 60], output_extension='gif')
+        self.assertEqual(('GIF', [((60, 45), 100, 2), ((60, 45), 200, 2), ((60, 45), 300, 2)]),
+                         self._frames(binary))
+        # the square moved along, without a trail of the earlier ones
+        pil_image = PILImage.open(binary)
+        pil_image.seek(2)
+        self.assertIsNone(pil_image.convert('RGBA').getchannel('A').crop((0, 0, 28, 45)).getbbox())
+
+    def test_fit_animated_gif_keeps_the_loop_count(self):
+        for loop in (None, 0, 3):
+            source = self._animated_gif(loop=loop)
+            self.assertEqual(loop, PILImage.open(source).info.get('loop'))
+            source.seek(0)
+            binary = image.fit_image(source, [60, 60], output_extension='gif')
+            self.assertEqual(loop, PILImage.open(binary).info.get('loop'))
+
+    @unittest.skipUnless(features.check('webp_anim'), 'needs pillow with animated webp')
+    def test_crop_animated_gif_to_webp(self):
+        binary = image.crop_image(self._animated_gif(), [40, 40], output_extension='webp')
+        self.assertEqual(('WEBP', [((40, 40), 100, None), ((40, 40), 200, None), ((40, 40), 300, None)]),
+                         self._frames(binary))
+
+    def test_manipulated_animated_images(self):
+        specs = [('fit', (60, 60)), ('crop', (20, 20))]
+        frames = [(mode, size, self._frames(binary)[1])
+                  for mode, size, binary in image.manipulated_images(self._animated_gif(), specs,
+                                                                      output_extension='gif')]
+        self.assertEqual([('fit', (60, 60), [((60, 45), 100, 2), ((60, 45), 200, 2), ((60, 45), 300, 2)]),
+                          ('crop', (20, 20), [((20, 20), 100, 2), ((20, 20), 200, 2), ((20, 20), 300, 2)])],
+                         frames)
+
+    def test_animation_resized_as_still(self):
+        # pngs can't store animations
+        self.assertEqual(1, PILImage.open(image.fit_image(self._animated_gif(), [60, 60],
+                                                          output_extension='png')).n_frames)
+
+    def test_animation_limits(self):
+        self.addCleanup(image.set_limits, image.MAX_PIXELS, image.MAX_DECODED_BYTES,
+                        image.MAX_FRAMES, image.MAX_ANIMATION_PIXELS)
+        image.set_limits(0, 0, 2, 0)
+        binary = image.fit_image(self._animated_gif(), [60, 60], output_extension='gif')
+        self.assertEqual(((60, 45), 1), (PILImage.open(binary).size, PILImage.open(binary).n_frames))
+        image.set_limits(0, 0, 0, 120 * 90 * 3 - 1)
+        binary = image.crop_image(self._animated_gif(), [20, 20], output_extension='gif')
+        self.assertEqual(1, PILImage.open(binary).n_frames)
+        image.set_limits(0, 0, 3, 120 * 90 * 3)
+        binary = image.crop_image(self._animated_gif(), [20, 20], output_extension='gif')
+        self.assertEqual(3, PILImage.open(binary).n_frames)
+
+    def test_megapixel_bucket(self):
+        self.assertEqual('0-1', metrics.megapixel_bucket((640, 480)))
+        self.assertEqual('1-4', metrics.megapixel_bucket((1600, 1200)))
+        self.assertEqual('64+', metrics.megapixel_bucket((10000, 10000)))
@@ -2,15 +2,24 @@ import unittest
 import os
 import shutil
 import json
+import time
+import threading
 try:
     from StringIO import StringIO as BytesIO  # TODO awful
 except ImportError:
     from io import BytesIO
 import base64
+import tarfile
+import zipfile
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 from PIL import Image as PILImage
 
 import image_service
+from image_service import signing
 
 
 class TestImageService(unittest.TestCase):
@@ -25,10 +34,30 @@ class TestImageService(unittest.TestCase):
         image_service.app.config['STORAGE_DIRECTORY'] = self.storage_directory
         image_service.app.config['AUTH_TOKEN'] = (self.origin, self.auth_token)
         image_service.app.config['AUTH_BASIC'] = (self.username, self.password)
+        image_service.app.config['ORIGINAL_MAX_AGE'] = 0
+        image_service.app.config['MANIPULATED_MAX_AGE'] = 0
         self.app = image_service.app.test_client()
         image_service._storage = None
 
     def tearDown(self):
+        image_service.app.config['DERIVATIVE_CACHE_BYTES'] = 0
+        image_service.app.config['PRESETS'] = []
+        image_service.app.config['SERVE_MODE'] = 'python'
+        image_service.app.config['STORAGE_BACKEND'] = 'filesystem'
+        image_service.app.config['NEGOTIATED_FORMATS'] = []
+        image_service.app.config['TIER_CACHE_DIRECTORY'] = ''
+        image_service.app.config['TIER_CACHE_BYTES'] = 1024 * 1024 * 1024
+        image_service.app.config['MAX_DECODED_BYTES'] = 512 * 1024 * 1024
+        image_service.app.config['OVERLOAD_PENDING'] = 0
+        image_service.app.config['OVERLOAD_RESPONSE'] = 'accepted'
+        image_service.app.config['METADATA_INDEX'] = False
+        image_service.app.config['ALLOWED_SIZES'] = []
+        image_service.app.config['SIZE_STEP'] = 0
+        image_service.app.config['MAX_WIDTH'] = 0
+        image_service.app.config['URL_SIGNING_KEY'] = ''
+        image_service.app.config['MAX_MANIPULATED_PER_IMAGE'] = 0
+        image_service.app.config['CONTENT_ADDRESSED'] = False
+        image_service._storage = None
         try:
             shutil.rmtree(self.storage_directory)
         except OSError:
@@ -63,6 +92,13 @@ class TestImageService(unittest.TestCase):
                             },
                             data={'file': (binary_image, image_name)})
 
+    def _delete_image(self, image_name):
+        return self.app.delete('/images/%s' % image_name,
+                               headers={
+                                   'Authorization': 'Token ' + self.auth_token,
+                                   'Origin': self.origin
+                               })
+
     def _get_image(self, image_name, image_extension, mode=None, size=None):
         resource_url = '/images/%s.%s' % (image_name, image_extension)
         if mode and size:
@@ -70,6 +106,23 @@ class TestImageService(unittest.TestCase):
         return self.app.get(resource_url)
 
 
+    def test_executors_created_once(self):
+        for getter, name in ((image_service.preset_executor, '_preset_executor'),
+                             (image_service.batch_executor, '_batch_executor')):
+            self.addCleanup(setattr, image_service, name, getattr(image_service, name))
+            setattr(image_service, name, None)
+
+            def slow_executor(max_workers):
+                time.sleep(0.05)
+                return mock.Mock()
+            with mock.patch.object(image_service, 'ThreadPoolExecutor', side_effect=slow_executor) as executor:
+                threads = [threading.Thread(target=getter) for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(1, executor.call_count)
+
     def test_create_storage(self):
         image_service.storage()
         self.assertTrue(os.path.isdir(self.storage_directory))
@@ -197,8 +250,533 @@ class TestImageService(unittest.TestCase):
         pil_image = PILImage.open(BytesIO(response.data))
         self.assertEqual((200, 200), pil_image.size)
 
+    def test_get_manipulated_animated_gif(self):
+        frames = [PILImage.new('RGB', (100, 80), color) for color in ('red', 'green', 'blue')]
+        animation = BytesIO()
+        frames[0].save(animation, 'GIF', save_all=True, append_images=frames[1:], duration=[50, 60, 70], loop=0)
+        animation.seek(0)
+        self.assertEqual(201, self._put_image(animation, 'animation.gif').status_code)
+        response = self._get_image('animation', 'gif', mode='fit', size=(50, 50))
+        self.assertEqual((200, 'image/gif'), (response.status_code, response.mimetype))
+        pil_image = PILImage.open(BytesIO(response.data))
+        durations = []
+        for index in range(pil_image.n_frames):
+            pil_image.seek(index)
+            durations.append(pil_image.info['duration'])
+        self.assertEqual(((50, 40), [50, 60, 70]), (pil_image.size, durations))
+
+    def test_size_policy(self):
+        image_service.app.config['SIZE_STEP'] = 50
+        image_service.app.config['MAX_WIDTH'] = 1000
+        image_service.app.config['MANIPULATED_MAX_AGE'] = 60
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        response = self._get_image('test_image', 'png', mode='fit', size=(101, 99))
+        self.assertEqual(302, response.status_code)
+        self.assertTrue(response.headers['Location'].endswith('/images/test_image@fit-150x100.png'))
+        self.assertIn('max-age=60', response.headers['Cache-Control'])
+        # not created
+        self.assertEqual([], image_service.storage().manipulated('test_image', 'png'))
+        self.assertEqual(302, self.app.get('/images/test_image@fit-0150x100.png').status_code)
+        self.assertEqual(200, self._get_image('test_image', 'png', mode='fit', size=(150, 100)).status_code)
+        self.assertEqual(404, self._get_image('test_image', 'png', mode='fit', size=(1001, 100)).status_code)
+        self.assertEqual(404, self._get_image('test_image', 'png', mode='fit', size=(0, 100)).status_code)
+
+    def test_allowed_sizes(self):
+        image_service.app.config['ALLOWED_SIZES'] = [(100, 100), (200, 200)]
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        response = self._get_image('test_image', 'png', mode='crop', size=(150, 20))
+        self.assertEqual(302, response.status_code)
+        self.assertTrue(response.headers['Location'].endswith('/images/test_image@crop-200x200.png'))
+        self.assertEqual(200, self._get_image('test_image', 'png', mode='crop', size=(200, 200)).status_code)
+
+    def _signed_url(self, name, extension, mode, size, expires=None):
+        return '/images/%s@%s-%dx%d.%s?%s' % (name, mode, size[0], size[1], extension, signing.signed_query(
+            'secret', name, extension, mode, size, expires))
+
+    def test_signed_urls(self):
+        image_service.app.config['URL_SIGNING_KEY'] = 'secret'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        self.assertEqual(403, self._get_image('test_image', 'png', mode='fit', size=(100, 100)).status_code)
+        self.assertEqual([], image_service.storage().manipulated('test_image', 'png'))
+        self.assertEqual(200, self.app.get(self._signed_url('test_image', 'png', 'fit', (100, 100))).status_code)
+        # stored images don't need a signature
+        self.assertEqual(200, self._get_image('test_image', 'png', mode='fit', size=(100, 100)).status_code)
+        expires = int(time.time()) + 60
+        self.assertEqual(200, self.app.get(self._signed_url('test_image', 'png', 'crop', (50, 50),
+                                                            expires)).status_code)
+
+    def test_invalid_signatures_dont_touch_the_storage(self):
+        image_service.app.config['URL_SIGNING_KEY'] = 'secret'
+        expired = int(time.time()) - 1
+        with mock.patch.object(image_service, 'storage', side_effect=AssertionError) as storage:
+            for url in ('/images/test_image@fit-100x100.png?sig=invalid',
+                        self._signed_url('test_image', 'png', 'fit', (100, 100)).replace('fit-100', 'fit-101'),
+                        self._signed_url('test_image', 'png', 'fit', (100, 100), expired),
+                        self._signed_url('test_image', 'png', 'fit', (100, 100), expired).replace(
+                            'expires=%d' % expired, 'expires=%d' % (expired + 120)),
+                        '/images/test_image@fit-100x100.png?sig=invalid&expires=never'):
+                self.assertEqual(403, self.app.get(url).status_code)
+            self.assertEqual(0, storage.call_count)
+
+    def test_signed_redirect(self):
+        image_service.app.config['URL_SIGNING_KEY'] = 'secret'
+        image_service.app.config['SIZE_STEP'] = 50
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        response = self.app.get(self._signed_url('test_image', 'png', 'fit', (101, 99)))
+        self.assertEqual(302, response.status_code)
+        location = response.headers['Location']
+        self.assertIn(self._signed_url('test_image', 'png', 'fit', (150, 100)), location)
+        self.assertEqual(200, self.app.get(location).status_code)
+
     def test_get_manipulated_invalid_mode(self):
         image_name = 'test_image'
         image_extension = 'png'
         response = self._get_image(image_name, image_extension, mode='nonsense', size=(200, 200))
         self.assertEqual(404, response.status_code)
+
+    def test_put_invalidates_cached_manipulated_image(self):
+        image_service.app.config['DERIVATIVE_CACHE_BYTES'] = 1024 * 1024
+        image_service._storage = None
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        response = self._get_image(image_name, image_extension, mode='fit', size=(200, 200))
+        self.assertEqual((200, 150), PILImage.open(BytesIO(response.data)).size)
+        rotated = BytesIO()
+        PILImage.open(self._test_image_path('png_image.png')).rotate(90, expand=True).save(rotated, 'PNG')
+        rotated.seek(0)
+        self._put_image(rotated, '%s.%s' % (image_name, image_extension))
+        response = self._get_image(image_name, image_extension, mode='fit', size=(200, 200))
+        self.assertEqual((150, 200), PILImage.open(BytesIO(response.data)).size)
+        stats = json.loads(self.app.get('/stats/cache').data.decode())
+        self.assertEqual(2, stats['misses'])
+
+    def test_memory_hit_served_without_the_file(self):
+        image_service.app.config['DERIVATIVE_CACHE_BYTES'] = 1024 * 1024
+        image_service._storage = None
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        created = self._get_image('test_image', 'png', mode='fit', size=(200, 200))
+        os.remove(image_service.storage().path('test_image', 'png', 'fit', (200, 200)))
+        response = self._get_image('test_image', 'png', mode='fit', size=(200, 200))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual((created.data, created.headers['ETag']), (response.data, response.headers['ETag']))
+
+    def test_max_manipulated_with_memory_cache(self):
+        image_service.app.config['DERIVATIVE_CACHE_BYTES'] = 1024 * 1024
+        image_service.app.config['MAX_MANIPULATED_PER_IMAGE'] = 1
+        image_service._storage = None
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_image:
+            self._put_image(jpg_image, 'test_image.jpg')
+        for size in ((100, 100), (150, 150), (100, 100)):
+            self.assertEqual(200, self._get_image('test_image', 'jpg', mode='fit', size=size).status_code)
+        # the evicted versions aren't served from memory either, versions created while
+        # another one is evicted are only cached on their next request
+        stats = json.loads(self.app.get('/stats/cache').data.decode())
+        self.assertEqual((0, 3, 0), (stats['hits'], stats['misses'], stats['entries']))
+        self.assertEqual(200, self._get_image('test_image', 'jpg', mode='fit', size=(100, 100)).status_code)
+        self.assertEqual(1, json.loads(self.app.get('/stats/cache').data.decode())['entries'])
+
+    def test_cache_stats_without_cache(self):
+        self.assertEqual(404, self.app.get('/stats/cache').status_code)
+
+    def test_tier_stats(self):
+        image_service.app.config['TIER_CACHE_DIRECTORY'] = os.path.join(self.storage_directory, 'tier')
+        image_service._storage = None
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        self._get_image(image_name, image_extension, mode='fit', size=(200, 200))
+        self._get_image(image_name, image_extension, mode='fit', size=(200, 200))
+        stats = json.loads(self.app.get('/stats/tiers').data.decode())
+        self.assertEqual((1, 1, 0.5), (stats['hits'], stats['misses'], stats['hit_ratio']))
+
+    def test_tier_evictions_with_memory_cache(self):
+        image_service.app.config['TIER_CACHE_DIRECTORY'] = os.path.join(self.storage_directory, 'tier')
+        image_service.app.config['TIER_CACHE_BYTES'] = 1
+        image_service.app.config['DERIVATIVE_CACHE_BYTES'] = 1024 * 1024
+        image_service._storage = None
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_image:
+            self._put_image(jpg_image, 'test_image.jpg')
+        for size in ((100, 100), (150, 150), (100, 100)):
+            self.assertEqual(200, self._get_image('test_image', 'jpg', mode='fit', size=size).status_code)
+        # every version has been evicted from the tier right away, and from memory with it
+        stats = json.loads(self.app.get('/stats/cache').data.decode())
+        self.assertEqual((0, 3, 0), (stats['hits'], stats['misses'], stats['entries']))
+
+    def test_tier_needs_python_serve_mode(self):
+        image_service.app.config['TIER_CACHE_DIRECTORY'] = os.path.join(self.storage_directory, 'tier')
+        image_service.app.config['SERVE_MODE'] = 'x-accel-redirect'
+        self.assertRaises(ValueError, image_service.storage)
+
+    def test_s3_needs_python_serve_mode(self):
+        image_service.app.config['STORAGE_BACKEND'] = 's3'
+        for serve_mode in ('x-accel-redirect', 'x-sendfile'):
+            image_service.app.config['SERVE_MODE'] = serve_mode
+            self.assertRaises(ValueError, image_service.storage)
+
+    def test_upload_too_large_image(self):
+        image_service.app.config['MAX_DECODED_BYTES'] = 1024
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            response = self._post_image(png_image, 'test_image.png')
+        self.assertEqual(413, response.status_code)
+        self.assertFalse(image_service.storage().exists('test_image', 'png'))
+
+    def test_manipulated_image_over_the_limits(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_image:
+            self._put_image(jpg_image, 'test_image.jpg')
+        # accepted with the limits at the upload, like originals stored before lower limits
+        self.addCleanup(image_service.image.set_limits, image_service.image.MAX_PIXELS,
+                        image_service.image.MAX_DECODED_BYTES)
+        image_service.app.config['MAX_DECODED_BYTES'] = 1024 * 1024
+        image_service._storage = None
+        self.assertEqual(200, self._get_image('test_image', 'jpg', mode='fit', size=(200, 200)).status_code)
+        response = self._get_image('test_image', 'jpg', mode='fit', size=(1000, 1000))
+        self.assertEqual((422, 'no-store'), (response.status_code, response.headers['Cache-Control']))
+
+    def test_upload_header_after_first_chunk(self):
+        # the icc profile comes before the frame header and is larger than a chunk
+        jpg_image = BytesIO()
+        PILImage.open(self._test_image_path('jpg_image.jpg')).save(jpg_image, 'JPEG', icc_profile=b'x' * 200000)
+        response = self._post_image(BytesIO(jpg_image.getvalue()), 'test_image.jpg')
+        self.assertEqual(201, response.status_code)
+        with image_service.storage().get('test_image', 'jpg') as image_file:
+            self.assertEqual(jpg_image.getvalue(), image_file.read())
+
+    def _batch_headers(self):
+        return {'Authorization': 'Token ' + self.auth_token, 'Origin': self.origin}
+
+    def _image_data(self, image_name):
+        with open(self._test_image_path(image_name), 'rb') as image_file:
+            return image_file.read()
+
+    def test_batch_upload_multipart(self):
+        response = self.app.post('/images/batch', content_type='multipart/form-data', headers=self._batch_headers(),
+                                 data={'file': [(BytesIO(self._image_data('png_image.png')), 'first.png'),
+                                                (BytesIO(self._image_data('jpg_image.jpg')), 'second.jpg'),
+                                                (BytesIO(b'no image'), 'third.png'),
+                                                (BytesIO(self._image_data('png_image.png')), 'first.png')]})
+        self.assertEqual(200, response.status_code)
+        results = json.loads(response.data.decode())['results']
+        self.assertEqual([201, 201, 400, 201], [result['code'] for result in results])
+        self.assertEqual(['ok', 'ok', 'fail', 'ok'], [result['status'] for result in results])
+        self.assertEqual('/images/second.jpg', results[1]['url'])
+        # both are stored concurrently
+        self.assertEqual(['/images/first-1.png', '/images/first.png'], sorted([results[0]['url'], results[3]['url']]))
+        self.assertTrue(image_service.storage().exists('second', 'jpg'))
+
+    def test_batch_upload_tar(self):
+        body = BytesIO()
+        with tarfile.open(fileobj=body, mode='w|gz') as archive:
+            for name in ('images/first.png', 'second.png'):
+                data = self._image_data('png_image.png')
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, BytesIO(data))
+        response = self.app.post('/images/batch', content_type='application/x-tar', headers=self._batch_headers(),
+                                 data=body.getvalue())
+        results = json.loads(response.data.decode())['results']
+        self.assertEqual([('first.png', 201), ('second.png', 201)], [(r['file'], r['code']) for r in results])
+        self.assertTrue(image_service.storage().exists('first', 'png'))
+
+    def test_batch_upload_corrupt_tar(self):
+        body = BytesIO()
+        with tarfile.open(fileobj=body, mode='w') as archive:
+            for name in ('one.png', 'two.png'):
+                data = self._image_data('png_image.png')
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, BytesIO(data))
+        # ends in the middle of two.png
+        truncated = body.getvalue()[:512 + len(self._image_data('png_image.png')) + 1024]
+        response = self.app.post('/images/batch', content_type='application/x-tar', headers=self._batch_headers(),
+                                 data=truncated)
+        self.assertEqual(200, response.status_code)
+        results = json.loads(response.data.decode())['results']
+        self.assertEqual([('one.png', 201), (None, 400)], [(r['file'], r['code']) for r in results])
+        self.assertEqual('The tar archive is corrupt.', results[1]['message'])
+        # stored before the response is sent
+        self.assertTrue(image_service.storage().exists('one', 'png'))
+        self.assertFalse(image_service.storage().exists('two', 'png'))
+
+    def test_batch_upload_zip(self):
+        body = BytesIO()
+        with zipfile.ZipFile(body, 'w') as archive:
+            archive.writestr('first.jpg', self._image_data('jpg_image.jpg'))
+            archive.writestr('notes.txt', b'no image')
+        response = self.app.post('/images/batch', content_type='application/zip', headers=self._batch_headers(),
+                                 data=body.getvalue())
+        results = json.loads(response.data.decode())['results']
+        self.assertEqual([('first.jpg', 201), ('notes.txt', 400)], [(r['file'], r['code']) for r in results])
+        self.assertEqual(400, self.app.post('/images/batch', content_type='application/zip',
+                                            headers=self._batch_headers(), data=b'corrupt').status_code)
+
+    def test_batch_requires_auth(self):
+        self.assertEqual(401, self.app.post('/images/batch').status_code)
+        self.assertEqual(401, self.app.delete('/images/batch').status_code)
+
+    def test_batch_delete(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        response = self.app.delete('/images/batch', headers=self._batch_headers(),
+                                   data=json.dumps({'files': ['test_image.png', 'missing.png', 'no_extension']}),
+                                   content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        results = json.loads(response.data.decode())['results']
+        self.assertEqual([200, 404, 400], [result['code'] for result in results])
+        self.assertFalse(image_service.storage().exists('test_image', 'png'))
+        self.assertEqual(400, self.app.delete('/images/batch', headers=self._batch_headers()).status_code)
+
+    def test_failed_upload_releases_name(self):
+        image_service.app.config['CONTENT_ADDRESSED'] = True
+        with mock.patch.object(image_service.ContentAddressedStorage, '_link', side_effect=IOError('disk full')):
+            with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+                self.assertEqual(500, self._post_image(png_image, 'test_image.png').status_code)
+        # no empty image is left behind
+        self.assertFalse(image_service.storage().exists('test_image', 'png'))
+
+    def test_upload_no_image(self):
+        response = self._post_image(BytesIO(b'no image'), 'test_image.png')
+        self.assertEqual(400, response.status_code)
+
+    @unittest.skipIf(not image_service.metrics.prometheus_client, 'needs prometheus_client')
+    def test_metrics(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        self._get_image('test_image', 'png', mode='fit', size=(200, 200))
+        self._get_image('test_image', 'png', mode='fit', size=(200, 200))
+        response = self.app.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        data = response.data.decode()
+        for stage in ('request', 'path', 'read', 'decode', 'resample', 'encode', 'save', 'send'):
+            self.assertIn('image_service_stage_seconds_count{stage="%s"}' % stage, data)
+        self.assertIn('image_service_derivative_requests_total{mode="fit",result="miss"}', data)
+        self.assertIn('image_service_derivative_requests_total{mode="fit",result="hit"}', data)
+        self.assertIn('image_service_resize_seconds_count{megapixels="0-1"}', data)
+        self.assertIn('image_service_served_bytes_total', data)
+
+    def _overload(self):
+        image_service.app.config['OVERLOAD_PENDING'] = 1
+        image_service.storage()
+        image_service._resize_executor.pending = 1
+
+    def _wait_for_background_jobs(self):
+        image_service.preset_executor().shutdown(wait=True)
+        image_service._preset_executor = None
+
+    def test_overload_accepted(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        self.assertEqual(200, self._get_image('test_image', 'png', mode='fit', size=(100, 100)).status_code)
+        self._overload()
+        response = self._get_image('test_image', 'png', mode='fit', size=(200, 200))
+        self.assertEqual(202, response.status_code)
+        self.assertEqual('2', response.headers['Retry-After'])
+        self.assertEqual('no-store', response.headers['Cache-Control'])
+        # hits are served as usual
+        self.assertEqual(200, self._get_image('test_image', 'png', mode='fit', size=(100, 100)).status_code)
+        self.assertEqual(404, self._get_image('missing', 'png', mode='fit', size=(200, 200)).status_code)
+        self.assertEqual(404, self._get_image('test_image', 'png', mode='foo', size=(200, 200)).status_code)
+        self._wait_for_background_jobs()
+        response = self._get_image('test_image', 'png', mode='fit', size=(200, 200))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(200, PILImage.open(BytesIO(response.data)).size[0])
+        self.assertIn('image_service_overload_responses_total{response="accepted"}',
+                      self.app.get('/metrics').data.decode())
+
+    def test_overload_nearest(self):
+        image_service.app.config['OVERLOAD_RESPONSE'] = 'nearest'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        for size in ((400, 200), (200, 100), (50, 25)):
+            self._get_image('test_image', 'png', mode='crop', size=size)
+        self._overload()
+        response = self._get_image('test_image', 'png', mode='crop', size=(100, 50))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('/images/test_image@crop-200x100.png', response.headers['Content-Location'])
+        self.assertEqual('no-store', response.headers['Cache-Control'])
+        self.assertEqual((200, 100), PILImage.open(BytesIO(response.data)).size)
+        # no stored version with the same aspect ratio
+        self.assertEqual(202, self._get_image('test_image', 'png', mode='crop', size=(100, 100)).status_code)
+        self._wait_for_background_jobs()
+        self.assertEqual(200, self._get_image('test_image', 'png', mode='crop', size=(100, 50)).status_code)
+        self.assertIn('image_service_overload_responses_total{response="nearest"}',
+                      self.app.get('/metrics').data.decode())
+
+    def test_overload_background_queue_full(self):
+        image_service.app.config['BACKGROUND_QUEUE_SIZE'] = 1
+        self.addCleanup(image_service.app.config.__setitem__, 'BACKGROUND_QUEUE_SIZE', 256)
+        self.addCleanup(image_service._background_jobs.clear)
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        self._overload()
+        # the queued job doesn't start
+        with mock.patch.object(image_service, 'preset_executor'):
+            self.assertEqual(202, self._get_image('test_image', 'png', mode='fit', size=(200, 200)).status_code)
+            # already queued
+            self.assertEqual(202, self._get_image('test_image', 'png', mode='fit', size=(200, 200)).status_code)
+            self.assertEqual(503, self._get_image('test_image', 'png', mode='fit', size=(100, 100)).status_code)
+        stats = json.loads(self.app.get('/stats/background').data.decode())
+        self.assertEqual((1, 1, 1), (stats['jobs'], stats['max_jobs'], stats['resize_pending']))
+        if image_service.metrics.prometheus_client:
+            self.assertIn('image_service_overload_responses_total{response="rejected"}',
+                          self.app.get('/metrics').data.decode())
+
+    def test_index_stats(self):
+        self.assertEqual(404, self.app.get('/stats/index').status_code)
+        image_service.app.config['METADATA_INDEX'] = True
+        image_service._storage = None
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, 'test_image.png')
+        self.assertEqual(200, self._get_image('test_image', 'png', mode='fit', size=(100, 100)).status_code)
+        stats = json.loads(self.app.get('/stats/index').data.decode())
+        self.assertEqual(1, stats['originals'])
+        self.assertEqual(1, stats['manipulated'])
+
+    def test_tier_stats_without_tiers(self):
+        self.assertEqual(404, self.app.get('/stats/tiers').status_code)
+
+    def test_upload_creates_presets(self):
+        image_service.app.config['PRESETS'] = [('fit', (200, 200)), ('crop', (100, 100))]
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            response = self._post_image(png_image, '%s.%s' % (image_name, image_extension))
+            self.assertEqual(201, response.status_code)
+        image_service.preset_executor().shutdown(wait=True)
+        image_service._preset_executor = None
+        self.assertTrue(image_service.storage().exists(image_name, image_extension, 'fit', (200, 200)))
+        self.assertTrue(image_service.storage().exists(image_name, image_extension, 'crop', (100, 100)))
+
+    def test_delete_image(self):
+        image_service.app.config['DERIVATIVE_CACHE_BYTES'] = 1024 * 1024
+        image_service._storage = None
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        self.assertEqual(200, self._get_image(image_name, image_extension, mode='fit', size=(200, 200)).status_code)
+        response = self._delete_image('%s.%s' % (image_name, image_extension))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(404, self._get_image(image_name, image_extension, mode='fit', size=(200, 200)).status_code)
+        self.assertEqual(404, self._delete_image('%s.%s' % (image_name, image_extension)).status_code)
+
+    def test_conditional_get_image(self):
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        response = self._get_image(image_name, image_extension)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        self.assertEqual('no-cache', response.headers.get('Cache-Control'))
+        with mock.patch.object(image_service.storage(), 'get') as get:
+            response = self.app.get('/images/%s.%s' % (image_name, image_extension),
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(b'', response.data)
+            response = self.app.get('/images/%s.%s' % (image_name, image_extension),
+                                    headers={'If-Modified-Since': last_modified})
+            self.assertEqual(304, response.status_code)
+            self.assertFalse(get.called)
+        response = self.app.get('/images/%s.%s' % (image_name, image_extension),
+                                headers={'If-None-Match': '"other"'})
+        self.assertEqual(200, response.status_code)
+
+    def test_conditional_get_manipulated_image(self):
+        image_service.app.config['MANIPULATED_MAX_AGE'] = 3600
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        created = self._get_image(image_name, image_extension, mode='fit', size=(200, 200))
+        self.assertEqual('public, max-age=3600', created.headers['Cache-Control'])
+        served = self._get_image(image_name, image_extension, mode='fit', size=(200, 200))
+        self.assertEqual(created.headers['ETag'], served.headers['ETag'])
+        response = self.app.get('/images/%s@fit-200x200.%s' % (image_name, image_extension),
+                                headers={'If-None-Match': created.headers['ETag']})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('public, max-age=3600', response.headers['Cache-Control'])
+        # a new original means new manipulated images
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        response = self.app.get('/images/%s@fit-200x200.%s' % (image_name, image_extension),
+                                headers={'If-None-Match': created.headers['ETag']})
+        self.assertEqual(200, response.status_code)
+
+    def test_range_request(self):
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            png_data = png_image.read()
+        self._put_image(BytesIO(png_data), '%s.%s' % (image_name, image_extension))
+        response = self.app.get('/images/%s.%s' % (image_name, image_extension), headers={'Range': 'bytes=10-19'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(png_data[10:20], response.data)
+        self.assertEqual('bytes 10-19/%d' % len(png_data), response.headers['Content-Range'])
+        response = self.app.get('/images/%s@fit-200x200.%s' % (image_name, image_extension),
+                                headers={'Range': 'bytes=0-7'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'\x89PNG\r\n\x1a\n', response.data)
+
+    def test_x_accel_redirect(self):
+        image_service.app.config['SERVE_MODE'] = 'x-accel-redirect'
+        image_service.app.config['X_ACCEL_PREFIX'] = '/protected/'
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        response = self._get_image(image_name, image_extension)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'', response.data)
+        self.assertEqual('/protected/test_image.png', response.headers['X-Accel-Redirect'])
+        self.assertEqual('image/png', response.headers['Content-Type'])
+        self.assertIn('ETag', response.headers)
+        response = self._get_image(image_name, image_extension, mode='crop', size=(200, 200))
+        self.assertEqual('/protected/_test_image.png/crop-200x200.png', response.headers['X-Accel-Redirect'])
+        self.assertTrue(image_service.storage().exists(image_name, image_extension, 'crop', (200, 200)))
+
+    def test_x_sendfile(self):
+        image_service.app.config['SERVE_MODE'] = 'x-sendfile'
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        response = self._get_image(image_name, image_extension)
+        self.assertEqual(os.path.join(self.storage_directory, 'test_image.png'), response.headers['X-Sendfile'])
+        self.assertEqual(404, self._get_image('missing', image_extension).status_code)
+
+    def test_negotiate_webp(self):
+        image_service.app.config['NEGOTIATED_FORMATS'] = ['avif', 'webp']
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        url = '/images/%s@fit-200x200.%s' % (image_name, image_extension)
+        response = self.app.get(url, headers={'Accept': 'image/webp,image/*,*/*;q=0.8'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/webp', response.headers['Content-Type'])
+        self.assertEqual('Accept', response.headers['Vary'])
+        pil_image = PILImage.open(BytesIO(response.data))
+        self.assertEqual(('WEBP', (200, 150)), (pil_image.format, pil_image.size))
+        self.assertTrue(os.path.isfile(os.path.join(self.storage_directory, '_test_image.png', 'fit-200x200.webp')))
+        response = self.app.get(url, headers={'Accept': 'image/*,*/*;q=0.8'})
+        self.assertEqual('image/png', response.headers['Content-Type'])
+        self.assertEqual('Accept', response.headers['Vary'])
+        self.assertEqual('PNG', PILImage.open(BytesIO(response.data)).format)
+
+    def test_no_negotiation_by_default(self):
+        image_name = 'test_image'
+        image_extension = 'png'
+        with open(self._test_image_path('png_image.png'), 'rb') as png_image:
+            self._put_image(png_image, '%s.%s' % (image_name, image_extension))
+        response = self.app.get('/images/%s@fit-200x200.%s' % (image_name, image_extension),
+                                headers={'Accept': 'image/webp'})
+        self.assertEqual('image/png', response.headers['Content-Type'])
+        self.assertNotIn('Vary', response.headers)
@@ -0,0 +1,60 @@
+import unittest
+import os
+import os.path as op
+import shutil
+
+from image_service.migrate import migrate
+from image_service.storage import FileSystemStorage, ContentAddressedStorage
+
+
+class TestMigrate(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = op.join(op.dirname(op.dirname(op.realpath(__file__))), 'test_storage')
+        with open(op.join(op.dirname(op.realpath(__file__)), 'test_images', 'png_image.png'), 'rb') as png_file:
+            self.png_data = png_file.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_dir)
+
+    def _fill(self, storage):
+        for name in ('first', 'second', 'third'):
+            storage.save(name, 'png', self.png_data)
+            storage.get(name, 'png', 'fit', (100, 100)).close()
+        self.assertEqual('first-1', storage.safe_name('first', 'png'))
+
+    def _check(self, storage, safe_name='first-2'):
+        for name in ('first', 'second', 'third'):
+            with storage.get(name, 'png') as image_file:
+                self.assertEqual(self.png_data, image_file.read())
+            self.assertTrue(storage.exists(name, 'png', 'fit', (100, 100)))
+        self.assertEqual(safe_name, storage.safe_name('first', 'png'))
+
+    def test_flat_to_sharded_and_back(self):
+        self._fill(FileSystemStorage(self.storage_dir))
+        moves = migrate(self.storage_dir, True)
+        self.assertTrue(moves)
+        storage = FileSystemStorage(self.storage_dir, sharded=True)
+        self._check(storage)
+        for entry in os.listdir(self.storage_dir):
+            self.assertRegex(entry, r'^(\.names|[0-9a-f]{2})$')
+        migrate(self.storage_dir, False)
+        self._check(FileSystemStorage(self.storage_dir), 'first-3')
+        self.assertFalse([entry for entry in os.listdir(self.storage_dir) if len(entry) == 2])
+        # nothing left to do
+        self.assertEqual([], migrate(self.storage_dir, False))
+
+    def test_dry_run(self):
+        self._fill(FileSystemStorage(self.storage_dir))
+        entries = sorted(os.listdir(self.storage_dir))
+        self.assertTrue(migrate(self.storage_dir, True, dry_run=True))
+        self.assertEqual(entries, sorted(os.listdir(self.storage_dir)))
+
+    def test_content_addressed(self):
+        self._fill(ContentAddressedStorage(self.storage_dir))
+        migrate(self.storage_dir, True)
+        storage = ContentAddressedStorage(self.storage_dir, sharded=True)
+        self._check(storage)
+        storage.delete('first', 'png')
+        storage.delete('second', 'png')
+        storage.delete('third', 'png')
+        self.assertFalse(any(files for _, _, files in os.walk(op.join(self.storage_dir, '.blobs'))))
@@ -0,0 +1,32 @@
+import unittest
+
+from image_service.policy import SizePolicy
+
+
+class TestSizePolicy(unittest.TestCase):
+    def test_no_limits(self):
+        policy = SizePolicy()
+        self.assertEqual((123, 45), policy.canonical_size((123, 45)))
+        self.assertIsNone(policy.canonical_size((0, 45)))
+        self.assertIsNone(policy.canonical_size((-1, 45)))
+
+    def test_allowed_sizes(self):
+        policy = SizePolicy([(400, 300), (100, 100), (200, 200)])
+        self.assertEqual((100, 100), policy.canonical_size((100, 100)))
+        self.assertEqual((100, 100), policy.canonical_size((20, 50)))
+        self.assertEqual((200, 200), policy.canonical_size((101, 100)))
+        self.assertEqual((400, 300), policy.canonical_size((250, 100)))
+        # larger than all of them
+        self.assertEqual((400, 300), policy.canonical_size((2000, 2000)))
+
+    def test_step(self):
+        policy = SizePolicy(step=50)
+        self.assertEqual((100, 50), policy.canonical_size((100, 50)))
+        self.assertEqual((150, 50), policy.canonical_size((101, 1)))
+
+    def test_max_size(self):
+        policy = SizePolicy(step=300, max_size=(1000, 0))
+        self.assertEqual((1000, 600), policy.canonical_size((999, 599)))
+        self.assertEqual((1000, 3000), policy.canonical_size((1000, 2999)))
+        self.assertIsNone(policy.canonical_size((1001, 100)))
+        self.assertIsNone(SizePolicy([(100, 100)], max_size=(50, 50)).canonical_size((60, 10)))
@@ -0,0 +1,112 @@
+import unittest
+import os.path as op
+from io import BytesIO
+
+from PIL import Image as PILImage
+from werkzeug.exceptions import NotFound
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    boto3 = None
+
+from image_service.s3 import S3Storage
+
+
+@unittest.skipIf(boto3 is None, 'needs boto3 and moto')
+class TestS3Storage(unittest.TestCase):
+    """runs the storage API against a mocked s3 bucket"""
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='images')
+        self.client = client
+        self.storage = S3Storage('images', 'test/', client=client)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def _test_image_data(self, image_name):
+        with open(op.join(op.dirname(op.realpath(__file__)), 'test_images', image_name), 'rb') as image_file:
+            return image_file.read()
+
+    def _keys(self):
+        return sorted(item['Key'] for item in self.client.list_objects_v2(Bucket='images').get('Contents', ()))
+
+    def test_save_and_get(self):
+        data = self._test_image_data('jpg_image.jpg')
+        self.storage.save('jpg_image', 'jpg', data)
+        self.assertTrue(self.storage.exists('jpg_image', 'jpg'))
+        image_file = self.storage.get('jpg_image', 'jpg')
+        self.assertEqual(image_file.read(), data)
+        self.assertEqual(image_file.stat.st_size, len(data))
+        self.assertEqual(self.storage.stat('jpg_image', 'jpg').st_size, len(data))
+        self.assertEqual(self._keys(), ['test/jpg_image.jpg'])
+
+    def test_save_stream(self):
+        data = self._test_image_data('jpg_image.jpg')
+        self.storage.save_stream('jpg_image', 'jpg', BytesIO(data))
+        self.assertEqual(self.storage.get('jpg_image', 'jpg').read(), data)
+
+    def test_get_missing(self):
+        self.assertFalse(self.storage.exists('missing', 'jpg'))
+        self.assertRaises(NotFound, self.storage.get, 'missing', 'jpg')
+        self.assertRaises(NotFound, self.storage.get, 'missing', 'jpg', 'fit', (50, 50))
+        self.assertRaises(NotFound, self.storage.stat, 'missing', 'jpg')
+
+    def test_create_manipulated_on_get(self):
+        self.storage.save('jpg_image', 'jpg', self._test_image_data('jpg_image.jpg'))
+        image_file = self.storage.get('jpg_image', 'jpg', 'crop', (50, 40))
+        self.assertEqual(PILImage.open(image_file).size, (50, 40))
+        self.assertTrue(self.storage.exists('jpg_image', 'jpg', 'crop', (50, 40)))
+        self.assertIn('test/_jpg_image.jpg/crop-50x40.jpg', self._keys())
+        webp_file = self.storage.get('jpg_image', 'jpg', 'fit', (50, 50), 'webp')
+        self.assertEqual(PILImage.open(webp_file).format, 'WEBP')
+
+    def test_dimensions(self):
+        self.storage.save('jpg_image', 'jpg', self._test_image_data('jpg_image.jpg'))
+        self.assertEqual((1600, 1200), self.storage.dimensions('jpg_image', 'jpg'))
+        self.assertRaises(NotFound, self.storage.dimensions, 'missing', 'jpg')
+
+    def test_create_manipulated(self):
+        self.storage.save('png_image', 'png', self._test_image_data('png_image.png'))
+        self.storage.create_manipulated('png_image', 'png', [('fit', (20, 20)), ('crop', (10, 10))])
+        self.assertTrue(self.storage.exists('png_image', 'png', 'fit', (20, 20)))
+        self.assertTrue(self.storage.exists('png_image', 'png', 'crop', (10, 10)))
+
+    def test_manipulated(self):
+        self.storage.save('jpg_image', 'jpg', self._test_image_data('jpg_image.jpg'))
+        self.storage.get('jpg_image', 'jpg', 'crop', (50, 40))
+        self.assertEqual([('crop', (50, 40), 'jpg')], self.storage.manipulated('jpg_image', 'jpg'))
+        self.assertEqual([], self.storage.manipulated('missing', 'jpg'))
+
+    def test_replace_original_deletes_manipulated(self):
+        data = self._test_image_data('jpg_image.jpg')
+        self.storage.save('jpg_image', 'jpg', data)
+        self.storage.get('jpg_image', 'jpg', 'fit', (50, 50))
+        self.storage.save('jpg_image', 'jpg', data)
+        self.assertFalse(self.storage.exists('jpg_image', 'jpg', 'fit', (50, 50)))
+
+    def test_delete(self):
+        self.storage.save('jpg_image', 'jpg', self._test_image_data('jpg_image.jpg'))
+        self.storage.get('jpg_image', 'jpg', 'fit', (50, 50))
+        self.storage.delete('jpg_image', 'jpg')
+        self.assertEqual(self._keys(), [])
+        self.assertRaises(NotFound, self.storage.delete, 'jpg_image', 'jpg')
+
+    def test_safe_name(self):
+        self.assertEqual(self.storage.safe_name('image', 'jpg'), 'image')
+        self.assertEqual(self.storage.safe_name('image', 'jpg'), 'image-1')
+        self.storage.save('other', 'jpg', self._test_image_data('jpg_image.jpg'))
+        self.assertEqual(self.storage.safe_name('other', 'jpg'), 'other-1')
+
+    def test_release_name(self):
+        name = self.storage.safe_name('jpg_image', 'jpg')
+        self.storage.release_name(name, 'jpg')
+        self.assertFalse(self.storage.exists(name, 'jpg'))
+        self.storage.save(name, 'jpg', self._test_image_data('jpg_image.jpg'))
+        self.storage.release_name(name, 'jpg')
+        self.assertTrue(self.storage.exists(name, 'jpg'))
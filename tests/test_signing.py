@@ -0,0 +1,32 @@
+import time
+import unittest
+
+from image_service import signing
+
+
+class TestSigning(unittest.TestCase):
+    def test_check_signature(self):
+        signature = signing.signature('key', 'image', 'jpg', 'fit', (100, 50))
+        self.assertTrue(signing.check_signature('key', signature, 'image', 'jpg', 'fit', (100, 50)))
+        self.assertFalse(signing.check_signature('other', signature, 'image', 'jpg', 'fit', (100, 50)))
+        self.assertFalse(signing.check_signature('key', signature, 'image', 'jpg', 'fit', (100, 51)))
+        self.assertFalse(signing.check_signature('key', signature, 'image', 'jpg', 'crop', (100, 50)))
+        self.assertFalse(signing.check_signature('key', signature, 'image', 'png', 'fit', (100, 50)))
+        self.assertFalse(signing.check_signature('key', signature, 'image', 'jpg', 'fit', (100, 50), 2 ** 40))
+        self.assertFalse(signing.check_signature('key', signature[:-1], 'image', 'jpg', 'fit', (100, 50)))
+        self.assertFalse(signing.check_signature('key', u'\xe4' + signature[1:], 'image', 'jpg', 'fit', (100, 50)))
+
+    def test_expires(self):
+        expires = int(time.time()) + 60
+        signature = signing.signature('key', 'image', 'jpg', 'fit', (100, 50), expires)
+        self.assertTrue(signing.check_signature('key', signature, 'image', 'jpg', 'fit', (100, 50), expires))
+        self.assertFalse(signing.check_signature('key', signature, 'image', 'jpg', 'fit', (100, 50)))
+        expired = int(time.time()) - 1
+        signature = signing.signature('key', 'image', 'jpg', 'fit', (100, 50), expired)
+        self.assertFalse(signing.check_signature('key', signature, 'image', 'jpg', 'fit', (100, 50), expired))
+
+    def test_signed_query(self):
+        signature = signing.signature('key', 'image', 'jpg', 'fit', (100, 50), 123)
+        self.assertEqual('sig=%s&expires=123' % signature,
+                         signing.signed_query('key', 'image', 'jpg', 'fit', (100, 50), 123))
+        self.assertNotIn('=', signature)
@@ -1,11 +1,20 @@
 import unittest
+import os
 import os.path as op
+import hashlib
 import shutil
+import threading
+from io import BytesIO
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
-from PIL import Image as PILImage
+from PIL import Image as PILImage, ImageChops, ImageStat
 from werkzeug.exceptions import NotFound
 
-from image_service.storage import FileSystemStorage
+from image_service import image
+from image_service.storage import FileSystemStorage, ContentAddressedStorage, TieredStorage
 
 
 class TestFileSystemStorage(unittest.TestCase):
@@ -25,6 +34,9 @@ class TestFileSystemStorage(unittest.TestCase):
         current_dir = op.dirname(op.realpath(__file__))
         return op.join(current_dir, 'test_images', image_name)
 
+    def _storage_entries(self):
+        return os.listdir(self.storage_dir)
+
     def test_create_storage_dir(self):
         self.assertTrue(op.exists(self.storage_dir))
 
@@ -165,3 +177,500 @@ class TestFileSystemStorage(unittest.TestCase):
             self.storage.save(safe_name, image_extension, png_file.read())
         safe_name = self.storage.safe_name(image_name, image_extension)
         self.assertEqual('%s-2' % image_name, safe_name)
+
+    def test_get_manipulated_of_missing_original(self):
+        self.assertRaises(NotFound, self.storage.get, 'missing', 'png', 'fit', (1, 1))
+        # nothing is created for it
+        self.assertEqual([], self._storage_entries())
+
+    def test_concurrent_get_creates_once(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
+            self.storage.save(image_name, image_extension, png_file.read())
+        sizes = []
+        with mock.patch.object(image, 'fit_image', wraps=image.fit_image) as fit_image:
+            def get():
+                with self.storage.get(image_name, image_extension, 'fit', (200, 200)) as image_file:
+                    sizes.append(PILImage.open(image_file).size)
+            threads = [threading.Thread(target=get) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(1, fit_image.call_count)
+        self.assertEqual([(200, 150)] * 8, sizes)
+        # the lock files are removed again
+        self.assertEqual(['fit-200x200.png'],
+                         os.listdir(op.join(self.storage_dir, '_%s.%s' % (image_name, image_extension))))
+
+    def test_save_leaves_no_temp_files(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
+            self.storage.save(image_name, image_extension, png_file.read())
+            png_file.seek(0)
+            self.storage.save(image_name, image_extension, png_file.read())
+        self.assertEqual(['%s.%s' % (image_name, image_extension)], self._storage_entries())
+
+    def test_created_image_served_from_memory(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
+            self.storage.save(image_name, image_extension, png_file.read())
+        created = self.storage.get(image_name, image_extension, 'fit', (200, 200))
+        with self.storage.get(image_name, image_extension, 'fit', (200, 200)) as image_file:
+            self.assertEqual(image_file.read(), created.read())
+
+    def test_create_manipulated(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
+            self.storage.save(image_name, image_extension, png_file.read())
+        self.storage.get(image_name, image_extension, 'fit', (200, 200))
+        with mock.patch.object(image.Image, 'open', wraps=image.Image.open) as pil_open:
+            self.storage.create_manipulated(image_name, image_extension,
+                                            [('fit', (200, 200)), ('crop', (100, 100)), ('fit', (50, 50))])
+            self.assertEqual(1, pil_open.call_count)
+        self.assertTrue(self.storage.exists(image_name, image_extension, 'crop', (100, 100)))
+        self.assertTrue(self.storage.exists(image_name, image_extension, 'fit', (50, 50)))
+        with mock.patch.object(image.Image, 'open', wraps=image.Image.open) as pil_open:
+            self.storage.create_manipulated(image_name, image_extension, [('fit', (50, 50))])
+            self.assertEqual(0, pil_open.call_count)
+
+    def test_manipulated(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            self.storage.save('png_image', 'png', png_file.read())
+        self.assertEqual([], self.storage.manipulated('png_image', 'png'))
+        self.assertEqual([], self.storage.manipulated('missing', 'png'))
+        self.storage.get('png_image', 'png', 'fit', (200, 100)).close()
+        self.storage.get('png_image', 'png', 'crop', (50, 50), 'webp').close()
+        self.assertEqual([('crop', (50, 50), 'webp'), ('fit', (200, 100), 'png')],
+                         sorted(self.storage.manipulated('png_image', 'png')))
+
+    def test_manipulated_from_stored_version(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            self.storage.save('jpg_image', 'jpg', jpg_file.read())
+        self.storage.get('jpg_image', 'jpg', 'fit', (800, 800)).close()
+        with mock.patch.object(image, 'manipulate_file', wraps=image.manipulate_file) as manipulate_file:
+            for mode, size in (('fit', (300, 300)), ('crop', (300, 300)), ('crop', (100, 50))):
+                with self.storage.get('jpg_image', 'jpg', mode, size) as image_file:
+                    from_stored = PILImage.open(image_file).convert('RGB')
+                from_original = PILImage.open(image.manipulate_file(self.storage.path('jpg_image', 'jpg'),
+                                                                    mode, size)).convert('RGB')
+                self.assertEqual(from_original.size, from_stored.size)
+                # only one more jpeg generation, a few levels per channel
+                self.assertLess(max(ImageStat.Stat(ImageChops.difference(from_original, from_stored)).mean), 4)
+            # the three calls of this test
+            self.assertEqual(3, manipulate_file.call_count)
+            # less than twice as large
+            self.storage.get('jpg_image', 'jpg', 'fit', (500, 500)).close()
+            self.storage.get('jpg_image', 'jpg', 'crop', (500, 100)).close()
+            self.assertEqual(5, manipulate_file.call_count)
+            # stored versions are in the format of the original, the output format doesn't matter
+            with self.storage.get('jpg_image', 'jpg', 'fit', (100, 100), 'webp') as image_file:
+                self.assertEqual('WEBP', PILImage.open(image_file).format)
+            self.assertEqual(5, manipulate_file.call_count)
+
+    def test_manipulated_from_stored_version_has_the_size_of_the_original(self):
+        self.storage.save('wide', 'png', image.binary_image(PILImage.new('RGB', (1841, 893)), 'PNG').getvalue())
+        self.storage.get('wide', 'png', 'fit', (411, 411)).close()
+        with self.storage.get('wide', 'png', 'fit', (166, 166)) as image_file:
+            self.assertEqual((166, 81), PILImage.open(image_file).size)
+
+    def test_dimensions(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            self.storage.save('jpg_image', 'jpg', jpg_file.read())
+        self.assertEqual((1600, 1200), self.storage.dimensions('jpg_image', 'jpg'))
+        self.assertRaises(NotFound, self.storage.dimensions, 'missing', 'jpg')
+
+    def test_max_manipulated(self):
+        storage = FileSystemStorage(self.storage_dir, max_manipulated=2)
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            storage.save('png_image', 'png', png_file.read())
+        for width, atime in ((100, 2000), (200, 1000)):
+            storage.get('png_image', 'png', 'fit', (width, width)).close()
+            image_path = storage.path('png_image', 'png', 'fit', (width, width))
+            os.utime(image_path, (atime, os.stat(image_path).st_mtime))
+        # a read makes it the most recently read one
+        storage.get('png_image', 'png', 'fit', (200, 200)).close()
+        storage.get('png_image', 'png', 'crop', (50, 50)).close()
+        self.assertEqual([('crop', (50, 50), 'png'), ('fit', (200, 200), 'png')],
+                         sorted(storage.manipulated('png_image', 'png')))
+
+    def test_max_manipulated_calls_on_evict(self):
+        storage = FileSystemStorage(self.storage_dir, max_manipulated=1)
+        storage.on_evict = mock.Mock()
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            storage.save('png_image', 'png', png_file.read())
+        storage.get('png_image', 'png', 'fit', (100, 100)).close()
+        storage.get('png_image', 'png', 'fit', (200, 200), 'webp').close()
+        storage.on_evict.assert_called_once_with('png_image', 'png', 'fit', (100, 100), None)
+
+    def test_safe_name_reserves_name(self):
+        first = self.storage.safe_name('png_image', 'png')
+        second = self.storage.safe_name('png_image', 'png')
+        self.assertEqual(['png_image', 'png_image-1'], [first, second])
+        self.assertTrue(self.storage.exists(first, 'png'))
+
+    def test_release_name(self):
+        name = self.storage.safe_name('png_image', 'png')
+        self.storage.release_name(name, 'png')
+        self.assertFalse(self.storage.exists(name, 'png'))
+        # saved images are kept
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            self.storage.save(name, 'png', png_file.read())
+        self.storage.release_name(name, 'png')
+        self.assertTrue(self.storage.exists(name, 'png'))
+
+    def test_safe_name_skips_taken_names(self):
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            png_data = png_file.read()
+        for name in ('png_image', 'png_image-1', 'png_image-2'):
+            self.storage.save(name, 'png', png_data)
+        self.assertEqual('png_image-3', self.storage.safe_name('png_image', 'png'))
+        # the next call starts after the last reserved name
+        with mock.patch.object(self.storage, '_reserve', wraps=self.storage._reserve) as reserve:
+            self.assertEqual('png_image-4', self.storage.safe_name('png_image', 'png'))
+            self.assertEqual(1, reserve.call_count)
+
+    def test_concurrent_safe_name(self):
+        names = []
+
+        def safe_name():
+            for _ in range(10):
+                names.append(self.storage.safe_name('png_image', 'png'))
+        threads = [threading.Thread(target=safe_name) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(40, len(set(names)))
+
+    def test_stat(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        self.assertRaises(NotFound, self.storage.stat, image_name, image_extension)
+        with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
+            png_data = png_file.read()
+        self.storage.save(image_name, image_extension, png_data)
+        self.assertEqual(len(png_data), self.storage.stat(image_name, image_extension).st_size)
+        # stat doesn't create manipulated images
+        self.assertRaises(NotFound, self.storage.stat, image_name, image_extension, 'fit', (200, 200))
+        self.assertFalse(self.storage.exists(image_name, image_extension, 'fit', (200, 200)))
+
+    def test_output_extension(self):
+        image_name = 'png_image'
+        image_extension = 'png'
+        with open(self._test_image_path('%s.%s' % (image_name, image_extension)), 'rb') as png_file:
+            self.storage.save(image_name, image_extension, png_file.read())
+        image_file = self.storage.get(image_name, image_extension, 'fit', (200, 200), 'jpg')
+        self.assertEqual('JPEG', PILImage.open(image_file).format)
+        self.assertTrue(op.isfile(op.join(self.storage_dir, '_png_image.png', 'fit-200x200.jpg')))
+        self.assertFalse(self.storage.exists(image_name, image_extension, 'fit', (200, 200)))
+        self.assertTrue(self.storage.exists(image_name, image_extension, 'fit', (200, 200), 'jpg'))
+
+    def test_save_stream(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            jpg_data = jpg_file.read()
+            jpg_file.seek(0)
+            self.storage.save_stream('jpg_image', 'jpg', jpg_file)
+        with self.storage.get('jpg_image', 'jpg') as image_file:
+            self.assertEqual(jpg_data, image_file.read())
+        self.assertEqual(['jpg_image.jpg'], self._storage_entries())
+
+    def test_reads_create_no_directories(self):
+        self.assertFalse(self.storage.exists('missing', 'jpg', 'fit', (100, 100)))
+        self.assertRaises(NotFound, self.storage.get, 'missing', 'jpg')
+        self.assertRaises(NotFound, self.storage.stat, 'missing', 'jpg', 'fit', (100, 100))
+        self.storage.path('missing', 'jpg', 'fit', (100, 100))
+        self.assertEqual([], self._storage_entries())
+
+    def test_sharded_layout(self):
+        storage = FileSystemStorage(self.storage_dir, sharded=True)
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            storage.save('jpg_image', 'jpg', jpg_file.read())
+        storage.get('jpg_image', 'jpg', 'fit', (100, 100)).close()
+        image_path = storage.path('jpg_image', 'jpg')
+        shard_dir = op.relpath(op.dirname(image_path), self.storage_dir)
+        self.assertRegex(shard_dir, r'^[0-9a-f]{2}/[0-9a-f]{2}$')
+        self.assertTrue(op.isfile(image_path))
+        self.assertEqual(op.join(op.dirname(image_path), '_jpg_image.jpg', 'fit-100x100.jpg'),
+                         storage.path('jpg_image', 'jpg', 'fit', (100, 100)))
+        self.assertTrue(storage.exists('jpg_image', 'jpg', 'fit', (100, 100)))
+        self.assertEqual('jpg_image-1', storage.safe_name('jpg_image', 'jpg'))
+        for entry in self._storage_entries():
+            self.assertRegex(entry, r'^(\.names|[0-9a-f]{2})$')
+
+
+class TestIndexedFileSystemStorage(TestFileSystemStorage):
+    """the storage API with the metadata index"""
+
+    def setUp(self):
+        self.storage_dir = op.join(op.dirname(op.dirname(op.realpath(__file__))), 'test_storage')
+        self.storage = FileSystemStorage(self.storage_dir, indexed=True)
+
+    def _storage_entries(self):
+        return [entry for entry in os.listdir(self.storage_dir) if not entry.startswith('.index.sqlite')]
+
+    def _save_jpg(self):
+        with open(self._test_image_path('jpg_image.jpg'), 'rb') as jpg_file:
+            data = jpg_file.read()
+        self.storage.save('jpg_image', 'jpg', data)
+        return data
+
+    def test_metadata(self):
+        data = self._save_jpg()
+        metadata = self.storage.metadata('jpg_image', 'jpg')
+        self.assertEqual('JPEG', metadata['format'])
+        self.assertEqual(PILImage.open(BytesIO(data)).size, (metadata['width'], metadata['height']))
+        self.assertEqual(len(data), metadata['size'])
+        self.assertEqual(hashlib.sha256(data).hexdigest(), metadata['content_hash'])
+        self.storage.save_stream('jpg_image', 'jpg', BytesIO(data))
+        self.assertEqual(hashlib.sha256(data).hexdigest(), self.storage.metadata('jpg_image', 'jpg')['content_hash'])
+        self.assertRaises(NotFound, self.storage.metadata, 'missing', 'jpg')
+
+    def test_stat_matches_file(self):
+        self._save_jpg()
+        self.storage.get('jpg_image', 'jpg', 'fit', (100, 100)).close()
+        for args in (('jpg_image', 'jpg'), ('jpg_image', 'jpg', 'fit', (100, 100))):
+            file_stat = os.stat(self.storage.path(*args))
+            self.assertEqual((file_stat.st_size, file_stat.st_mtime), tuple(self.storage.stat(*args)))
+
+    def test_index_stats(self):
+        data = self._save_jpg()
+        manipulated = self.storage.get('jpg_image', 'jpg', 'fit', (100, 100)).read()
+        self.assertEqual(dict(originals=1, original_bytes=len(data), manipulated=1, manipulated_bytes=len(manipulated)),
+                         self.storage.index_stats())
+        self.storage.delete('jpg_image', 'jpg')
+        self.assertEqual(dict(originals=0, original_bytes=0, manipulated=0, manipulated_bytes=0),
+                         self.storage.index_stats())
+        self.assertIsNone(FileSystemStorage(self.storage_dir).index_stats())
+
+    def test_rebuild_index(self):
+        self._save_jpg()
+        self.storage.get('jpg_image', 'jpg', 'crop', (50, 50), 'webp').close()
+        metadata = self.storage.metadata('jpg_image', 'jpg')
+        stats = self.storage.index_stats()
+        # changes that bypass the index
+        os.remove(op.join(self.storage_dir, '.index.sqlite'))
+        with open(self._test_image_path('png_image.png'), 'rb') as png_file:
+            FileSystemStorage(self.storage_dir).save('png_image', 'png', png_file.read())
+        storage = FileSystemStorage(self.storage_dir, indexed=True)
+        self.assertFalse(storage.exists('jpg_image', 'jpg'))
+        storage.rebuild_index()
+        self.assertEqual(metadata, storage.metadata('jpg_image', 'jpg'))
+        self.assertEqual([('crop', (50, 50), 'webp')], storage.manipulated('jpg_image', 'jpg'))
+        self.assertTrue(storage.exists('png_image', 'png'))
+        self.assertEqual(stats['originals'] + 1, storage.index_stats()['originals'])
+
+
+class TestContentAddressedStorage(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = op.join(op.dirname(op.dirname(op.realpath(__file__))), 'test_storage')
+        self.storage = ContentAddressedStorage(self.storage_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_dir)
+
+    def _test_image_data(self, image_name):
+        current_dir = op.dirname(op.realpath(__file__))
+        with open(op.join(current_dir, 'test_images', image_name), 'rb') as image_file:
+            return image_file.read()
+
+    def _blobs(self):
+        return sorted(f for f in os.listdir(op.join(self.storage_dir, '.blobs')) if not f.startswith('_'))
+
+    def test_manipulated(self):
+        self.storage.save('first', 'png', self._test_image_data('png_image.png'))
+        self.storage.get('first', 'png', 'fit', (100, 100)).close()
+        self.assertEqual([('fit', (100, 100), 'png')], self.storage.manipulated('first', 'png'))
+        self.assertEqual([], self.storage.manipulated('missing', 'png'))
+
+    def test_identical_uploads_stored_once(self):
+        png_data = self._test_image_data('png_image.png')
+        self.storage.save('first', 'png', png_data)
+        self.storage.save('second', 'png', png_data)
+        self.assertEqual(1, len(self._blobs()))
+        with self.storage.get('second', 'png') as image_file:
+            self.assertEqual(png_data, image_file.read())
+
+    def test_evicted_blob_versions_for_all_names(self):
+        storage = ContentAddressedStorage(self.storage_dir, max_manipulated=1)
+        storage.on_evict = mock.Mock()
+        png_data = self._test_image_data('png_image.png')
+        storage.save('first', 'png', png_data)
+        storage.save('second', 'png', png_data)
+        storage.get('first', 'png', 'fit', (100, 100)).close()
+        storage.get('first', 'png', 'fit', (200, 200)).close()
+        self.assertEqual(sorted([mock.call('first', 'png', 'fit', (100, 100), None),
+                                 mock.call('second', 'png', 'fit', (100, 100), None)]),
+                         sorted(storage.on_evict.call_args_list))
+
+    def test_identical_uploads_share_manipulated_images(self):
+        png_data = self._test_image_data('png_image.png')
+        self.storage.save('first', 'png', png_data)
+        self.storage.save('second', 'png', png_data)
+        self.storage.get('first', 'png', 'fit', (200, 200))
+        self.assertTrue(self.storage.exists('second', 'png', 'fit', (200, 200)))
+        with mock.patch.object(image, 'fit_image') as fit_image:
+            self.storage.get('second', 'png', 'fit', (200, 200)).close()
+            self.assertFalse(fit_image.called)
+
+    def test_update_with_new_content(self):
+        self.storage.save('first', 'png', self._test_image_data('png_image.png'))
+        self.storage.get('first', 'png', 'fit', (200, 200))
+        rotated = BytesIO()
+        PILImage.open(BytesIO(self._test_image_data('png_image.png'))).rotate(90, expand=True).save(rotated, 'PNG')
+        self.storage.save('first', 'png', rotated.getvalue())
+        self.assertEqual((150, 200), PILImage.open(self.storage.get('first', 'png', 'fit', (200, 200))).size)
+        self.storage.delete('first', 'png', 'fit', (200, 200))
+        self.assertFalse(self.storage.exists('first', 'png', 'fit', (200, 200)))
+        self.assertEqual(1, len(self._blobs()))
+
+    def test_delete_keeps_shared_blob(self):
+        png_data = self._test_image_data('png_image.png')
+        self.storage.save('first', 'png', png_data)
+        self.storage.save('second', 'png', png_data)
+        self.storage.delete('first', 'png')
+        self.assertFalse(self.storage.exists('first', 'png'))
+        self.assertRaises(NotFound, self.storage.get, 'first', 'png')
+        with self.storage.get('second', 'png') as image_file:
+            self.assertEqual(png_data, image_file.read())
+        self.storage.delete('second', 'png')
+        self.assertEqual([], self._blobs())
+        self.assertEqual([], os.listdir(op.join(self.storage_dir, '.blobs')))
+
+    def test_safe_name(self):
+        png_data = self._test_image_data('png_image.png')
+        self.storage.save('png_image', 'png', png_data)
+        self.assertEqual('png_image-1', self.storage.safe_name('png_image', 'png'))
+
+    def test_release_name(self):
+        name = self.storage.safe_name('png_image', 'png')
+        self.storage.release_name(name, 'png')
+        self.assertFalse(self.storage.exists(name, 'png'))
+        self.storage.save(name, 'png', self._test_image_data('png_image.png'))
+        self.storage.release_name(name, 'png')
+        self.assertTrue(self.storage.exists(name, 'png'))
+
+    def test_delete_placeholder(self):
+        name = self.storage.safe_name('png_image', 'png')
+        self.storage.delete(name, 'png')
+        self.assertFalse(self.storage.exists(name, 'png'))
+
+    def test_not_existing(self):
+        self.assertRaises(NotFound, self.storage.get, 'png_image', 'png')
+        self.assertRaises(NotFound, self.storage.get, 'png_image', 'png', 'fit', (200, 200))
+        self.assertRaises(NotFound, self.storage.delete, 'png_image', 'png')
+        self.assertFalse(self.storage.exists('png_image', 'png', 'fit', (200, 200)))
+
+    def test_save_stream(self):
+        png_data = self._test_image_data('png_image.png')
+        self.storage.save('first', 'png', png_data)
+        self.storage.save_stream('second', 'png', BytesIO(png_data))
+        self.storage.save_stream('third', 'png', BytesIO(self._test_image_data('jpg_image.jpg')))
+        self.assertEqual(2, len(self._blobs()))
+        with self.storage.get('second', 'png') as image_file:
+            self.assertEqual(png_data, image_file.read())
+        self.assertFalse([f for f in os.listdir(op.join(self.storage_dir, '.blobs')) if f.endswith('.tmp')])
+
+    def test_sharded(self):
+        storage = ContentAddressedStorage(self.storage_dir, sharded=True)
+        png_data = self._test_image_data('png_image.png')
+        storage.save('first', 'png', png_data)
+        storage.save('second', 'png', png_data)
+        with storage.get('second', 'png') as image_file:
+            self.assertEqual(png_data, image_file.read())
+        storage.get('first', 'png', 'fit', (100, 100)).close()
+        self.assertTrue(storage.exists('second', 'png', 'fit', (100, 100)))
+        storage.delete('first', 'png')
+        storage.delete('second', 'png')
+        self.assertFalse(any(files for _, _, files in os.walk(op.join(self.storage_dir, '.blobs'))))
+
+
+class TestTieredStorage(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = op.join(op.dirname(op.dirname(op.realpath(__file__))), 'test_storage')
+        self.cold = FileSystemStorage(op.join(self.storage_dir, 'cold'))
+        self.local_dir = op.join(self.storage_dir, 'local')
+        self.storage = TieredStorage(self.cold, self.local_dir, 1024 * 1024)
+        with open(op.join(op.dirname(op.realpath(__file__)), 'test_images', 'jpg_image.jpg'), 'rb') as jpg_file:
+            self.storage.save('jpg_image', 'jpg', jpg_file.read())
+
+    def tearDown(self):
+        shutil.rmtree(self.storage_dir)
+
+    def test_originals_in_cold_storage(self):
+        self.assertTrue(self.cold.exists('jpg_image', 'jpg'))
+        self.assertFalse(op.exists(op.join(self.local_dir, 'jpg_image.jpg')))
+        with self.storage.get('jpg_image', 'jpg') as image_file:
+            self.assertEqual(image_file.read(), self.cold.get('jpg_image', 'jpg').read())
+
+    def test_manipulated_in_local_storage(self):
+        self.storage.get('jpg_image', 'jpg', 'fit', (100, 100)).close()
+        self.assertTrue(op.isfile(op.join(self.local_dir, '_jpg_image.jpg', 'fit-100x100.jpg')))
+        self.assertFalse(self.cold.exists('jpg_image', 'jpg', 'fit', (100, 100)))
+        self.storage.get('jpg_image', 'jpg', 'fit', (100, 100)).close()
+        stats = self.storage.tier_stats()
+        self.assertEqual((1, 1, 0.5), (stats['hits'], stats['misses'], stats['hit_ratio']))
+
+    def test_manipulated_from_local_version(self):
+        self.storage.get('jpg_image', 'jpg', 'fit', (800, 800)).close()
+        with mock.patch.object(self.cold, 'get', wraps=self.cold.get) as cold_get:
+            with self.storage.get('jpg_image', 'jpg', 'fit', (200, 200)) as image_file:
+                self.assertEqual((200, 150), PILImage.open(image_file).size)
+            self.assertEqual(0, cold_get.call_count)
+        self.assertEqual(2, self.storage.tier_stats()['misses'])
+
+    def test_create_manipulated(self):
+        with mock.patch.object(self.cold, 'get', wraps=self.cold.get) as cold_get:
+            self.storage.create_manipulated('jpg_image', 'jpg', [('fit', (50, 50)), ('crop', (20, 20))])
+        # the original is read from the cold storage once for all versions
+        cold_get.assert_called_once_with('jpg_image', 'jpg')
+        self.assertTrue(self.storage.exists('jpg_image', 'jpg', 'fit', (50, 50)))
+        self.assertTrue(self.storage.exists('jpg_image', 'jpg', 'crop', (20, 20)))
+        self.assertFalse(self.cold.exists('jpg_image', 'jpg', 'fit', (50, 50)))
+
+    def test_touch(self):
+        self.storage.get('jpg_image', 'jpg', 'fit', (100, 100)).close()
+        image_path = self.storage.path('jpg_image', 'jpg', 'fit', (100, 100))
+        os.utime(image_path, (1000, os.stat(image_path).st_mtime))
+        self.storage.touch('jpg_image', 'jpg', 'fit', (100, 100))
+        self.assertGreater(os.stat(image_path).st_atime, 1000)
+        # evicted meanwhile
+        self.storage.touch('jpg_image', 'jpg', 'fit', (300, 300))
+
+    def test_evicts_least_recently_read(self):
+        for width in (100, 200, 300):
+            self.storage.get('jpg_image', 'jpg', 'fit', (width, width)).close()
+        # 200 was read last, 100 before 300
+        for width, atime in ((100, 1000), (200, 3000), (300, 2000)):
+            image_path = self.storage.path('jpg_image', 'jpg', 'fit', (width, width))
+            os.utime(image_path, (atime, os.stat(image_path).st_mtime))
+        sizes = [self.storage.stat('jpg_image', 'jpg', 'fit', (width, width)).st_size for width in (100, 200, 300)]
+        self.storage._max_bytes = sizes[1] + sizes[2]
+        self.storage.on_evict = mock.Mock()
+        # too wide to be created from a stored version (that would count as a read of it)
+        self.storage.get('jpg_image', 'jpg', 'crop', (280, 10)).close()
+        self.assertFalse(self.storage.exists('jpg_image', 'jpg', 'fit', (100, 100)))
+        self.assertFalse(self.storage.exists('jpg_image', 'jpg', 'fit', (300, 300)))
+        self.assertTrue(self.storage.exists('jpg_image', 'jpg', 'fit', (200, 200)))
+        self.assertEqual(2, self.storage.tier_stats()['evictions'])
+        self.assertEqual([mock.call('jpg_image', 'jpg', 'fit', (100, 100), None),
+                          mock.call('jpg_image', 'jpg', 'fit', (300, 300), None)],
+                         self.storage.on_evict.call_args_list)
+        # evicted images are created again
+        with self.storage.get('jpg_image', 'jpg', 'fit', (100, 100)) as image_file:
+            self.assertEqual((100, 75), PILImage.open(image_file).size)
+
+    def test_save_original_deletes_local_manipulated(self):
+        self.storage.get('jpg_image', 'jpg', 'fit', (100, 100)).close()
+        self.storage.save('jpg_image', 'jpg', self.cold.get('jpg_image', 'jpg').read())
+        self.assertFalse(self.storage.exists('jpg_image', 'jpg', 'fit', (100, 100)))
+
+    def test_delete(self):
+        self.storage.get('jpg_image', 'jpg', 'fit', (100, 100)).close()
+        self.storage.delete('jpg_image', 'jpg')
+        self.assertFalse(self.cold.exists('jpg_image', 'jpg'))
+        self.assertFalse(self.storage.exists('jpg_image', 'jpg', 'fit', (100, 100)))